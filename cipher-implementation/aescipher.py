@@ -8,15 +8,61 @@ Fantastic reference for AES implementation in Python
 
 """
 import os
+from struct import Struct
 from hashlib import pbkdf2_hmac
 from hmac import new as new_hmac, compare_digest
 from util import Util
 from scheduler import KeyScheduler
+from ttable import TTableEngine
+from numpy_engine import NumpyBatchEngine
+import keycache
+import streaming
+import asyncstream
+from streaming import CBCEncryptor, CBCDecryptor
+import parallel
+import profiling
+import batch
+from gcm import GHash, inc32
 
 
 class AES(Util):
-    def __init__(self, aes_key_size_bits: int = 128, master_key=None):
+    # Block engines available for _encrypt_block / decrypt_block.
+    # 'reference' runs the step-by-step state matrix rounds below,
+    # 'ttable' uses the 32-bit word lookup table rounds from ttable.py,
+    # 'numpy' batches independent blocks (CTR, CBC decryption) through numpy_engine.py
+    ENGINES = ('reference', 'ttable', 'numpy')
+    # Expanded key schedules are looked up here so that switching back to a recently
+    # used key skips key expansion. Set to None to always expand from scratch.
+    key_schedule_cache = keycache.DEFAULT_CACHE
+    # Password-derived keys (and their schedules) for encrypt_with_password / decrypt_with_password.
+    # Set to None to run PBKDF2 for every message.
+    derived_key_cache = keycache.DEFAULT_DERIVED_CACHE
+    # The profiling.Profiler an instance reports to, set by enable_profiling
+    profiler = None
+
+    def __init__(self, aes_key_size_bits: int = 128, master_key=None, engine: str = 'reference'):
+        self._configure(aes_key_size_bits, engine)
+        if not master_key:
+            master_key = self.generate_random_aes_key()
+            # print(f'Master key generated: {self.master_key}')
+        self.set_master_key(master_key)
+
+    @classmethod
+    def from_round_keys(cls, round_keys, engine: str = 'reference', ttable=None, inverse_round_keys=None):
+        """ Build a cipher around an already expanded key schedule, skipping key expansion.
+        Used by worker processes, which are only handed the round keys, and for cached schedules. """
+        num_rounds = len(round_keys) - 1
+        aes = cls.__new__(cls)
+        aes._configure({10: 128, 12: 192, 14: 256}[num_rounds], engine)
+        aes.master_key = None
+        aes._set_round_keys(round_keys, ttable, inverse_round_keys)
+        return aes
+
+    def _configure(self, aes_key_size_bits: int, engine: str):
+        """ Set the sizes and engine that do not depend on the key itself """
         super().__init__()
+        if engine not in self.ENGINES:
+            raise ValueError(f'Unknown AES engine {engine!r}; expected one of {self.ENGINES}')
 
         self.aes_key_size = aes_key_size_bits // 8
         self.hmac_key_size = 128 // 8
@@ -25,19 +71,8 @@ class AES(Util):
         self.block_size = 16
         self.iv_size = self.block_size
         self.num_rounds = {128: 10, 192: 12, 256: 14}[aes_key_size_bits]
-        if not master_key:
-            self.master_key = self.generate_random_aes_key()
-            # print(f'Master key generated: {self.master_key}')
-            self.key_scheduler = KeyScheduler()
-            self.round_keys = self.key_scheduler.get_key_expansion(
-                base_key=self.master_key,
-                key_columns=self._convert_byte_array_to_state_matrix(
-                    self.master_key),
-                num_rounds=self.num_rounds
-            )
-            # print(f'{len(self.round_keys)} round keys generated.')
-            # for i, r in enumerate(self.round_keys):
-            # print(f'Round key {i} length = {len(r)}')
+        self.engine_name = engine
+        self.engine = None
 
     def generate_random_aes_key(self):
         """ Generate a random AES base key using the bytes size self.aes_key_size """
@@ -47,16 +82,29 @@ class AES(Util):
         if isinstance(key, str):
             key = key.encode('utf-8')
         self.master_key = key
-        self.key_scheduler = KeyScheduler()
-        self.round_keys = self.key_scheduler.get_key_expansion(
-            base_key=self.master_key,
-            key_columns=self._convert_byte_array_to_state_matrix(
-                self.master_key),
-            num_rounds=self.num_rounds
-        )
+        if self.key_schedule_cache is None:
+            schedule = keycache.expand_key(KeyScheduler(), self.master_key, self.num_rounds)
+        else:
+            schedule = self.key_schedule_cache.get(self.master_key, self.num_rounds)
         # print(f'{len(self.round_keys)} round keys generated.')
         # for i, r in enumerate(self.round_keys):
         # print(f'Round key {i} length = {len(r)}')
+        self._set_round_keys(schedule.round_keys, schedule.ttable, schedule.inverse_round_keys)
+
+    def _set_round_keys(self, round_keys, ttable=None, inverse_round_keys=None):
+        """ Install an expanded key schedule and build the selected block engine around it.
+        A prebuilt (e.g. cached) TTableEngine and equivalent inverse schedule for the same
+        key can be passed in; otherwise they are derived from round_keys. """
+        self.round_keys = round_keys
+        if inverse_round_keys is None:
+            inverse_round_keys = KeyScheduler().get_equivalent_inverse_key_expansion(round_keys)
+        self.inverse_round_keys = inverse_round_keys
+        self._ghash = None
+        if self.engine_name == 'ttable':
+            self.engine = ttable if ttable is not None else TTableEngine(
+                self.round_keys, self.num_rounds, self.inverse_round_keys)
+        elif self.engine_name == 'numpy':
+            self.engine = NumpyBatchEngine(self.round_keys, self.num_rounds, ttable)
 
     def _add_round_key(self, state, round_key):
         """
@@ -133,16 +181,16 @@ class AES(Util):
 
     def mix_single_column(self, a):
         """ Mix one single column of a state matrix;
-        Implemention coming directly from
-        Section 4.1.2 in The Design of Rijndael shown in README
+        Section 4.1.2 in The Design of Rijndael shown in README: each output byte is
+        02.a[i] ^ 03.a[i+1] ^ a[i+2] ^ a[i+3]. The 02 / 03 products come from the
+        precomputed Rijndael tables (02 . x is xtime(x)) instead of calling xtime per byte.
         """
-        t = a[0] ^ a[1] ^ a[2] ^ a[3]
-        u = a[0]  # first row
-        for i in range(4):
-            m = u if (i + 1) % 4 == 0 else a[i + 1]
-            v = a[i] ^ m
-            v = self.xtime(v)
-            a[i] = a[i] ^ t ^ v
+        mul2, mul3 = self.mul2, self.mul3
+        a0, a1, a2, a3 = a
+        a[0] = mul2[a0] ^ mul3[a1] ^ a2 ^ a3
+        a[1] = a0 ^ mul2[a1] ^ mul3[a2] ^ a3
+        a[2] = a0 ^ a1 ^ mul2[a2] ^ mul3[a3]
+        a[3] = mul3[a0] ^ a1 ^ a2 ^ mul2[a3]
 
     def mix_columns(self, state: list):
         """ Handle the mix columns step of an AES round
@@ -153,29 +201,59 @@ class AES(Util):
             self.mix_single_column(state[i])
 
     def _inverse_mix_columns(self, state: list):
-        """ Invert the column mixing; implementation directly from
-        section 4.1.3 in The Design of Rijndael, shown in README.
-        KEY NOTE from that section:
-        ... InvMixColumns can be implemented as a simple preprocessing step, followed by a MixColumns step.
+        """ Invert the column mixing; section 4.1.3 in The Design of Rijndael, shown in README.
+        The book implements InvMixColumns as a preprocessing step (four xtime calls per column)
+        followed by a MixColumns step. Here the two are fused into a single pass multiplying by
+        the inverse circulant matrix (0e, 0b, 0d, 09) with the precomputed tables, so it costs
+        the same as a forward MixColumns.
         """
-        for i in range(4):
-            a = state[i]  # a is a column
-            u = self.xtime(self.xtime(a[0] ^ a[2]))
-            v = self.xtime(self.xtime(a[1] ^ a[3]))
-            a[0] ^= u
-            a[1] ^= v
-            a[2] ^= u
-            a[3] ^= v
-
-        self.mix_columns(state)
-
-    def decrypt(self, ciphertext, initialization_vector):
+        mul9, mul11, mul13, mul14 = self.mul9, self.mul11, self.mul13, self.mul14
+        for a in state:  # a is a column
+            a0, a1, a2, a3 = a
+            a[0] = mul14[a0] ^ mul11[a1] ^ mul13[a2] ^ mul9[a3]
+            a[1] = mul9[a0] ^ mul14[a1] ^ mul11[a2] ^ mul13[a3]
+            a[2] = mul13[a0] ^ mul9[a1] ^ mul14[a2] ^ mul11[a3]
+            a[3] = mul11[a0] ^ mul13[a1] ^ mul9[a2] ^ mul14[a3]
+
+    def decrypt(self, ciphertext, initialization_vector, workers: int = 1, executor=None,
+                min_segment_size: int = parallel.MIN_SEGMENT_SIZE):
         """
         Decrypt ciphertext using the initialization vector used by encryption.
 
         The AES algorithm requires that the IV size must be 16 bytes (128 bits)
+
+        Unlike encryption, CBC decryption of block i only needs ciphertext blocks i and i - 1,
+        so with workers > 1 (or workers=None for one per core) large ciphertexts are split into
+        contiguous ranges that are decrypted in a process pool.
         """
+        return self.decrypt_bytes(ciphertext, initialization_vector, workers, executor,
+                                  min_segment_size).decode('utf-8')
+
+    def decrypt_bytes(self, ciphertext, initialization_vector, workers: int = 1, executor=None,
+                      min_segment_size: int = parallel.MIN_SEGMENT_SIZE) -> bytes:
+        """ Same as decrypt but returns the raw plaintext bytes, for binary payloads """
         assert len(initialization_vector) == 16
+        return self._remove_padding(self._decrypt_cbc(
+            ciphertext, initialization_vector, workers, executor, min_segment_size))
+
+    def _decrypt_cbc(self, ciphertext, initialization_vector, workers: int = 1, executor=None,
+                     min_segment_size: int = parallel.MIN_SEGMENT_SIZE) -> bytes:
+        """ CBC decrypt whole blocks, leaving any padding in place """
+        if workers != 1:
+            segments = parallel.split_into_segments(
+                len(ciphertext), self.block_size, workers, min_segment_size)
+            if len(segments) > 1:
+                # Each range chains from the last ciphertext block of the range before it
+                jobs = [
+                    (self.round_keys, self.engine_name,
+                     ciphertext[start - self.block_size: start] if start else initialization_vector,
+                     ciphertext[start: end])
+                    for start, end in segments
+                ]
+                return b''.join(parallel.map_in_processes(
+                    parallel.cbc_decrypt_segment, jobs, workers, executor))
+        if self.engine is not None:
+            return self.engine.decrypt_cbc(ciphertext, initialization_vector)
 
         decrypted_blocks = []
         previous = initialization_vector
@@ -189,37 +267,41 @@ class AES(Util):
             # print(f'Decrypted block: {decrypted_block}')
             decrypted_blocks.append(decrypted_block)
             previous = ciphertext_block
-        return self._remove_padding(b''.join(decrypted_blocks)).decode('utf-8')
+        return b''.join(decrypted_blocks)
 
     def decrypt_block(self, ciphertext):
         """
         Decrypt single 16 byte block (128 bits) of cipher text
         """
         assert len(ciphertext) == 16
+        if self.engine is not None:
+            return self.engine.decrypt_block(ciphertext)
+
+        # Equivalent inverse cipher (FIPS-197 section 5.3.5): self.inverse_round_keys holds the
+        # round keys in reverse order with InvMixColumns already applied to the middle ones, so
+        # each round has the same shape as an encryption round.
+        inverse_round_keys = self.inverse_round_keys
 
         # Step 1: Get the 4x4 state matrix from the cipher text block
         cipher_state = self._convert_byte_array_to_state_matrix(ciphertext)
 
-        # Step 2: Add round key for current / initial round
-        self._add_round_key(cipher_state, self.round_keys[-1])
-
-        # invert the row shift and byte substitutions since
-        # encryption ends with sub bytes and then shift rows
-        self._inverse_shift_rows(cipher_state)
-        self._inverse_substitute_bytes(cipher_state)
+        # Step 2: Add round key for current / initial round (the last encryption round key)
+        self._add_round_key(cipher_state, inverse_round_keys[0])
 
-        for i in range(self.num_rounds - 1, 0, -1):
-            self._add_round_key(cipher_state, self.round_keys[i])
-            self._inverse_mix_columns(cipher_state)
-            self._inverse_shift_rows(cipher_state)
+        for i in range(1, self.num_rounds):
             self._inverse_substitute_bytes(cipher_state)
+            self._inverse_shift_rows(cipher_state)
+            self._inverse_mix_columns(cipher_state)
+            self._add_round_key(cipher_state, inverse_round_keys[i])
 
-        # Finish by adding (xoring) round key
-        self._add_round_key(cipher_state, self.round_keys[0])
+        # Final round has no InvMixColumns; finish by adding the original cipher key
+        self._inverse_substitute_bytes(cipher_state)
+        self._inverse_shift_rows(cipher_state)
+        self._add_round_key(cipher_state, inverse_round_keys[-1])
 
         return self._convert_state_matrix_to_byte_array(cipher_state)
 
-    def _get_key_iv(self, password, salt, workload=100000):
+    def _get_key_iv(self, password, salt, workload=100000, aes_key_size=None):
         """
         Introduce some randomness with an initialization vector.
         Purpose of IV is to to achieve semantic security,
@@ -228,11 +310,12 @@ class AES(Util):
         (potentially similar) segments of the encrypted message.
 
         Stretches the password and extracts an AES key, an HMAC key and an AES
-        initialization vector.
+        initialization vector. aes_key_size (bytes) defaults to this cipher's key size.
         """
+        aes_key_size = aes_key_size or self.aes_key_size
         stretched = pbkdf2_hmac('sha256', password, salt,
-                                workload, self.aes_key_size + self.iv_size + self.hmac_key_size)
-        aes_key, stretched = stretched[:self.aes_key_size], stretched[self.aes_key_size:]
+                                workload, aes_key_size + self.iv_size + self.hmac_key_size)
+        aes_key, stretched = stretched[:aes_key_size], stretched[aes_key_size:]
         hmac_key, stretched = stretched[:self.hmac_key_size], stretched[self.hmac_key_size:]
         iv = stretched[:self.iv_size]
         return aes_key, hmac_key, iv
@@ -241,6 +324,8 @@ class AES(Util):
         """ Encrypt single 16 byte block (128 bits) of plaintext """
         # Ensure the plaintext length is actually the correct block size
         assert len(plaintext) == 16
+        if self.engine is not None:
+            return self.engine.encrypt_block(plaintext)
         # step 1: convert plaintext to "state" 4x4 matrix
         plaintext_state = self._convert_byte_array_to_state_matrix(plaintext)
 
@@ -271,6 +356,12 @@ class AES(Util):
 
         # add padding; won't do anything if no padding needed
         plaintext = self._add_padding(plaintext)
+        return self._encrypt_cbc(plaintext, initialization_vector)
+
+    def _encrypt_cbc(self, plaintext, initialization_vector) -> bytes:
+        """ CBC encrypt plaintext that is already padded to a whole number of blocks """
+        if self.engine is not None:
+            return self.engine.encrypt_cbc(plaintext, initialization_vector)
 
         # initial round key addition; each byte of the state is combined with a byte of the round key using bitwise xor.
         encrypted_blocks = []
@@ -287,3 +378,342 @@ class AES(Util):
             encrypted_blocks.append(encrypted_block)
             prev = encrypted_block
         return b''.join(encrypted_blocks)
+
+    ## Buffer based API ##
+    def _writable_view(self, out, needed: int):
+        view = memoryview(out).cast('B')
+        if view.readonly:
+            raise TypeError('Output buffer must be writable')
+        if len(view) < needed:
+            raise ValueError(f'Output buffer too small: {needed} bytes needed, {len(view)} available')
+        return view
+
+    def encrypt_into(self, plaintext, out, initialization_vector) -> int:
+        """ CBC encrypt any bytes-like plaintext (bytes, bytearray, memoryview, mmap, ...) into the
+        caller provided writable buffer out, which needs room for the padded length
+        (len(plaintext) // 16 + 1) * 16. Returns the number of bytes written.
+        With the ttable / numpy engines whole blocks are read and written in place;
+        only the final padded block is built separately. """
+        source = memoryview(plaintext).cast('B')
+        whole = len(source) - len(source) % self.block_size
+        total = whole + self.block_size
+        destination = self._writable_view(out, total)
+        self._encrypt_cbc_into(source[:whole], destination[:whole], initialization_vector)
+        previous = bytes(destination[whole - self.block_size: whole]) if whole else initialization_vector
+        final_block = self._add_padding(bytes(source[whole:]))
+        self._encrypt_cbc_into(final_block, destination[whole: total], previous)
+        return total
+
+    def decrypt_into(self, ciphertext, out, initialization_vector) -> int:
+        """ CBC decrypt any bytes-like ciphertext into the caller provided writable buffer out
+        (at least len(ciphertext) bytes). Returns the plaintext length; the padding bytes
+        after it in out are left as decrypted. """
+        source = memoryview(ciphertext).cast('B')
+        length = len(source)
+        if length == 0 or length % self.block_size:
+            raise ValueError('Ciphertext length is not a positive multiple of the block size')
+        destination = self._writable_view(out, length)
+        self._decrypt_cbc_into(source, destination[:length], initialization_vector)
+        last_block = bytes(destination[length - self.block_size: length])
+        return length - self.block_size + len(self._remove_padding(last_block))
+
+    def _encrypt_cbc_into(self, plaintext, out, initialization_vector):
+        if self.engine is not None:
+            self.engine.encrypt_cbc_into(plaintext, out, initialization_vector)
+        else:
+            out[:] = self._encrypt_cbc(bytes(plaintext), initialization_vector)
+
+    def _decrypt_cbc_into(self, ciphertext, out, initialization_vector):
+        if self.engine is not None:
+            self.engine.decrypt_cbc_into(ciphertext, out, initialization_vector)
+        else:
+            out[:] = self._decrypt_cbc(bytes(ciphertext), initialization_vector)
+    ## Buffer based API ##
+
+    ## Batches of messages ##
+    def _many(self, pairs, batch_fn, worker, workers, executor, min_shard_size) -> list:
+        """ Run batch_fn over all pairs, or over contiguous shards of them in worker processes """
+        pairs = list(pairs)
+        shards = parallel.split_into_segments(len(pairs), 1, workers, min_shard_size)
+        if len(shards) <= 1:
+            return batch_fn(self, pairs)
+        jobs = [(self.round_keys, self.engine_name, pairs[start: end]) for start, end in shards]
+        return [result for shard in parallel.map_in_processes(worker, jobs, workers, executor) for result in shard]
+
+    def encrypt_many(self, pairs, workers: int = 1, executor=None,
+                     min_shard_size: int = parallel.MIN_SHARD_MESSAGES) -> list:
+        """ CBC encrypt a sequence of (message, iv) pairs in one go (see batch.py), returning the
+        ciphertexts in order. Same output as calling encrypt on each pair, at a fraction of the
+        per message cost. With workers > 1 (None for one per core) large batches are split into
+        shards of at least min_shard_size messages and encrypted in a process pool. """
+        return self._many(pairs, batch.encrypt_many, parallel.encrypt_many_segment,
+                          workers, executor, min_shard_size)
+
+    def decrypt_many(self, pairs, workers: int = 1, executor=None,
+                     min_shard_size: int = parallel.MIN_SHARD_MESSAGES) -> list:
+        """ CBC decrypt a sequence of (ciphertext, iv) pairs, returning the plaintext bytes in order
+        (as decrypt_bytes would). Sharding works as in encrypt_many. """
+        return self._many(pairs, batch.decrypt_many, parallel.decrypt_many_segment,
+                          workers, executor, min_shard_size)
+
+    @staticmethod
+    def encrypt_multi_key(keys, block_sets) -> list:
+        """ Encrypt block_sets[i] (whole 16 byte blocks, ECB) under keys[i] for many keys in one pass,
+        expanding every key schedule together instead of one KeyScheduler run per key (see batch.py) """
+        return batch.encrypt_multi_key(keys, block_sets)
+
+    @staticmethod
+    def decrypt_multi_key(keys, block_sets) -> list:
+        """ Inverse of encrypt_multi_key """
+        return batch.decrypt_multi_key(keys, block_sets)
+    ## Batches of messages ##
+
+    ## Streaming ##
+    def encryptor(self, initialization_vector):
+        """ Incremental CBC encryptor with update(chunk) / finalize() semantics, see streaming.py """
+        return CBCEncryptor(self, initialization_vector)
+
+    def decryptor(self, initialization_vector):
+        """ Incremental CBC decryptor with update(chunk) / finalize() semantics, see streaming.py """
+        return CBCDecryptor(self, initialization_vector)
+
+    def encrypt_file(self, source_path, destination_path, initialization_vector,
+                     chunk_size: int = streaming.DEFAULT_CHUNK_SIZE, use_mmap: bool = False):
+        """ CBC encrypt a file of any size with bounded memory; returns bytes written """
+        return streaming.encrypt_file(self, source_path, destination_path, initialization_vector,
+                                      chunk_size=chunk_size, use_mmap=use_mmap)
+
+    def decrypt_file(self, source_path, destination_path, initialization_vector,
+                     chunk_size: int = streaming.DEFAULT_CHUNK_SIZE, use_mmap: bool = False):
+        """ CBC decrypt a file written by encrypt_file; returns bytes written """
+        return streaming.decrypt_file(self, source_path, destination_path, initialization_vector,
+                                      chunk_size=chunk_size, use_mmap=use_mmap)
+
+    def open_encrypted(self, source, initialization_vector=None, cache_blocks: int = 256):
+        """ Seekable read-only file object over a CBC encrypted file that decrypts only the
+        blocks each read covers (see streaming.CBCReader). Without an IV the file must start with it. """
+        return streaming.CBCReader(self, source, initialization_vector, cache_blocks=cache_blocks)
+
+    async def encrypt_stream(self, reader, writer, initialization_vector, mode: str = 'cbc', **kwargs):
+        """ Encrypt an asyncio StreamReader into a StreamWriter off the event loop
+        (CBC or CTR, see asyncstream.py); returns the stream's StreamStats """
+        return await asyncstream.encrypt_stream(self, reader, writer, initialization_vector, mode, **kwargs)
+
+    async def decrypt_stream(self, reader, writer, initialization_vector, mode: str = 'cbc', **kwargs):
+        """ Decrypt an asyncio StreamReader into a StreamWriter off the event loop; returns StreamStats """
+        return await asyncstream.decrypt_stream(self, reader, writer, initialization_vector, mode, **kwargs)
+    ## Streaming ##
+
+    ## Password based encryption ##
+    # Header: magic, format version, AES key size in bytes, PBKDF2 iterations, salt, message IV
+    PASSWORD_HEADER = Struct('>4sBBI16s16s')
+    PASSWORD_MAGIC = b'AESP'
+    PASSWORD_VERSION = 1
+    PASSWORD_WORKLOAD = 100000
+    # Refuse headers asking for absurd amounts of key stretching
+    PASSWORD_MAX_WORKLOAD = 10000000
+
+    def _derive_password_keys(self, password, salt, workload, aes_key_size):
+        """ PBKDF2 key material for a password, through derived_key_cache when enabled """
+        def derive():
+            # the derived IV is unused: each message gets a fresh random one
+            aes_key, hmac_key, _ = self._get_key_iv(password, salt, workload, aes_key_size)
+            return aes_key, hmac_key
+        if self.derived_key_cache is None:
+            aes_key, hmac_key = derive()
+            return keycache.DerivedKeys(aes_key, hmac_key, keycache.expand_key(
+                KeyScheduler(), aes_key, {16: 10, 24: 12, 32: 14}[aes_key_size]))
+        return self.derived_key_cache.get(password, salt, workload, aes_key_size, derive)
+
+    def encrypt_with_password(self, plaintext, password, salt=None, workload: int = PASSWORD_WORKLOAD):
+        """ Encrypt with a key stretched from a password (PBKDF2-HMAC-SHA256, see _get_key_iv).
+
+        Output is a self describing header (key size, iteration count, salt, IV), the CBC
+        ciphertext and an HMAC-SHA256 over both (encrypt-then-MAC). A random salt is generated
+        unless one is given; reusing a salt lets derived keys come from derived_key_cache.
+        Every message gets its own random IV, so reusing a salt never reuses an IV.
+        """
+        if isinstance(plaintext, str):
+            plaintext = plaintext.encode('utf-8')
+        elif isinstance(plaintext, int):
+            plaintext = str(plaintext).encode('utf-8')
+        if isinstance(password, str):
+            password = password.encode('utf-8')
+        salt = os.urandom(self.salt_size) if salt is None else salt
+        assert len(salt) == self.salt_size
+        derived = self._derive_password_keys(password, salt, workload, self.aes_key_size)
+        cipher = self.from_round_keys(derived.schedule.round_keys, self.engine_name, derived.schedule.ttable,
+                                      derived.schedule.inverse_round_keys)
+        iv = os.urandom(self.iv_size)
+        header = self.PASSWORD_HEADER.pack(
+            self.PASSWORD_MAGIC, self.PASSWORD_VERSION, self.aes_key_size, workload, salt, iv)
+        body = header + cipher._encrypt_cbc(self._add_padding(plaintext), iv)
+        return body + new_hmac(derived.hmac_key, body, 'sha256').digest()
+
+    def decrypt_with_password(self, data, password) -> bytes:
+        """ Verify and decrypt the output of encrypt_with_password, returning the plaintext bytes.
+        Key size and iteration count come from the header, not from this cipher.
+        Raises ValueError if the data is malformed or the password / HMAC does not match. """
+        if isinstance(password, str):
+            password = password.encode('utf-8')
+        header_size = self.PASSWORD_HEADER.size
+        if len(data) < header_size + self.block_size + self.hmac_size:
+            raise ValueError('Password encrypted data is too short')
+        magic, version, aes_key_size, workload, salt, iv = self.PASSWORD_HEADER.unpack_from(data)
+        if magic != self.PASSWORD_MAGIC or version != self.PASSWORD_VERSION:
+            raise ValueError('Not password encrypted data (unknown header)')
+        if aes_key_size not in (16, 24, 32) or not 0 < workload <= self.PASSWORD_MAX_WORKLOAD:
+            raise ValueError('Invalid key size or iteration count in header')
+        body, mac = data[:-self.hmac_size], data[-self.hmac_size:]
+        derived = self._derive_password_keys(password, salt, workload, aes_key_size)
+        if not compare_digest(new_hmac(derived.hmac_key, body, 'sha256').digest(), mac):
+            raise ValueError('HMAC verification failed (wrong password or corrupted data)')
+        cipher = self.from_round_keys(derived.schedule.round_keys, self.engine_name, derived.schedule.ttable,
+                                      derived.schedule.inverse_round_keys)
+        return self._remove_padding(cipher._decrypt_cbc(body[header_size:], iv))
+    ## Password based encryption ##
+
+    ## CTR mode ##
+    def _ctr_keystream(self, initial_counter: int, num_blocks: int) -> bytes:
+        """ Encrypt num_blocks successive counter blocks starting at initial_counter.
+        The counter is the whole 128 bit block, incremented modulo 2^128 (NIST SP 800-38A) """
+        if self.engine is not None:
+            return self.engine.ctr_keystream(initial_counter, num_blocks)
+        return b''.join(
+            self._encrypt_block(((initial_counter + i) % (1 << 128)).to_bytes(16, 'big'))
+            for i in range(num_blocks)
+        )
+
+    def _ctr_xor(self, data, initial_counter: int) -> bytes:
+        """ XOR data with the keystream for the counter range starting at initial_counter """
+        num_blocks = -(-len(data) // self.block_size)
+        keystream = self._ctr_keystream(initial_counter, num_blocks)[:len(data)]
+        return (int.from_bytes(data, 'big') ^ int.from_bytes(keystream, 'big')).to_bytes(len(data), 'big')
+
+    def _ctr(self, data, initialization_vector, workers, executor, min_segment_size) -> bytes:
+        """ Shared CTR implementation; encryption and decryption are the same operation.
+        Large inputs are split into contiguous counter ranges, one per worker process. """
+        assert len(initialization_vector) == 16
+        initial_counter = int.from_bytes(initialization_vector, 'big')
+        segments = parallel.split_into_segments(
+            len(data), self.block_size, workers, min_segment_size)
+        if len(segments) <= 1:
+            return self._ctr_xor(data, initial_counter)
+        jobs = [
+            (self.round_keys, self.engine_name, (initial_counter + start // self.block_size) % (1 << 128),
+             data[start: end])
+            for start, end in segments
+        ]
+        return b''.join(parallel.map_in_processes(parallel.ctr_segment, jobs, workers, executor))
+
+    def encrypt_ctr(self, plaintext, initialization_vector, workers: int = 1, executor=None,
+                    min_segment_size: int = parallel.MIN_SEGMENT_SIZE):
+        """ Encrypt with AES in counter (CTR) mode. No padding is added.
+        Unlike CBC every block is independent, so with workers > 1 (or workers=None for one per core)
+        the counter space is split into segments that are encrypted in a process pool.
+        An existing ProcessPoolExecutor can be passed as executor to avoid starting a new pool per call. """
+        if isinstance(plaintext, str):
+            plaintext = plaintext.encode('utf-8')
+        elif isinstance(plaintext, int):
+            plaintext = str(plaintext).encode('utf-8')
+        return self._ctr(plaintext, initialization_vector, workers, executor, min_segment_size)
+
+    def decrypt_ctr(self, ciphertext, initialization_vector, workers: int = 1, executor=None,
+                    min_segment_size: int = parallel.MIN_SEGMENT_SIZE):
+        """ Decrypt AES CTR ciphertext. Returns the raw plaintext bytes since CTR is meant for binary blobs. """
+        return self._ctr(ciphertext, initialization_vector, workers, executor, min_segment_size)
+    ## CTR mode ##
+
+    ## GCM mode ##
+    # Blocks encrypted and hashed per batch; each batch is CTR encrypted then GHASHed
+    # while it is still in cache, so the payload is only traversed once.
+    GCM_BATCH_BLOCKS = 4096
+    GCM_TAG_SIZE = 16
+    GCM_MIN_TAG_SIZE = 12
+
+    def _get_ghash(self) -> GHash:
+        """ GHASH tables depend only on H = E(K, 0^128), so build them once per key """
+        if self._ghash is None:
+            self._ghash = GHash(self._encrypt_block(bytes(self.block_size)))
+        return self._ghash
+
+    def _gcm_keystream(self, counter: int, num_blocks: int) -> bytes:
+        """ Keystream for GCM's inc32 counter: only the low 32 bits of the counter block
+        increment, so split the run where they wrap around """
+        before_wrap = min(num_blocks, (1 << 32) - (counter & 0xFFFFFFFF))
+        keystream = self._ctr_keystream(counter, before_wrap)
+        if before_wrap < num_blocks:
+            keystream += self._ctr_keystream(counter & ~0xFFFFFFFF, num_blocks - before_wrap)
+        return keystream
+
+    def _gcm(self, data, initialization_vector, associated_data, encrypting: bool):
+        """ Shared GCM pass: returns the encrypted/decrypted data and the full 16 byte tag """
+        ghash = self._get_ghash()
+        pre_counter = ghash.pre_counter_block(initialization_vector)
+        y = ghash.update(0, associated_data)
+        counter = inc32(pre_counter)
+        batch_size = self.GCM_BATCH_BLOCKS * self.block_size
+        out = []
+        for start in range(0, len(data), batch_size):
+            chunk = data[start: start + batch_size]
+            if not encrypting:
+                y = ghash.update(y, chunk)
+            num_blocks = -(-len(chunk) // self.block_size)
+            keystream = self._gcm_keystream(counter, num_blocks)[:len(chunk)]
+            processed = (int.from_bytes(chunk, 'big') ^ int.from_bytes(keystream, 'big')).to_bytes(len(chunk), 'big')
+            if encrypting:
+                y = ghash.update(y, processed)
+            counter = (counter & ~0xFFFFFFFF) | ((counter + num_blocks) & 0xFFFFFFFF)
+            out.append(processed)
+        y = ghash.finish(y, len(associated_data), len(data))
+        tag = y ^ int.from_bytes(self._encrypt_block(pre_counter.to_bytes(16, 'big')), 'big')
+        return b''.join(out), tag.to_bytes(16, 'big')
+
+    def encrypt_gcm(self, plaintext, initialization_vector, associated_data=b'', tag_size: int = GCM_TAG_SIZE):
+        """ Authenticated encryption with AES-GCM. The initialization vector should be unique per
+        message under a key (12 bytes recommended). associated_data is authenticated but not encrypted.
+        Returns the ciphertext followed by the authentication tag (16 bytes, or tag_size from 12 to 16). """
+        if isinstance(plaintext, str):
+            plaintext = plaintext.encode('utf-8')
+        elif isinstance(plaintext, int):
+            plaintext = str(plaintext).encode('utf-8')
+        self._check_gcm_parameters(initialization_vector, tag_size)
+        ciphertext, tag = self._gcm(plaintext, initialization_vector, associated_data, encrypting=True)
+        return ciphertext + tag[:tag_size]
+
+    def decrypt_gcm(self, ciphertext, initialization_vector, associated_data=b'', tag_size: int = GCM_TAG_SIZE):
+        """ Verify and decrypt the output of encrypt_gcm (made with the same tag_size), returning
+        the plaintext bytes. Raises ValueError if the ciphertext, tag or associated data were
+        tampered with, or if the IV or tag size could not have come from encrypt_gcm. """
+        self._check_gcm_parameters(initialization_vector, tag_size)
+        if len(ciphertext) < tag_size:
+            raise ValueError('GCM ciphertext is shorter than the authentication tag')
+        ciphertext, received_tag = ciphertext[:-tag_size], ciphertext[-tag_size:]
+        plaintext, tag = self._gcm(ciphertext, initialization_vector, associated_data, encrypting=False)
+        if not compare_digest(tag[:tag_size], received_tag):
+            raise ValueError('GCM authentication failed')
+        return plaintext
+
+    def _check_gcm_parameters(self, initialization_vector, tag_size: int):
+        """ Any non-empty IV works (12 bytes directly, other lengths through GHASH); tags may be
+        truncated to no fewer than 12 bytes """
+        if len(initialization_vector) == 0:
+            raise ValueError('GCM initialization vector must not be empty')
+        if not self.GCM_MIN_TAG_SIZE <= tag_size <= self.GCM_TAG_SIZE:
+            raise ValueError(f'GCM tag size must be between {self.GCM_MIN_TAG_SIZE} and {self.GCM_TAG_SIZE} bytes')
+    ## GCM mode ##
+
+    ## Profiling ##
+    def enable_profiling(self, profiler=None):
+        """ Start recording per-stage timings and message counters for this instance
+        (see profiling.py); returns the Profiler, which can be shared between ciphers """
+        if self.profiler is not None:
+            self.disable_profiling()
+        profiler = profiler if profiler is not None else profiling.Profiler()
+        profiler.instrument(self)
+        return profiler
+
+    def disable_profiling(self):
+        """ Remove the profiling wrappers; the instance runs uninstrumented again """
+        profiling.Profiler.uninstrument(self)
+    ## Profiling ##
@@ -0,0 +1,200 @@
+"""
+asyncio adapter: encrypt or decrypt everything read from an asyncio.StreamReader
+into an asyncio.StreamWriter without blocking the event loop.
+
+The input is read in block aligned chunks and the crypto work for each chunk is
+handed to an executor (the loop's default thread pool unless one is given). With
+a ProcessPoolExecutor the workers get the expanded round keys and rebuild the
+cipher (see parallel.py), so the event loop thread only does I/O.
+
+Backpressure comes from two bounds: at most max_in_flight chunks are submitted
+but not yet written, and every write is followed by `await writer.drain()`, so a
+slow consumer stops the reader instead of letting output pile up in memory.
+
+CTR chunks and CBC decryption chunks are independent of each other and run
+concurrently; CBC encryption chains each chunk on the previous chunk's last
+ciphertext block, so those chunks run one after another (reading still runs ahead).
+Output is identical to AES.encrypt / decrypt_bytes (CBC) and encrypt_ctr (CTR).
+"""
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import parallel
+from streaming import DEFAULT_CHUNK_SIZE
+
+MODES = ('cbc', 'ctr')
+DEFAULT_MAX_IN_FLIGHT = 4
+
+
+class StreamStats:
+    """ Byte counters and throughput for one stream """
+
+    def __init__(self):
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.chunks = 0
+        self.started = time.perf_counter()
+        self.finished = None
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.perf_counter()) - self.started
+
+    @property
+    def bytes_per_second(self) -> float:
+        """ Input bytes processed per second so far (or over the whole stream once finished) """
+        elapsed = self.elapsed
+        return self.bytes_in / elapsed if elapsed > 0 else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'chunks': self.chunks,
+            'elapsed_s': self.elapsed,
+            'bytes_per_s': self.bytes_per_second,
+        }
+
+
+async def _read_chunk(reader: asyncio.StreamReader, size: int) -> bytes:
+    """ Read exactly size bytes, or whatever is left before EOF """
+    try:
+        return await reader.readexactly(size)
+    except asyncio.IncompleteReadError as e:
+        return e.partial
+
+
+class AsyncStreamCipher:
+    """ Streams data through an AES cipher in CBC or CTR mode on an executor.
+    One instance can serve any number of streams; each call returns its own StreamStats. """
+
+    def __init__(self, cipher, mode: str = 'cbc', executor=None,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT):
+        if mode not in MODES:
+            raise ValueError(f'Unknown stream mode {mode!r}; expected one of {MODES}')
+        if max_in_flight < 1:
+            raise ValueError('max_in_flight must be at least 1')
+        self.cipher = cipher
+        self.mode = mode
+        self.executor = executor
+        # Chunks are kept block aligned so every chunk but the last is whole blocks
+        self.chunk_size = max(cipher.block_size, chunk_size - chunk_size % cipher.block_size)
+        self.max_in_flight = max_in_flight
+        # Process workers cannot share the cipher object; they get the round keys instead
+        self._in_processes = isinstance(executor, ProcessPoolExecutor)
+
+    ## Per chunk work, run on the executor ##
+    def _offload(self, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def _ctr_job(self, data, initial_counter: int):
+        if self._in_processes:
+            cipher = self.cipher
+            return self._offload(parallel.ctr_segment, cipher.round_keys, cipher.engine_name, initial_counter, data)
+        return self._offload(self.cipher._ctr_xor, data, initial_counter)
+
+    async def _cbc_encrypt_job(self, previous_job, initialization_vector, data, last: bool) -> bytes:
+        """ Wait for the previous chunk's ciphertext, then encrypt this chunk chained on it """
+        cipher = self.cipher
+        previous = initialization_vector if previous_job is None else (await previous_job)[-cipher.block_size:]
+        if last:
+            data = cipher._add_padding(data)
+        if self._in_processes:
+            return await self._offload(
+                parallel.cbc_encrypt_segment, cipher.round_keys, cipher.engine_name, previous, data)
+        return await self._offload(cipher._encrypt_cbc, data, previous)
+
+    async def _cbc_decrypt_job(self, previous, data, last: bool) -> bytes:
+        cipher = self.cipher
+        if self._in_processes:
+            decrypted = await self._offload(
+                parallel.cbc_decrypt_segment, cipher.round_keys, cipher.engine_name, previous, data)
+        else:
+            decrypted = await self._offload(cipher._decrypt_cbc, data, previous)
+        return cipher._remove_padding(decrypted) if last else decrypted
+
+    ## Pipeline ##
+    async def _pump(self, reader, writer, submit) -> StreamStats:
+        """ Read chunks (one ahead, so the last chunk is known), submit(chunk, offset, last)
+        each one and write the results in order, keeping at most max_in_flight outstanding """
+        stats = StreamStats()
+        pending = deque()
+
+        async def write_oldest():
+            out = await pending.popleft()
+            writer.write(out)
+            await writer.drain()
+            stats.bytes_out += len(out)
+
+        try:
+            offset = 0
+            chunk = await _read_chunk(reader, self.chunk_size)
+            while True:
+                following = await _read_chunk(reader, self.chunk_size) if len(chunk) == self.chunk_size else b''
+                last = not following
+                pending.append(asyncio.ensure_future(submit(chunk, offset, last)))
+                stats.bytes_in += len(chunk)
+                stats.chunks += 1
+                offset += len(chunk)
+                while len(pending) >= self.max_in_flight:
+                    await write_oldest()
+                if last:
+                    break
+                chunk = following
+            while pending:
+                await write_oldest()
+        finally:
+            for job in pending:
+                job.cancel()
+            stats.finished = time.perf_counter()
+        return stats
+
+    async def encrypt(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                      initialization_vector) -> StreamStats:
+        """ Encrypt everything until EOF on reader into writer (the IV is not written) """
+        assert len(initialization_vector) == self.cipher.block_size
+        if self.mode == 'ctr':
+            return await self._pump(reader, writer, self._ctr_submitter(initialization_vector))
+        chain = [None]
+
+        def submit(chunk, offset, last):
+            chain[0] = asyncio.ensure_future(self._cbc_encrypt_job(chain[0], initialization_vector, chunk, last))
+            return chain[0]
+        return await self._pump(reader, writer, submit)
+
+    async def decrypt(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                      initialization_vector) -> StreamStats:
+        """ Decrypt everything until EOF on reader into writer; CBC padding is removed """
+        assert len(initialization_vector) == self.cipher.block_size
+        if self.mode == 'ctr':
+            return await self._pump(reader, writer, self._ctr_submitter(initialization_vector))
+        block_size = self.cipher.block_size
+        previous = [bytes(initialization_vector)]
+
+        def submit(chunk, offset, last):
+            if not chunk or len(chunk) % block_size:
+                raise ValueError('Ciphertext length is not a positive multiple of the block size')
+            # CBC decryption only needs the previous ciphertext block, which is already known
+            job = self._cbc_decrypt_job(previous[0], chunk, last)
+            previous[0] = chunk[-block_size:]
+            return job
+        return await self._pump(reader, writer, submit)
+
+    def _ctr_submitter(self, initialization_vector):
+        initial_counter = int.from_bytes(initialization_vector, 'big')
+        block_size = self.cipher.block_size
+
+        def submit(chunk, offset, last):
+            return self._ctr_job(chunk, (initial_counter + offset // block_size) % (1 << 128))
+        return submit
+
+
+async def encrypt_stream(cipher, reader, writer, initialization_vector, mode: str = 'cbc', **kwargs) -> StreamStats:
+    """ Shortcut for AsyncStreamCipher(cipher, mode, **kwargs).encrypt(reader, writer, iv) """
+    return await AsyncStreamCipher(cipher, mode, **kwargs).encrypt(reader, writer, initialization_vector)
+
+
+async def decrypt_stream(cipher, reader, writer, initialization_vector, mode: str = 'cbc', **kwargs) -> StreamStats:
+    """ Shortcut for AsyncStreamCipher(cipher, mode, **kwargs).decrypt(reader, writer, iv) """
+    return await AsyncStreamCipher(cipher, mode, **kwargs).decrypt(reader, writer, initialization_vector)
@@ -0,0 +1,273 @@
+"""
+AESAVS (AES Algorithm Validation Suite, see AESAVS.pdf) runner.
+
+Known Answer Tests (section 6.2, appendices B - E):
+    GFSbox   testing/aesavstestdata.csv (zero key, varying plaintext)
+    KeySbox  testing/aesavs_kat.csv    (varying key, zero plaintext)
+    VarTxt   testing/aesavs_kat.csv    (zero key, plaintext with 1..128 leading one bits)
+    VarKey   testing/aesavs_kat.csv    (zero plaintext, key with 1..keysize leading one bits)
+Every vector is checked in both directions.
+
+Monte Carlo Tests (section 6.4.1 ECB and 6.4.2 CBC), encryption and decryption,
+for every key size: OUTER pseudorandom texts of INNER chained block operations
+each, with the key updated from the last ciphertexts after every text. The first
+three AES-128 encryption outputs published in AESAVS are checked exactly; every
+other MCT run must produce the same output for every engine being tested.
+MCT is the heaviest realistic load on _encrypt_block / decrypt_block, which makes
+it the correctness gate for any new engine.
+
+Jobs (suite x engine x key size) run in a process pool. Suites share the pool,
+so each suite reports the CPU time of its jobs and the wall time is reported
+once for the whole run.
+
+Usage (from this directory):
+
+    python avs.py                                   # everything, every available engine
+    python avs.py --suite GFSbox KeySbox --engine ttable
+    python avs.py --suite MCT-ECB MCT-CBC --outer 1000 --workers 4
+"""
+import argparse
+import csv
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from hashlib import sha256
+from aescipher import AES
+import numpy_engine
+
+TEST_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testing')
+KAT_SUITES = ('GFSbox', 'KeySbox', 'VarTxt', 'VarKey')
+MCT_SUITES = ('MCT-ECB', 'MCT-CBC')
+SUITES = KAT_SUITES + MCT_SUITES
+KEY_SIZES = (128, 192, 256)
+# AESAVS section 6.4: 100 pseudorandom texts of 1000 iterations each
+MCT_OUTER = 100
+MCT_INNER = 1000
+
+# Initial values for the Monte Carlo tests. The AES-128 values are the sample REQUEST
+# values from AESAVS sections 6.4.1 / 6.4.2; the others are arbitrary fixed values.
+MCT_SEEDS = {
+    'MCT-ECB': {
+        128: ('8d2e60365f17c7df1040d7501b4a7b5a', None, '59b5088e6dadc3ad5f27a460872d5929'),
+        192: ('e9f065d7c13573587f7875357dfbb16c53489f6a4bd0f7cd', None, '59b5088e6dadc3ad5f27a460872d5929'),
+        256: ('c47b0294dbbbee0fec4757f22ffeee3587ca4730c3d33b691df38bab076bc558', None,
+              '59b5088e6dadc3ad5f27a460872d5929'),
+    },
+    'MCT-CBC': {
+        128: ('9dc2c84a37850c11699818605f47958c', '256953b2feab2a04ae0180d8335bbed6',
+              '2e586692e647f5028ec6fa47a55a2aab'),
+        192: ('e9f065d7c13573587f7875357dfbb16c53489f6a4bd0f7cd', '256953b2feab2a04ae0180d8335bbed6',
+              '2e586692e647f5028ec6fa47a55a2aab'),
+        256: ('c47b0294dbbbee0fec4757f22ffeee3587ca4730c3d33b691df38bab076bc558',
+              '256953b2feab2a04ae0180d8335bbed6', '2e586692e647f5028ec6fa47a55a2aab'),
+    },
+}
+
+# First three (key, iv, plaintext, ciphertext) RESPONSE records published for AES-128 encryption
+MCT_KNOWN_ANSWERS = {
+    'MCT-ECB': [
+        ('8d2e60365f17c7df1040d7501b4a7b5a', None,
+         '59b5088e6dadc3ad5f27a460872d5929', 'a02600ecb8ea77625bba6641ed5f5920'),
+        ('2d0860dae7fdb0bd4bfab111f615227a', None,
+         'a02600ecb8ea77625bba6641ed5f5920', '5241ead9a89ca31a7147f53a5bf6d96a'),
+        ('7f498a034f6113a73abd442bade3fb10', None,
+         '5241ead9a89ca31a7147f53a5bf6d96a', '22f09171bc67d0661d1c25f181a69f33'),
+    ],
+    'MCT-CBC': [
+        ('9dc2c84a37850c11699818605f47958c', '256953b2feab2a04ae0180d8335bbed6',
+         '2e586692e647f5028ec6fa47a55a2aab', '1b1ebd1fc45ec43037fd4844241a437f'),
+        ('86dc7555f3dbc8215e6550247b5dd6f3', '1b1ebd1fc45ec43037fd4844241a437f',
+         'c1b77ed52521525f0a4ba341bdaf51d9', 'bf43583a665fa45fdee831243a16ea8f'),
+        ('399f2d6f95846c7e808d6100414b3c7c', 'bf43583a665fa45fdee831243a16ea8f',
+         '7cbeea19157ec7bbf6289e2dff5e8ee4', '5464e1900f81e06f67139456da25fc09'),
+    ],
+}
+
+
+def available_engines() -> list:
+    return [e for e in AES.ENGINES if e != 'numpy' or numpy_engine.np is not None]
+
+
+## Known Answer Tests ##
+def load_kat_vectors() -> dict:
+    """ {suite: [(keysize, key, plaintext, ciphertext), ...]} with the values as bytes """
+    vectors = {suite: [] for suite in KAT_SUITES}
+    with open(os.path.join(TEST_DATA_DIR, 'aesavstestdata.csv')) as f:
+        reader = csv.reader(f)
+        next(reader)
+        for keysize, plaintext, ciphertext in reader:
+            vectors['GFSbox'].append((int(keysize), bytes(int(keysize) // 8),
+                                      bytes.fromhex(plaintext), bytes.fromhex(ciphertext)))
+    with open(os.path.join(TEST_DATA_DIR, 'aesavs_kat.csv')) as f:
+        reader = csv.reader(f)
+        next(reader)
+        for suite, keysize, key, plaintext, ciphertext in reader:
+            vectors[suite].append((int(keysize), bytes.fromhex(key),
+                                   bytes.fromhex(plaintext), bytes.fromhex(ciphertext)))
+    return vectors
+
+
+def run_kat(engine: str, vectors) -> list:
+    """ Check every vector in both directions; returns a description of each failure """
+    failures = []
+    for keysize, key, plaintext, ciphertext in vectors:
+        cipher = AES(aes_key_size_bits=keysize, master_key=key, engine=engine)
+        if cipher._encrypt_block(plaintext) != ciphertext:
+            failures.append(f'encrypt key={key.hex()} plaintext={plaintext.hex()}')
+        if cipher.decrypt_block(ciphertext) != plaintext:
+            failures.append(f'decrypt key={key.hex()} ciphertext={ciphertext.hex()}')
+    return failures
+
+
+## Monte Carlo Tests ##
+def _next_key(key: bytes, last: bytes, before_last: bytes) -> bytes:
+    """ Key[i+1] = Key[i] xor the trailing key-length bits of (before_last || last) """
+    material = (before_last + last)[-len(key):]
+    return bytes(k ^ m for k, m in zip(key, material))
+
+
+def mct_ecb(engine: str, key: bytes, text: bytes, encrypt: bool = True,
+            outer: int = MCT_OUTER, inner: int = MCT_INNER) -> list:
+    """ AESAVS 6.4.1; returns (key, None, input, output) for every outer iteration.
+    For decryption text is a ciphertext and the outputs are plaintexts. """
+    records = []
+    for _ in range(outer):
+        cipher = AES(aes_key_size_bits=8 * len(key), master_key=key, engine=engine)
+        block = cipher._encrypt_block if encrypt else cipher.decrypt_block
+        first = before_last = text
+        for _ in range(inner):
+            before_last, text = text, block(text)
+        records.append((key, None, first, text))
+        key = _next_key(key, text, before_last)
+    return records
+
+
+def mct_cbc(engine: str, key: bytes, iv: bytes, text: bytes, encrypt: bool = True,
+            outer: int = MCT_OUTER, inner: int = MCT_INNER) -> list:
+    """ AESAVS 6.4.2; returns (key, iv, input, output) for every outer iteration.
+    Encryption: CT[j] = E(PT[j] xor CT[j-1]) (IV for j = 0), PT[j+1] = CT[j-1] (IV for j = 0).
+    Decryption swaps the roles of plaintext and ciphertext. """
+    records = []
+    for _ in range(outer):
+        cipher = AES(aes_key_size_bits=8 * len(key), master_key=key, engine=engine)
+        first, chain = text, iv
+        outputs = [iv]
+        for _ in range(inner):
+            if encrypt:
+                output = cipher._encrypt_block(bytes(a ^ b for a, b in zip(text, chain)))
+                chain = output
+            else:
+                output = bytes(a ^ b for a, b in zip(cipher.decrypt_block(text), chain))
+                chain = text
+            # the next input is the previous output (the IV after the first block)
+            text = outputs[-1]
+            outputs.append(output)
+        records.append((key, iv, first, outputs[-1]))
+        key = _next_key(key, outputs[-1], outputs[-2])
+        iv, text = outputs[-1], outputs[-2]
+    return records
+
+
+def run_mct(suite: str, engine: str, keysize: int, encrypt: bool,
+            outer: int = MCT_OUTER, inner: int = MCT_INNER) -> list:
+    key, iv, text = (None if v is None else bytes.fromhex(v) for v in MCT_SEEDS[suite][keysize])
+    if suite == 'MCT-ECB':
+        return mct_ecb(engine, key, text, encrypt, outer, inner)
+    return mct_cbc(engine, key, iv, text, encrypt, outer, inner)
+
+
+def check_mct_known_answers(suite: str, records) -> list:
+    """ Compare the leading records of an AES-128 encryption run with the published ones """
+    failures = []
+    for i, (record, expected) in enumerate(zip(records, MCT_KNOWN_ANSWERS[suite])):
+        actual = tuple(None if v is None else v.hex() for v in record)
+        if actual != expected:
+            failures.append(f'record {i}: {actual} != {expected}')
+    return failures
+
+
+## Runner ##
+def run_job(suite: str, engine: str, keysize: int, outer: int, inner: int, vectors=None) -> dict:
+    """ Run one suite for one engine and key size (a process pool job) """
+    start = time.perf_counter()
+    result = {'suite': suite, 'engine': engine, 'keysize': keysize, 'failures': [], 'digest': None}
+    if suite in KAT_SUITES:
+        result['failures'] = run_kat(engine, vectors)
+        result['count'] = len(vectors)
+    else:
+        digest = sha256()
+        for encrypt in (True, False):
+            records = run_mct(suite, engine, keysize, encrypt, outer, inner)
+            if encrypt and keysize == 128 and inner == MCT_INNER:
+                result['failures'] += check_mct_known_answers(suite, records)
+            for record in records:
+                digest.update(b''.join(v for v in record if v is not None))
+        result['digest'] = digest.hexdigest()
+        result['count'] = 2 * outer * inner
+    result['elapsed_s'] = time.perf_counter() - start
+    return result
+
+
+def run(suites, engines, key_sizes=KEY_SIZES, outer: int = MCT_OUTER, inner: int = MCT_INNER,
+        workers=None) -> dict:
+    """ Run every (suite, engine, key size) job in a process pool.
+    Returns {suite: {'cpu_s', 'operations', 'failures'}}; cpu_s is the summed time of the
+    suite's jobs (they run concurrently with other suites' jobs, so there is no per-suite wall time) """
+    kat_vectors = load_kat_vectors()
+    jobs = []
+    for suite in suites:
+        for engine in engines:
+            for keysize in key_sizes:
+                vectors = [v for v in kat_vectors[suite] if v[0] == keysize] if suite in KAT_SUITES else None
+                jobs.append((suite, engine, keysize, outer, inner, vectors))
+
+    report = {suite: {'cpu_s': 0.0, 'operations': 0, 'failures': []} for suite in suites}
+    digests = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for future in as_completed([pool.submit(run_job, *job) for job in jobs]):
+            result = future.result()
+            summary = report[result['suite']]
+            summary['cpu_s'] += result['elapsed_s']
+            summary['operations'] += result['count']
+            summary['failures'] += [f"{result['engine']}/{result['keysize']}: {f}" for f in result['failures']]
+            if result['digest'] is not None:
+                digests.setdefault((result['suite'], result['keysize']), {})[result['engine']] = result['digest']
+
+    # Monte Carlo outputs must not depend on the engine
+    for (suite, keysize), by_engine in digests.items():
+        if len(set(by_engine.values())) > 1:
+            report[suite]['failures'].append(f'{keysize}: engines disagree {by_engine}')
+    return report
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Run the AESAVS known answer and Monte Carlo tests')
+    parser.add_argument('--suite', nargs='+', choices=SUITES, default=list(SUITES))
+    parser.add_argument('--engine', nargs='+', choices=AES.ENGINES, default=None,
+                        help='engines to test (default: every available engine)')
+    parser.add_argument('--key-size', nargs='+', type=int, choices=KEY_SIZES, default=list(KEY_SIZES))
+    parser.add_argument('--outer', type=int, default=MCT_OUTER, help='Monte Carlo texts (default: %(default)s)')
+    parser.add_argument('--inner', type=int, default=MCT_INNER,
+                        help='Monte Carlo iterations per text (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per core)')
+    args = parser.parse_args(argv)
+
+    engines = args.engine or available_engines()
+    start = time.perf_counter()
+    report = run(args.suite, engines, args.key_size, args.outer, args.inner, args.workers)
+    wall = time.perf_counter() - start
+    failed = 0
+    print(f'{"suite":<10}{"operations":>12}{"cpu s":>10}  result')
+    for suite, summary in report.items():
+        status = 'ok' if not summary['failures'] else f'{len(summary["failures"])} FAILED'
+        print(f'{suite:<10}{summary["operations"]:>12}{summary["cpu_s"]:>10.2f}  {status}')
+        for failure in summary['failures']:
+            print(f'    {failure}')
+        failed += len(summary['failures'])
+    print(f'wall time {wall:.2f} s for all suites')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,175 @@
+"""
+Bulk CBC encryption / decryption of many short, independent messages.
+
+Encrypting thousands of short messages one AES.encrypt call at a time pays the
+per call overhead (padding, block splitting, engine dispatch and a join) for
+every message. Here every message of a batch is padded into one contiguous
+buffer and the output is written into one preallocated buffer, so each message
+costs little more than its block operations.
+
+With the numpy engine the messages are also interleaved: CBC encryption is
+serial within a message but messages are independent, so step j encrypts the
+j-th block of every message that has one in a single vectorized call. CBC
+decryption has no chaining dependency at all, so every block of every message is
+decrypted in one batch before the per message chaining xor. Other engines walk
+the packed buffer message by message with the engine's *_cbc_into helpers.
+
+encrypt_multi_key / decrypt_multi_key cover the opposite shape: a few blocks
+under each of many keys (per record data keys). With numpy all N key schedules
+are expanded together (numpy_engine.expand_keys) and every block of every
+record goes through the rounds in one pass, each with its own key's schedule.
+Without numpy each key is expanded and run on its own T-table engine.
+"""
+from numpy_engine import np, NumpyBatchEngine, BATCH_BLOCKS, NUM_ROUNDS
+import numpy_engine
+from keycache import expand_key
+from scheduler import KeyScheduler
+from util import add_padding, remove_padding
+
+BLOCK_SIZE = 16
+
+
+def _as_bytes(message) -> bytes:
+    """ Same conversions AES.encrypt applies to its plaintext """
+    if isinstance(message, str):
+        return message.encode('utf-8')
+    if isinstance(message, int):
+        return str(message).encode('utf-8')
+    return message
+
+
+def _pack(messages):
+    """ Concatenate messages (each already a whole number of blocks) into one buffer,
+    returning it with each message's (start, end) byte range """
+    ranges = []
+    position = 0
+    for message in messages:
+        ranges.append((position, position + len(message)))
+        position += len(message)
+    return b''.join(messages), ranges
+
+
+def _check_ivs(initialization_vectors):
+    for iv in initialization_vectors:
+        assert len(iv) == BLOCK_SIZE
+
+
+def _encrypt_interleaved(engine, packed, out, ranges, initialization_vectors):
+    """ CBC encrypt every message in lockstep, one vectorized call per block position """
+    blocks = np.frombuffer(packed, dtype=np.uint8).reshape(-1, BLOCK_SIZE)
+    destination = np.frombuffer(out, dtype=np.uint8).reshape(-1, BLOCK_SIZE)
+    first_blocks = np.array([start // BLOCK_SIZE for start, _ in ranges], dtype=np.intp)
+    counts = np.array([(end - start) // BLOCK_SIZE for start, end in ranges], dtype=np.intp)
+    # Longest messages first, so the messages still going at step j are always a prefix
+    order = np.argsort(-counts, kind='stable')
+    first_blocks, counts = first_blocks[order], counts[order]
+    ivs = np.frombuffer(b''.join(bytes(initialization_vectors[i]) for i in order),
+                        dtype=np.uint8).reshape(-1, BLOCK_SIZE)
+    # Groups of at most BATCH_BLOCKS messages bound the size of the temporaries
+    for group in range(0, len(order), BATCH_BLOCKS):
+        group_first = first_blocks[group: group + BATCH_BLOCKS]
+        group_counts = counts[group: group + BATCH_BLOCKS]
+        previous = ivs[group: group + BATCH_BLOCKS]
+        active = len(group_first)
+        for j in range(int(group_counts[0]) if active else 0):
+            while group_counts[active - 1] <= j:
+                active -= 1
+            index = group_first[:active] + j
+            previous = engine.encrypt_blocks(blocks[index] ^ previous[:active])
+            destination[index] = previous
+
+
+def _decrypt_batched(engine, packed, out, ranges, initialization_vectors):
+    """ Decrypt every block of every message at once, then xor each with the previous
+    ciphertext block of its own message (or its IV for the first block) """
+    blocks = np.frombuffer(packed, dtype=np.uint8).reshape(-1, BLOCK_SIZE)
+    destination = np.frombuffer(out, dtype=np.uint8).reshape(-1, BLOCK_SIZE)
+    chain = np.empty_like(blocks)
+    chain[1:] = blocks[:-1]
+    first_blocks = [start // BLOCK_SIZE for start, _ in ranges]
+    chain[first_blocks] = np.frombuffer(b''.join(bytes(iv) for iv in initialization_vectors),
+                                        dtype=np.uint8).reshape(-1, BLOCK_SIZE)
+    for i in range(0, len(blocks), BATCH_BLOCKS):
+        np.bitwise_xor(engine.decrypt_blocks(blocks[i: i + BATCH_BLOCKS]), chain[i: i + BATCH_BLOCKS],
+                       out=destination[i: i + BATCH_BLOCKS])
+
+
+def encrypt_many(cipher, pairs) -> list:
+    """ CBC encrypt every (message, iv) pair; returns the ciphertexts in order,
+    each identical to cipher.encrypt(message, iv) """
+    if not pairs:
+        return []
+    messages, initialization_vectors = zip(*pairs)
+    _check_ivs(initialization_vectors)
+    packed, ranges = _pack([add_padding(_as_bytes(m), BLOCK_SIZE) for m in messages])
+    out = bytearray(len(packed))
+    if isinstance(cipher.engine, NumpyBatchEngine):
+        _encrypt_interleaved(cipher.engine, packed, out, ranges, initialization_vectors)
+    else:
+        source, destination = memoryview(packed), memoryview(out)
+        for (start, end), iv in zip(ranges, initialization_vectors):
+            cipher._encrypt_cbc_into(source[start: end], destination[start: end], iv)
+    return [bytes(out[start: end]) for start, end in ranges]
+
+
+def decrypt_many(cipher, pairs) -> list:
+    """ CBC decrypt every (ciphertext, iv) pair; returns the plaintext bytes in order,
+    each identical to cipher.decrypt_bytes(ciphertext, iv) """
+    if not pairs:
+        return []
+    ciphertexts, initialization_vectors = zip(*pairs)
+    _check_ivs(initialization_vectors)
+    for ciphertext in ciphertexts:
+        if not ciphertext or len(ciphertext) % BLOCK_SIZE:
+            raise ValueError('Ciphertext length is not a positive multiple of the block size')
+    packed, ranges = _pack([bytes(c) for c in ciphertexts])
+    out = bytearray(len(packed))
+    if isinstance(cipher.engine, NumpyBatchEngine):
+        _decrypt_batched(cipher.engine, packed, out, ranges, initialization_vectors)
+    else:
+        source, destination = memoryview(packed), memoryview(out)
+        for (start, end), iv in zip(ranges, initialization_vectors):
+            cipher._decrypt_cbc_into(source[start: end], destination[start: end], iv)
+    return [remove_padding(bytes(out[start: end])) for start, end in ranges]
+
+
+def _multi_key(keys, block_sets, encrypting: bool) -> list:
+    keys = [bytes(k) for k in keys]
+    block_sets = [bytes(b) for b in block_sets]
+    if len(keys) != len(block_sets):
+        raise ValueError('Need exactly one block set per key')
+    for key, blocks in zip(keys, block_sets):
+        if len(key) not in NUM_ROUNDS:
+            raise ValueError(f'Keys must be 16, 24 or 32 bytes, got {len(key)}')
+        if len(blocks) % BLOCK_SIZE:
+            raise ValueError('Block sets must be a whole number of 16 byte blocks')
+    out = [b''] * len(keys)
+    if np is None:
+        key_scheduler = KeyScheduler()
+        for i, (key, blocks) in enumerate(zip(keys, block_sets)):
+            engine = expand_key(key_scheduler, key, NUM_ROUNDS[len(key)]).ttable
+            transform = engine.encrypt_block if encrypting else engine.decrypt_block
+            out[i] = b''.join(transform(blocks[j: j + BLOCK_SIZE]) for j in range(0, len(blocks), BLOCK_SIZE))
+        return out
+    transform = numpy_engine.encrypt_blocks_multi_key if encrypting else numpy_engine.decrypt_blocks_multi_key
+    # one lockstep expansion per key length
+    for key_length in sorted({len(k) for k in keys}):
+        indices = [i for i, k in enumerate(keys) if len(k) == key_length]
+        round_keys = numpy_engine.expand_keys([keys[i] for i in indices])
+        packed, ranges = _pack([block_sets[i] for i in indices])
+        counts = np.array([(end - start) // BLOCK_SIZE for start, end in ranges], dtype=np.intp)
+        result = transform(round_keys, np.frombuffer(packed, dtype=np.uint8).reshape(-1, BLOCK_SIZE), counts).tobytes()
+        for i, (start, end) in zip(indices, ranges):
+            out[i] = result[start: end]
+    return out
+
+
+def encrypt_multi_key(keys, block_sets) -> list:
+    """ Encrypt block_sets[i] (whole blocks, each independently, as ECB) under keys[i] for every i;
+    returns the ciphertexts in order. Keys may mix 128, 192 and 256 bit lengths. """
+    return _multi_key(keys, block_sets, encrypting=True)
+
+
+def decrypt_multi_key(keys, block_sets) -> list:
+    """ Inverse of encrypt_multi_key """
+    return _multi_key(keys, block_sets, encrypting=False)
@@ -0,0 +1,380 @@
+"""
+Benchmark harness for the AES implementation.
+
+Measures single block encryption / decryption, key expansion and full message
+encrypt / decrypt across engines, key sizes and payload sizes, reporting
+blocks/sec, MB/s, latency percentiles and peak traced memory as JSON.
+Each run can be compared against a stored baseline so regressions are caught
+before deploying.
+
+Usage (from this directory):
+
+    python benchmark.py                                   # quick run, compare to benchmarks/baseline.json
+    python benchmark.py --sizes 16 1K 1M 64M --engine ttable numpy
+    python benchmark.py --output results.json
+    python benchmark.py --save-baseline                   # overwrite the stored baseline
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from aescipher import AES
+from context import AESContext
+from scheduler import KeyScheduler
+import numpy_engine
+from util import parse_size
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks', 'baseline.json')
+KEY_SIZES = (128, 192, 256)
+DEFAULT_SIZES = ('16', '1K', '64K')
+# Throughput may drop this much (as a fraction of the baseline) before it counts as a regression
+DEFAULT_TOLERANCE = 0.25
+# Every benchmark repeats until it has run at least this long (and at least MIN_REPEATS times)
+MIN_SECONDS = 0.2
+MIN_REPEATS = 5
+
+
+def available_engines() -> list:
+    return [e for e in AES.ENGINES if e != 'numpy' or numpy_engine.np is not None]
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    """ Nearest-rank percentile of an already sorted list """
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def measure(fn, min_seconds: float = MIN_SECONDS, min_repeats: int = MIN_REPEATS) -> dict:
+    """ Time fn() repeatedly; return latency percentiles (seconds) plus peak traced memory
+    from one extra, separately traced call (tracing slows calls down, so it is not timed) """
+    timings = []
+    start = time.perf_counter()
+    while len(timings) < min_repeats or time.perf_counter() - start < min_seconds:
+        before = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - before)
+    timings.sort()
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'repeats': len(timings),
+        'mean_s': sum(timings) / len(timings),
+        'p50_s': percentile(timings, 0.50),
+        'p90_s': percentile(timings, 0.90),
+        'p99_s': percentile(timings, 0.99),
+        'peak_memory_bytes': peak,
+    }
+
+
+def with_throughput(stats: dict, num_bytes: int) -> dict:
+    """ Add blocks/sec and MB/s (based on the median latency) to a measurement """
+    stats['bytes'] = num_bytes
+    stats['blocks_per_s'] = (num_bytes / 16) / stats['p50_s']
+    stats['mb_per_s'] = (num_bytes / (1024 * 1024)) / stats['p50_s']
+    return stats
+
+
+## Suites ##
+def bench_blocks(engines, key_sizes, sizes) -> dict:
+    """ Single block _encrypt_block / decrypt_block """
+    results = {}
+    block = os.urandom(16)
+    for engine in engines:
+        for bits in key_sizes:
+            cipher = AES(aes_key_size_bits=bits, engine=engine)
+            results[f'encrypt_block/{engine}/{bits}'] = with_throughput(
+                measure(lambda: cipher._encrypt_block(block)), 16)
+            results[f'decrypt_block/{engine}/{bits}'] = with_throughput(
+                measure(lambda: cipher.decrypt_block(block)), 16)
+    return results
+
+
+def bench_key_expansion(engines, key_sizes, sizes) -> dict:
+    """ Uncached KeyScheduler.get_key_expansion, and AES construction through the schedule cache """
+    results = {}
+    for bits in key_sizes:
+        key = os.urandom(bits // 8)
+        num_rounds = {128: 10, 192: 12, 256: 14}[bits]
+
+        def expand():
+            scheduler = KeyScheduler()
+            scheduler.get_key_expansion(
+                base_key=key, key_columns=scheduler._convert_byte_array_to_state_matrix(key), num_rounds=num_rounds)
+        stats = measure(expand)
+        stats['keys_per_s'] = 1 / stats['p50_s']
+        results[f'key_expansion/{bits}'] = stats
+
+        AES(aes_key_size_bits=bits, master_key=key)  # warm the cache
+        stats = measure(lambda: AES(aes_key_size_bits=bits, master_key=key))
+        stats['keys_per_s'] = 1 / stats['p50_s']
+        results[f'construct_cached/{bits}'] = stats
+    return results
+
+
+def bench_payloads(engines, key_sizes, sizes) -> dict:
+    """ Full CBC encrypt / decrypt_bytes of random payloads """
+    results = {}
+    init_vector = os.urandom(16)
+    for engine in engines:
+        for bits in key_sizes:
+            cipher = AES(aes_key_size_bits=bits, engine=engine)
+            for size in sizes:
+                payload = os.urandom(size)
+                ciphertext = cipher.encrypt(payload, init_vector)
+                # large payloads take a long time; a single timed repeat is enough for them
+                repeats = MIN_REPEATS if size <= 1024 * 1024 else 1
+                results[f'encrypt/{engine}/{bits}/{size}'] = with_throughput(
+                    measure(lambda: cipher.encrypt(payload, init_vector), min_repeats=repeats), size)
+                results[f'decrypt/{engine}/{bits}/{size}'] = with_throughput(
+                    measure(lambda: cipher.decrypt_bytes(ciphertext, init_vector), min_repeats=repeats), size)
+    return results
+
+
+def bench_asymmetry(engines, key_sizes, sizes) -> dict:
+    """ Reference engine MixColumns vs InvMixColumns and block encrypt vs decrypt;
+    decrypt_over_encrypt is the decryption / encryption latency ratio (1.0 = symmetric) """
+    results = {}
+    state = [list(os.urandom(4)) for _ in range(4)]
+    cipher = AES(aes_key_size_bits=128)
+    mix = measure(lambda: cipher.mix_columns(state))
+    inverse_mix = measure(lambda: cipher._inverse_mix_columns(state))
+    inverse_mix['decrypt_over_encrypt'] = inverse_mix['p50_s'] / mix['p50_s']
+    results['mix_columns'] = mix
+    results['inverse_mix_columns'] = inverse_mix
+    block = os.urandom(16)
+    for bits in key_sizes:
+        cipher = AES(aes_key_size_bits=bits)
+        encrypt = with_throughput(measure(lambda: cipher._encrypt_block(block)), 16)
+        decrypt = with_throughput(measure(lambda: cipher.decrypt_block(block)), 16)
+        decrypt['decrypt_over_encrypt'] = decrypt['p50_s'] / encrypt['p50_s']
+        results[f'asymmetry/encrypt_block/{bits}'] = encrypt
+        results[f'asymmetry/decrypt_block/{bits}'] = decrypt
+    return results
+
+
+def bench_batches(engines, key_sizes, sizes, count: int = 1000) -> dict:
+    """ Messages/sec for a batch of short messages: one encrypt / decrypt_bytes call per
+    message versus a single encrypt_many / decrypt_many call """
+    results = {}
+    rng = random.Random(0)
+    # Around the size of the messages in testing/messages.json
+    messages = [os.urandom(rng.randint(16, 160)) for _ in range(count)]
+    ivs = [os.urandom(16) for _ in range(count)]
+    for engine in engines:
+        for bits in key_sizes:
+            cipher = AES(aes_key_size_bits=bits, engine=engine)
+            pairs = list(zip(messages, ivs))
+            encrypted = list(zip(cipher.encrypt_many(pairs), ivs))
+            cases = {
+                'encrypt_each': lambda: [cipher.encrypt(m, iv) for m, iv in pairs],
+                'encrypt_many': lambda: cipher.encrypt_many(pairs),
+                'decrypt_each': lambda: [cipher.decrypt_bytes(c, iv) for c, iv in encrypted],
+                'decrypt_many': lambda: cipher.decrypt_many(encrypted),
+            }
+            for name, fn in cases.items():
+                stats = measure(fn, min_repeats=3)
+                stats['messages'] = count
+                stats['messages_per_s'] = count / stats['p50_s']
+                results[f'batch/{name}/{engine}/{bits}'] = stats
+    return results
+
+
+def bench_multi_key(engines, key_sizes, sizes, count: int = 1000) -> dict:
+    """ Records/sec when every record (one or two blocks) has its own key: a fresh AES per
+    record versus one AES.encrypt_multi_key call expanding every schedule together """
+    results = {}
+    rng = random.Random(0)
+    for bits in key_sizes:
+        keys = [os.urandom(bits // 8) for _ in range(count)]
+        records = [os.urandom(16 * rng.randint(1, 2)) for _ in range(count)]
+
+        def each(engine):
+            out = []
+            for key, record in zip(keys, records):
+                cipher = AES(aes_key_size_bits=bits, master_key=key, engine=engine)
+                out.append(b''.join(cipher._encrypt_block(record[i: i + 16]) for i in range(0, len(record), 16)))
+            return out
+        cases = {f'each/{engine}': (lambda engine=engine: each(engine)) for engine in engines}
+        cases['batched'] = lambda: AES.encrypt_multi_key(keys, records)
+        for name, fn in cases.items():
+            # every key is new in a real workload, so the schedule cache must not help the repeats
+            cache, AES.key_schedule_cache = AES.key_schedule_cache, None
+            try:
+                stats = measure(fn, min_repeats=3)
+            finally:
+                AES.key_schedule_cache = cache
+            stats['records'] = count
+            stats['records_per_s'] = count / stats['p50_s']
+            results[f'multi_key/{name}/{bits}'] = stats
+    return results
+
+
+def footprint(factory, count: int = 1000) -> float:
+    """ Average traced bytes retained per object when count objects are kept alive """
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    objects = [factory(i) for i in range(count)]
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objects
+    return (after - before) / count
+
+
+def uncached_aes(bits: int, key: bytes, engine: str = 'reference') -> AES:
+    """ AES object that expands its own schedule: the instance's schedule cache is off
+    before the key is set, so nothing is shared with (or stored in) the class-wide cache """
+    aes = AES.__new__(AES)
+    aes.key_schedule_cache = None
+    aes.__init__(aes_key_size_bits=bits, master_key=key, engine=engine)
+    return aes
+
+
+def bench_contexts(engines, key_sizes, sizes) -> dict:
+    """ Construction time and per-instance memory of AES objects versus AESContext """
+    results = {}
+    for bits in key_sizes:
+        key = os.urandom(bits // 8)
+        keys = [os.urandom(bits // 8) for _ in range(1000)]
+        candidates = {
+            # (factory using the schedule cache, factory that expands its own schedule)
+            'aes_reference': (lambda k: AES(aes_key_size_bits=bits, master_key=k),
+                              lambda k: uncached_aes(bits, k)),
+            'aes_ttable': (lambda k: AES(aes_key_size_bits=bits, master_key=k, engine='ttable'),
+                           lambda k: uncached_aes(bits, k, 'ttable')),
+            'context': (AESContext, lambda k: AESContext(k, key_schedule_cache=None)),
+        }
+        for name, (factory, uncached_factory) in candidates.items():
+            factory(key)  # warm the schedule cache for the construction timing
+            stats = measure(lambda: factory(key))
+            stats['constructions_per_s'] = 1 / stats['p50_s']
+            # one key: the schedule is shared through the cache, so this is the bare object cost
+            stats['bytes_per_instance_shared_schedule'] = footprint(lambda i: factory(key))
+            # distinct keys, each object expanding and holding its own schedule
+            stats['bytes_per_instance_own_schedule'] = footprint(lambda i: uncached_factory(keys[i]))
+            results[f'construct/{name}/{bits}'] = stats
+    return results
+
+
+SUITES = {
+    'blocks': bench_blocks,
+    'key_expansion': bench_key_expansion,
+    'payloads': bench_payloads,
+    'contexts': bench_contexts,
+    'asymmetry': bench_asymmetry,
+    'batches': bench_batches,
+    'multi_key': bench_multi_key,
+}
+
+
+## Baseline comparison ##
+THROUGHPUT_METRICS = ('mb_per_s', 'keys_per_s', 'constructions_per_s', 'messages_per_s', 'records_per_s')
+
+
+def throughput(stats: dict):
+    for metric in THROUGHPUT_METRICS:
+        if metric in stats:
+            return metric, stats[metric]
+    return 'ops_per_s', 1 / stats['p50_s']
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """ Return (name, metric, baseline value, current value, ratio) for every benchmark
+    present in both runs whose throughput fell below (1 - tolerance) of the baseline """
+    regressions = []
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        metric, current = throughput(stats)
+        _, previous = throughput(baseline[name])
+        ratio = current / previous
+        if ratio < 1 - tolerance:
+            regressions.append((name, metric, previous, current, ratio))
+    return regressions
+
+
+def missing_from_baseline(results: dict, baseline: dict) -> list:
+    """ Names of the benchmarks in this run that the baseline has no entry for (compare
+    can't check them, so they are reported instead of passing silently) """
+    return [name for name in results if name not in baseline]
+
+
+def run(suites, engines, key_sizes, sizes) -> dict:
+    report = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'engines': engines,
+            'key_sizes': key_sizes,
+            'sizes': sizes,
+        },
+        'results': {},
+    }
+    for suite in suites:
+        print(f'Running {suite} benchmarks', file=sys.stderr)
+        report['results'].update(SUITES[suite](engines, key_sizes, sizes))
+    return report
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the AES implementation')
+    parser.add_argument('--suite', nargs='+', choices=sorted(SUITES), default=list(SUITES),
+                        help='benchmark suites to run (default: all)')
+    parser.add_argument('--engine', nargs='+', choices=AES.ENGINES, default=None,
+                        help='engines to benchmark (default: every available engine)')
+    parser.add_argument('--key-size', nargs='+', type=int, choices=KEY_SIZES, default=list(KEY_SIZES))
+    parser.add_argument('--sizes', nargs='+', default=list(DEFAULT_SIZES),
+                        help='payload sizes, e.g. 16 1K 64K 1M 64M (default: %(default)s)')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='baseline JSON to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='store this run as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='allowed fractional throughput drop before failing (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    engines = args.engine or available_engines()
+    sizes = [parse_size(s) for s in args.sizes]
+    report = run(args.suite, engines, args.key_size, sizes)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            f.write(text + '\n')
+        print(f'Saved baseline to {args.baseline}', file=sys.stderr)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f'No baseline at {args.baseline}; skipping comparison', file=sys.stderr)
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)['results']
+    regressions = compare(report['results'], baseline, args.tolerance)
+    for name, metric, previous, current, ratio in regressions:
+        print(f'REGRESSION {name}: {metric} {previous:.4g} -> {current:.4g} ({ratio:.0%} of baseline)',
+              file=sys.stderr)
+    missing = missing_from_baseline(report['results'], baseline)
+    for name in missing:
+        print(f'MISSING {name}: not in the baseline, not compared', file=sys.stderr)
+    print(f'{len(regressions)} regression(s) against {args.baseline}'
+          + (f', {len(missing)} benchmark(s) missing from it (refresh with --save-baseline)' if missing else ''),
+          file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,373 @@
+"""
+Command line file / stream encryptor.
+
+    python cli.py encrypt -i backup.tar -o backup.tar.aes --key-file backup.key --mode ctr
+    python cli.py decrypt -i backup.tar.aes -o backup.tar --key-file backup.key
+    tar c docs | python cli.py encrypt --password-file pw.txt > docs.tar.aes
+
+Input and output default to stdin / stdout. The output starts with a small header
+(mode, key size, PBKDF2 salt and iteration count when a password is used, IV), so
+decrypt only needs the key or password. With a password an HMAC-SHA256 over the
+header and ciphertext is appended, and on decryption it is checked in a first pass
+over the ciphertext before any plaintext is written (encrypt-then-MAC, as in
+AES.encrypt_with_password). Piped input is spooled to a temporary file for that pass.
+With -o the output goes to a temporary file next to it and is only renamed into place
+once the run succeeded, so a failed run never truncates an existing file.
+
+The input is processed as a pipeline: a reader thread reads fixed size chunks
+(plain reads or a memory map), chunks are encrypted / decrypted in a process pool
+(--workers, one per core by default) and a writer thread writes the results in
+order, so reading, crypto and writing overlap. CTR encryption / decryption and CBC
+decryption chunks are independent and use every worker; CBC encryption chains each
+chunk on the previous one and can only use one, so prefer --mode ctr for large
+files. A throughput summary is printed to stderr at the end.
+"""
+import argparse
+import mmap
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from hmac import new as new_hmac, compare_digest
+from struct import Struct
+from aescipher import AES
+from util import parse_size
+import parallel
+
+# magic, version, mode, key size in bytes, uses password, PBKDF2 iterations, salt, iv
+FILE_HEADER = Struct('>4sBBBBI16s16s')
+FILE_MAGIC = b'AESF'
+FILE_VERSION = 1
+MODES = ('cbc', 'ctr')
+BLOCK_SIZE = 16
+TAG_SIZE = 32
+DEFAULT_CHUNK_SIZE = '1M'
+
+
+## Keys ##
+KEY_SIZES = (16, 24, 32)
+
+
+def _parse_key(text: str) -> bytes:
+    """ --key: 16, 24 or 32 bytes as hex """
+    try:
+        key = bytes.fromhex(text)
+    except ValueError:
+        raise ValueError('--key must be hex')
+    if len(key) not in KEY_SIZES:
+        raise ValueError(f'--key must be 16, 24 or 32 bytes (32, 48 or 64 hex digits), got {len(key)} bytes')
+    return key
+
+
+def _read_key_file(path) -> bytes:
+    """ Raw 16 / 24 / 32 byte key, or the same as hex text """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) in KEY_SIZES:
+        return data
+    try:
+        key = bytes.fromhex(data.decode('ascii').strip())
+    except ValueError:
+        key = b''
+    if len(key) not in KEY_SIZES:
+        raise ValueError(f'{path} does not hold a 16, 24 or 32 byte key (raw or hex)')
+    return key
+
+
+def _read_password(args) -> bytes:
+    if args.password is not None:
+        return args.password.encode('utf-8')
+    with open(args.password_file, 'rb') as f:
+        return f.read().rstrip(b'\r\n')
+
+
+def build_cipher(args, key_size: int, salt: bytes, workload: int):
+    """ Return (AES, hmac key or None) for the key / key file / password given on the command line """
+    if args.key is None and args.key_file is None:
+        aes = AES(aes_key_size_bits=8 * key_size, engine=args.engine)
+        derived = aes._derive_password_keys(_read_password(args), salt, workload, key_size)
+        schedule = derived.schedule
+        cipher = AES.from_round_keys(schedule.round_keys, args.engine, schedule.ttable, schedule.inverse_round_keys)
+        return cipher, derived.hmac_key
+    key = _parse_key(args.key) if args.key is not None else _read_key_file(args.key_file)
+    if len(key) != key_size:
+        raise ValueError(f'Expected a {8 * key_size} bit key, got {8 * len(key)} bits')
+    return AES(aes_key_size_bits=8 * key_size, master_key=key, engine=args.engine), None
+
+
+## Authentication ##
+def _verify_mac(source, mac, chunk_size: int):
+    """ Check the HMAC over the rest of a seekable source (ciphertext followed by the tag)
+    before anything is decrypted; leaves the source where it started """
+    start = source.tell()
+    end = source.seek(0, os.SEEK_END)
+    if end - start < TAG_SIZE:
+        raise ValueError('Input is too short to hold the HMAC')
+    mac = mac.copy()
+    source.seek(start)
+    remaining = end - start - TAG_SIZE
+    while remaining:
+        chunk = source.read(min(chunk_size, remaining))
+        if not chunk:
+            raise ValueError('Input changed while it was being authenticated')
+        mac.update(chunk)
+        remaining -= len(chunk)
+    if not compare_digest(mac.digest(), source.read(TAG_SIZE)):
+        raise ValueError('HMAC verification failed (wrong password or corrupted data)')
+    source.seek(start)
+
+
+def _spool(source):
+    """ Copy a non-seekable stream (stdin) into an anonymous temporary file """
+    spooled = tempfile.TemporaryFile()
+    shutil.copyfileobj(source, spooled)
+    spooled.seek(0)
+    return spooled
+
+
+## Pipeline stages ##
+def _reader(source, chunk_size: int, use_mmap: bool, chunks: queue.Queue):
+    """ Reader thread: put raw chunks on the queue, then None at EOF (or the exception) """
+    try:
+        if use_mmap and source.seekable() and os.fstat(source.fileno()).st_size > source.tell():
+            with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for start in range(source.tell(), len(mapped), chunk_size):
+                    chunks.put(mapped[start: start + chunk_size])
+        else:
+            while True:
+                chunk = source.read(chunk_size)
+                if not chunk:
+                    break
+                chunks.put(chunk)
+        chunks.put(None)
+    except BaseException as e:
+        chunks.put(e)
+
+
+def _writer(destination, results: queue.Queue, stats: dict, mac):
+    """ Writer thread: write each job's result in submission order until None """
+    try:
+        while True:
+            item = results.get()
+            if item is None:
+                return
+            future, finish = item
+            out = future.result()
+            if finish is not None:
+                out = finish(out)
+            if mac is not None:
+                mac.update(out)
+            destination.write(out)
+            stats['bytes_out'] += len(out)
+    except BaseException as e:
+        stats['error'] = e
+        # keep draining so the producer never blocks on a full queue
+        while results.get() is not None:
+            pass
+
+
+def _aligned_chunks(chunks: queue.Queue, reserve: int):
+    """ Turn raw chunks into (data, last) pieces that are whole blocks except possibly the
+    last one; the final `reserve` bytes are only ever handed out with the last piece """
+    carry = bytearray()
+    while True:
+        raw = chunks.get()
+        if isinstance(raw, BaseException):
+            raise raw
+        if raw is None:
+            yield bytes(carry), True
+            return
+        carry += raw
+        usable = len(carry) - reserve
+        usable -= usable % BLOCK_SIZE
+        if usable > 0:
+            yield bytes(carry[:usable]), False
+            del carry[:usable]
+
+
+def run_pipeline(cipher, mode: str, encrypting: bool, iv: bytes, source, destination, executor,
+                 workers: int, chunk_size: int, use_mmap: bool, stats: dict, mac=None, input_mac=None):
+    """ Stream source through the cipher into destination. mac (encryption) is fed the output,
+    input_mac (decryption) the ciphertext; with input_mac the trailing TAG_SIZE bytes of the
+    input are returned instead of being decrypted. """
+    chunks = queue.Queue(maxsize=2 * workers + 2)
+    results = queue.Queue(maxsize=2 * workers + 2)
+    reader = threading.Thread(target=_reader, args=(source, chunk_size, use_mmap, chunks), daemon=True)
+    writer = threading.Thread(target=_writer, args=(destination, results, stats, mac), daemon=True)
+    reader.start()
+    writer.start()
+
+    round_keys, engine = cipher.round_keys, cipher.engine_name
+    initial_counter = int.from_bytes(iv, 'big')
+    previous = iv
+    offset = 0
+    tag = b''
+    # keep back the MAC, and the final (padded) block when decrypting CBC
+    reserve = (TAG_SIZE if input_mac is not None else 0) + (BLOCK_SIZE if mode == 'cbc' and not encrypting else 0)
+    in_flight = deque()
+    try:
+        for data, last in _aligned_chunks(chunks, reserve):
+            if last and input_mac is not None:
+                if len(data) < TAG_SIZE:
+                    raise ValueError('Input is too short to hold the HMAC')
+                data, tag = data[:-TAG_SIZE], data[-TAG_SIZE:]
+            if input_mac is not None:
+                input_mac.update(data)
+            stats['bytes_in'] += len(data)
+            finish = None
+            if mode == 'ctr':
+                counter = (initial_counter + offset // BLOCK_SIZE) % (1 << 128)
+                future = executor.submit(parallel.ctr_segment, round_keys, engine, counter, data)
+            elif encrypting:
+                if last:
+                    data = cipher._add_padding(data)
+                if data:
+                    future = executor.submit(parallel.cbc_encrypt_segment, round_keys, engine, previous, data)
+                    # the next chunk chains on this chunk's last ciphertext block
+                    previous = future.result()[-BLOCK_SIZE:]
+                else:
+                    future = executor.submit(bytes)
+            else:
+                if last and (not data or len(data) % BLOCK_SIZE):
+                    raise ValueError('Ciphertext length is not a positive multiple of the block size')
+                future = executor.submit(parallel.cbc_decrypt_segment, round_keys, engine, previous, data)
+                previous = data[-BLOCK_SIZE:] if data else previous
+                if last:
+                    finish = cipher._remove_padding
+            offset += len(data)
+            results.put((future, finish))
+            # bound the work queued ahead of the writer
+            in_flight.append(future)
+            while len(in_flight) > 2 * workers:
+                in_flight.popleft().result()
+            if 'error' in stats:
+                break
+    finally:
+        results.put(None)
+        writer.join()
+    if 'error' in stats:
+        raise stats['error']
+    return tag
+
+
+## Entry point ##
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Encrypt or decrypt files and streams with AES')
+    parser.add_argument('command', choices=('encrypt', 'decrypt'))
+    parser.add_argument('-i', '--input', help='input file (default: stdin)')
+    parser.add_argument('-o', '--output', help='output file (default: stdout)')
+    keys = parser.add_mutually_exclusive_group(required=True)
+    keys.add_argument('--key', help='key as hex (16, 24 or 32 bytes)')
+    keys.add_argument('--key-file', help='file holding the key, raw or hex')
+    keys.add_argument('--password', help='derive the key from this password (PBKDF2)')
+    keys.add_argument('--password-file', help='derive the key from the password in this file')
+    parser.add_argument('--mode', choices=MODES, default='cbc', help='encryption mode (default: %(default)s)')
+    parser.add_argument('--key-size', type=int, choices=(128, 192, 256), default=None,
+                        help='key size in bits (default: the key length, or 256 with a password)')
+    parser.add_argument('--engine', choices=AES.ENGINES, default='ttable', help='block engine (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=None, help='crypto worker processes (default: one per core)')
+    parser.add_argument('--io', choices=('read', 'mmap'), default='read',
+                        help='read the input with plain reads or a memory map (files only)')
+    parser.add_argument('--chunk-size', type=parse_size, default=DEFAULT_CHUNK_SIZE, help='pipeline chunk size (default: %(default)s)')
+    parser.add_argument('--workload', type=int, default=AES.PASSWORD_WORKLOAD, help='PBKDF2 iterations for --password')
+    args = parser.parse_args(argv)
+
+    workers = parallel.resolve_workers(args.workers)
+    chunk_size = max(BLOCK_SIZE, args.chunk_size // BLOCK_SIZE * BLOCK_SIZE)
+    encrypting = args.command == 'encrypt'
+    source = sys.stdin.buffer
+    destination = sys.stdout.buffer
+    stats = {'bytes_in': 0, 'bytes_out': 0}
+    start = time.perf_counter()
+    ok = False
+    try:
+        if args.input:
+            source = open(args.input, 'rb')
+        if args.output:
+            # written next to the target and renamed over it only once the run succeeded
+            destination = tempfile.NamedTemporaryFile(
+                dir=os.path.dirname(os.path.abspath(args.output)), prefix=f'.{os.path.basename(args.output)}.',
+                delete=False)
+        if encrypting:
+            if args.key is not None:
+                key_size = len(_parse_key(args.key))
+            elif args.key_file is not None:
+                key_size = len(_read_key_file(args.key_file))
+            else:
+                key_size = (args.key_size or 256) // 8
+            if args.key_size is not None and args.key_size // 8 != key_size:
+                raise ValueError(f'--key-size {args.key_size} does not match the {8 * key_size} bit key')
+            uses_password = args.key is None and args.key_file is None
+            salt = os.urandom(16) if uses_password else bytes(16)
+            workload = args.workload if uses_password else 0
+            iv = os.urandom(BLOCK_SIZE)
+            mode = args.mode
+            header = FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION, MODES.index(mode), key_size,
+                                      uses_password, workload, salt, iv)
+        else:
+            header = source.read(FILE_HEADER.size)
+            if len(header) != FILE_HEADER.size:
+                raise ValueError('Input is too short to hold the file header')
+            magic, version, mode_index, key_size, uses_password, workload, salt, iv = FILE_HEADER.unpack(header)
+            if magic != FILE_MAGIC or version != FILE_VERSION or mode_index >= len(MODES):
+                raise ValueError('Input was not written by cli.py encrypt (unknown header)')
+            if key_size not in (16, 24, 32) or workload > AES.PASSWORD_MAX_WORKLOAD or (uses_password and not workload):
+                raise ValueError('Invalid key size or iteration count in header')
+            if bool(uses_password) != (args.key is None and args.key_file is None):
+                raise ValueError('Input was encrypted with a ' + ('password' if uses_password else 'key'))
+            mode = MODES[mode_index]
+
+        cipher, hmac_key = build_cipher(args, key_size, salt, workload)
+        mac = new_hmac(hmac_key, header, 'sha256') if hmac_key is not None else None
+        if mac is not None and not encrypting:
+            # authenticate everything before a single byte of plaintext is released
+            if not source.seekable():
+                source = _spool(source)
+            _verify_mac(source, mac, chunk_size)
+        if encrypting:
+            destination.write(header)
+            stats['bytes_out'] += len(header)
+
+        executor = ProcessPoolExecutor(workers) if workers > 1 else ThreadPoolExecutor(1)
+        with executor:
+            tag = run_pipeline(cipher, mode, encrypting, iv, source, destination, executor, workers, chunk_size,
+                               args.io == 'mmap', stats,
+                               mac=mac if encrypting else None, input_mac=None if encrypting else mac)
+        if mac is not None:
+            if encrypting:
+                tag = mac.digest()
+                destination.write(tag)
+                stats['bytes_out'] += len(tag)
+            elif not compare_digest(mac.digest(), tag):
+                raise ValueError('HMAC verification failed (wrong password or corrupted data)')
+        ok = True
+    except (OSError, ValueError) as e:
+        print(f'error: {e}', file=sys.stderr)
+    finally:
+        if source is not sys.stdin.buffer:
+            source.close()
+        if destination is not sys.stdout.buffer:
+            destination.close()
+            if ok:
+                os.replace(destination.name, args.output)
+            else:
+                # never leave a partial or unauthenticated output file behind
+                os.remove(destination.name)
+        else:
+            destination.flush()
+
+    elapsed = time.perf_counter() - start
+    if ok:
+        rate = stats['bytes_in'] / (1024 * 1024) / elapsed if elapsed else 0.0
+        print(f'{args.command}ed {stats["bytes_in"]} bytes -> {stats["bytes_out"]} bytes in {elapsed:.2f} s '
+              f'({rate:.2f} MB/s, mode {mode}, {workers} worker{"s" if workers != 1 else ""})', file=sys.stderr)
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,59 @@
+"""
+Compact AES cipher context for applications holding many live ciphers
+(for example one per connection).
+
+AESContext is a T-table engine plus CBC helpers: it uses __slots__ (no per-object
+__dict__), stores the encryption and decryption schedules as flat array('I')
+word arrays and relies on the module level, shared S-box and T-tables instead of
+per-instance lists. Schedules come from the key schedule cache, so contexts
+created for the same key share one pair of arrays.
+
+Only AESContext is laid out this way. AES itself keeps its per-instance
+attributes (round keys, equivalent inverse round keys, engine, profiler hooks)
+and is not any smaller.
+"""
+import os
+from keycache import DEFAULT_CACHE, expand_key
+from scheduler import KeyScheduler
+from ttable import TTableEngine
+from util import add_padding, remove_padding
+
+NUM_ROUNDS = {16: 10, 24: 12, 32: 14}
+
+
+class AESContext(TTableEngine):
+    """ Lightweight AES cipher bound to one key. encrypt produces the same ciphertext as
+    AES.encrypt; decrypt returns bytes like AES.decrypt_bytes (AES.decrypt returns str). """
+    __slots__ = ()
+    block_size = 16
+
+    def __init__(self, key: bytes, key_schedule_cache=DEFAULT_CACHE):
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        if len(key) not in NUM_ROUNDS:
+            raise ValueError('AES keys must be 16, 24 or 32 bytes long')
+        num_rounds = NUM_ROUNDS[len(key)]
+        if key_schedule_cache is None:
+            schedule = expand_key(KeyScheduler(), key, num_rounds).ttable
+        else:
+            schedule = key_schedule_cache.get(key, num_rounds).ttable
+        # Cached arrays are shared between contexts and never written to
+        self.num_rounds = num_rounds
+        self.encryption_words = schedule.encryption_words
+        self.decryption_words = schedule.decryption_words
+
+    @classmethod
+    def generate(cls, aes_key_size_bits: int = 128):
+        """ Context for a new random key """
+        return cls(os.urandom(aes_key_size_bits // 8))
+
+    def encrypt(self, plaintext, initialization_vector) -> bytes:
+        """ CBC encrypt with padding, like AES.encrypt """
+        if isinstance(plaintext, str):
+            plaintext = plaintext.encode('utf-8')
+        return self.encrypt_cbc(add_padding(plaintext, self.block_size), initialization_vector)
+
+    def decrypt(self, ciphertext, initialization_vector) -> bytes:
+        """ CBC decrypt and strip padding; returns bytes """
+        return remove_padding(self.decrypt_cbc(ciphertext, initialization_vector))
+
@@ -0,0 +1,71 @@
+"""
+Galois/Counter Mode (NIST SP 800-38D) support: table-driven GHASH.
+
+GHASH multiplies by the hash subkey H = E(K, 0^128) in GF(2^128). Multiplication
+by a fixed H is linear, so X * H is the xor of the contributions of each byte of X.
+GHash precomputes those contributions once per H as sixteen 256-entry tables
+(Shoup's 8-bit tables), after which each 16 byte block costs 16 lookups and xors.
+"""
+from struct import Struct
+
+# Reduction constant for GCM's bit-reflected representation of GF(2^128)
+_R = 0xE1 << 120
+_LENGTHS = Struct('>QQ')
+
+
+def inc32(block: int) -> int:
+    """ Increment the rightmost 32 bits of a 128 bit counter block, leaving the rest alone """
+    return (block & ~0xFFFFFFFF) | ((block + 1) & 0xFFFFFFFF)
+
+
+class GHash:
+    """ GHASH keyed by a hash subkey H, with per-H 8-bit multiplication tables """
+
+    def __init__(self, hash_subkey: bytes):
+        h = int.from_bytes(hash_subkey, 'big')
+        # powers[j] = H * x^j; bit j of a block (counting from the most significant bit) contributes powers[j]
+        powers = []
+        for _ in range(128):
+            powers.append(h)
+            h = (h >> 1) ^ _R if h & 1 else h >> 1
+        self.tables = []
+        for position in range(16):
+            table = [0] * 256
+            for bit in range(8):
+                contribution = powers[8 * position + bit]
+                step = 0x80 >> bit
+                for b in range(step, 256, 2 * step):
+                    for v in range(b, b + step):
+                        table[v] ^= contribution
+            self.tables.append(table)
+
+    def multiply(self, x: int) -> int:
+        """ Return x * H in GF(2^128) """
+        m = self.tables
+        b = x.to_bytes(16, 'big')
+        return (m[0][b[0]] ^ m[1][b[1]] ^ m[2][b[2]] ^ m[3][b[3]]
+                ^ m[4][b[4]] ^ m[5][b[5]] ^ m[6][b[6]] ^ m[7][b[7]]
+                ^ m[8][b[8]] ^ m[9][b[9]] ^ m[10][b[10]] ^ m[11][b[11]]
+                ^ m[12][b[12]] ^ m[13][b[13]] ^ m[14][b[14]] ^ m[15][b[15]])
+
+    def update(self, y: int, data) -> int:
+        """ Absorb data into the running GHASH value y, zero padding a final partial block """
+        multiply = self.multiply
+        length = len(data)
+        whole = length - length % 16
+        for offset in range(0, whole, 16):
+            y = multiply(y ^ int.from_bytes(data[offset: offset + 16], 'big'))
+        if whole != length:
+            y = multiply(y ^ int.from_bytes(bytes(data[whole:]).ljust(16, b'\0'), 'big'))
+        return y
+
+    def finish(self, y: int, associated_data_length: int, ciphertext_length: int) -> int:
+        """ Absorb the final length block (bit lengths of A and C) """
+        return self.multiply(y ^ int.from_bytes(
+            _LENGTHS.pack(8 * associated_data_length, 8 * ciphertext_length), 'big'))
+
+    def pre_counter_block(self, initialization_vector: bytes) -> int:
+        """ J0: IV || 0^31 || 1 for 96 bit IVs, otherwise GHASH of the zero padded IV and its length """
+        if len(initialization_vector) == 12:
+            return (int.from_bytes(initialization_vector, 'big') << 32) | 1
+        return self.finish(self.update(0, initialization_vector), 0, len(initialization_vector))
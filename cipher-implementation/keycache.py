@@ -0,0 +1,143 @@
+"""
+Bounded, thread-safe LRU caches of expanded AES key schedules and of
+password-derived key material.
+
+Constructing an AES object (or calling set_master_key) normally builds a new
+KeyScheduler, which allocates fresh S-box lists, recomputes the round constants
+and reruns the key expansion. Services that switch between a working set of keys
+can instead look the schedule up here, so switching back to a recently used key
+skips all of that work.
+"""
+import threading
+from collections import OrderedDict, namedtuple
+from hashlib import sha256
+from hmac import new as new_hmac
+from scheduler import KeyScheduler
+from ttable import TTableEngine
+
+# round_keys: the encryption schedule as returned by KeyScheduler.get_key_expansion
+# inverse_round_keys: the equivalent inverse cipher (decryption) schedule, FIPS-197 section 5.3.5
+# ttable: a TTableEngine holding the word forms of both schedules
+KeySchedule = namedtuple('KeySchedule', ['round_keys', 'inverse_round_keys', 'ttable'])
+
+# aes_key, hmac_key: the keys returned by AES._get_key_iv (its IV is not used; every
+# password encrypted message carries its own random IV)
+# schedule: the KeySchedule expanded from aes_key
+DerivedKeys = namedtuple('DerivedKeys', ['aes_key', 'hmac_key', 'schedule'])
+
+DEFAULT_MAX_SIZE = 4096
+DEFAULT_DERIVED_MAX_SIZE = 256
+
+
+def expand_key(key_scheduler: KeyScheduler, key: bytes, num_rounds: int) -> KeySchedule:
+    """ Run the full key expansion for a key and build the encryption and decryption schedules """
+    round_keys, inverse_round_keys = key_scheduler.get_key_expansion(
+        base_key=key,
+        key_columns=key_scheduler._convert_byte_array_to_state_matrix(key),
+        num_rounds=num_rounds,
+        equivalent_inverse=True
+    )
+    return KeySchedule(round_keys, inverse_round_keys, TTableEngine(round_keys, num_rounds, inverse_round_keys))
+
+
+class LRUCache:
+    """ Bounded least recently used mapping with hit / miss / eviction counters.
+    Subclasses do their lookups and inserts while holding self._lock. """
+
+    def __init__(self, max_size: int):
+        assert max_size > 0
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _lookup(self, cache_key):
+        """ Return the cached value (marking it most recently used) or None; caller holds the lock """
+        value = self._entries.get(cache_key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(cache_key)
+        self.hits += 1
+        return value
+
+    def _insert(self, cache_key, value):
+        """ Add a value, evicting the least recently used entry if full; caller holds the lock """
+        self._entries[cache_key] = value
+        self._entries.move_to_end(cache_key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """ Drop every cached entry and reset the counters """
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> dict:
+        """ Snapshot of the cache counters """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+                'max_size': self.max_size,
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class KeyScheduleCache(LRUCache):
+    """ LRU cache mapping (key bytes, number of rounds) to an expanded KeySchedule.
+    Cached schedules are shared between AES objects and must be treated as read-only. """
+
+    def __init__(self, max_size: int = DEFAULT_MAX_SIZE):
+        super().__init__(max_size)
+        # A single scheduler is reused for every miss; it is only touched under the lock
+        self._key_scheduler = KeyScheduler()
+
+    def get(self, key: bytes, num_rounds: int) -> KeySchedule:
+        """ Return the schedule for key, expanding (and caching) it on a miss """
+        cache_key = (bytes(key), num_rounds)
+        with self._lock:
+            schedule = self._lookup(cache_key)
+            if schedule is None:
+                schedule = expand_key(self._key_scheduler, cache_key[0], num_rounds)
+                self._insert(cache_key, schedule)
+            return schedule
+
+
+class DerivedKeyCache(LRUCache):
+    """ LRU cache of password-derived key material keyed by
+    (HMAC-SHA256 of the password keyed with the salt, PBKDF2 workload, AES key size).
+    Neither the password nor an unsalted hash of it is stored. Derivation runs outside
+    the lock so a slow PBKDF2 miss does not block hits for other passwords. """
+
+    def __init__(self, max_size: int = DEFAULT_DERIVED_MAX_SIZE):
+        super().__init__(max_size)
+
+    def get(self, password: bytes, salt: bytes, workload: int, aes_key_size: int, derive) -> DerivedKeys:
+        """ Return the cached material, or call derive() -> (aes_key, hmac_key) on a miss
+        and cache it together with the expanded key schedule """
+        cache_key = (new_hmac(bytes(salt), password, sha256).digest(), workload, aes_key_size)
+        with self._lock:
+            derived = self._lookup(cache_key)
+        if derived is not None:
+            return derived
+        aes_key, hmac_key = derive()
+        num_rounds = {16: 10, 24: 12, 32: 14}[aes_key_size]
+        derived = DerivedKeys(aes_key, hmac_key, expand_key(KeyScheduler(), aes_key, num_rounds))
+        with self._lock:
+            self._insert(cache_key, derived)
+        return derived
+
+
+# Process-wide caches used by AES unless a class or instance overrides
+# AES.key_schedule_cache / AES.derived_key_cache
+DEFAULT_CACHE = KeyScheduleCache()
+DEFAULT_DERIVED_CACHE = DerivedKeyCache()
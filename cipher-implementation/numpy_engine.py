@@ -0,0 +1,248 @@
+"""
+NumPy vectorized batch engine: every AES round runs across N blocks at once.
+
+Blocks are held as an (N, 16) uint8 array in the same column-major byte order as
+the state matrix (byte 4 * column + row). SubBytes is fancy indexing into the
+S-box, ShiftRows is a fixed column permutation, MixColumns uses GF(2^8)
+multiplication lookup tables and AddRoundKey is a broadcast xor with the round
+keys from KeyScheduler.get_key_expansion. Per block interpreter overhead is paid
+once per batch instead of once per block, which pays off for the modes where
+blocks are independent (CTR keystream, ECB, CBC decryption). Serial CBC
+encryption cannot be batched and is delegated to the T-table engine.
+
+expand_keys runs the key schedule for N keys at once ((N, key length) in,
+(N, rounds + 1, 16) out), with the S-box lookups of each schedule step batched
+across keys, and encrypt_blocks_multi_key / decrypt_blocks_multi_key use one
+schedule per block, so many short records under many keys cost one pass.
+
+NumPy is an optional dependency; importing this module works without it but
+building an engine raises ImportError.
+"""
+try:
+    import numpy as np
+except ImportError:  # numpy is optional
+    np = None
+
+from rijndael import SBOX, INV_SBOX, MUL2, MUL3, MUL9, MUL11, MUL13, MUL14, _xtime
+from ttable import TTableEngine
+
+# Blocks processed per vectorized call; bounds temporary memory on large inputs
+BATCH_BLOCKS = 1 << 16
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError('The numpy engine requires numpy; install it with `pip install numpy`')
+
+
+def _build_tables():
+    """ S-boxes, multiplication tables and ShiftRows permutations as NumPy arrays """
+    tables = {
+        'sbox': np.frombuffer(SBOX, dtype=np.uint8),
+        'inv_sbox': np.frombuffer(INV_SBOX, dtype=np.uint8),
+    }
+    for factor, table in ((2, MUL2), (3, MUL3), (9, MUL9), (11, MUL11), (13, MUL13), (14, MUL14)):
+        tables[f'mul{factor}'] = np.frombuffer(table, dtype=np.uint8)
+    # byte 4 * c + r of the shifted state comes from column (c + r) % 4 (right shift for the inverse)
+    tables['shift_rows'] = np.array([4 * ((c + r) % 4) + r for c in range(4) for r in range(4)], dtype=np.intp)
+    tables['inv_shift_rows'] = np.array([4 * ((c - r) % 4) + r for c in range(4) for r in range(4)], dtype=np.intp)
+    return tables
+
+
+_TABLES = None
+
+
+def _tables():
+    global _TABLES
+    if _TABLES is None:
+        _TABLES = _build_tables()
+    return _TABLES
+
+
+## Round steps on (N, 16) arrays ##
+def _mix_columns(state):
+    t = _tables()
+    a = state.reshape(-1, 4, 4)
+    a0, a1, a2, a3 = a[:, :, 0], a[:, :, 1], a[:, :, 2], a[:, :, 3]
+    out = np.empty_like(a)
+    out[:, :, 0] = t['mul2'][a0] ^ t['mul3'][a1] ^ a2 ^ a3
+    out[:, :, 1] = a0 ^ t['mul2'][a1] ^ t['mul3'][a2] ^ a3
+    out[:, :, 2] = a0 ^ a1 ^ t['mul2'][a2] ^ t['mul3'][a3]
+    out[:, :, 3] = t['mul3'][a0] ^ a1 ^ a2 ^ t['mul2'][a3]
+    return out.reshape(-1, 16)
+
+
+def _inverse_mix_columns(state):
+    t = _tables()
+    m9, m11, m13, m14 = t['mul9'], t['mul11'], t['mul13'], t['mul14']
+    a = state.reshape(-1, 4, 4)
+    a0, a1, a2, a3 = a[:, :, 0], a[:, :, 1], a[:, :, 2], a[:, :, 3]
+    out = np.empty_like(a)
+    out[:, :, 0] = m14[a0] ^ m11[a1] ^ m13[a2] ^ m9[a3]
+    out[:, :, 1] = m9[a0] ^ m14[a1] ^ m11[a2] ^ m13[a3]
+    out[:, :, 2] = m13[a0] ^ m9[a1] ^ m14[a2] ^ m11[a3]
+    out[:, :, 3] = m11[a0] ^ m13[a1] ^ m9[a2] ^ m14[a3]
+    return out.reshape(-1, 16)
+
+
+def _encrypt_rounds(blocks, round_keys, num_rounds: int):
+    """ round_keys[..., r, :] is xored in round r: a (rounds + 1, 16) schedule broadcasts
+    over every block, an (N, rounds + 1, 16) one gives each block its own key """
+    t = _tables()
+    sbox, shift_rows = t['sbox'], t['shift_rows']
+    state = blocks ^ round_keys[..., 0, :]
+    for r in range(1, num_rounds):
+        state = _mix_columns(sbox[state][:, shift_rows]) ^ round_keys[..., r, :]
+    return sbox[state][:, shift_rows] ^ round_keys[..., num_rounds, :]
+
+
+def _decrypt_rounds(blocks, round_keys, num_rounds: int):
+    """ Inverse of _encrypt_rounds with the same (encryption) round keys """
+    t = _tables()
+    inv_sbox, inv_shift_rows = t['inv_sbox'], t['inv_shift_rows']
+    state = inv_sbox[(blocks ^ round_keys[..., num_rounds, :])[:, inv_shift_rows]]
+    for r in range(num_rounds - 1, 0, -1):
+        state = inv_sbox[_inverse_mix_columns(state ^ round_keys[..., r, :])[:, inv_shift_rows]]
+    return state ^ round_keys[..., 0, :]
+
+
+## Many keys at once ##
+NUM_ROUNDS = {16: 10, 24: 12, 32: 14}
+
+
+def _round_constants(count: int) -> list:
+    constants = [0x01]
+    while len(constants) < count:
+        constants.append(_xtime(constants[-1]))
+    return constants
+
+
+def expand_keys(keys):
+    """ Expand N keys of the same length in lockstep. keys is an (N, 16 / 24 / 32) uint8
+    array (or a list of byte strings); returns the (N, rounds + 1, 16) uint8 round keys,
+    identical to KeyScheduler.get_key_expansion for each key. Every step of the schedule
+    (RotWord, SubWord, Rcon, xor) is one vectorized operation over all N keys. """
+    _require_numpy()
+    if not isinstance(keys, np.ndarray):
+        keys = np.frombuffer(b''.join(bytes(k) for k in keys), dtype=np.uint8).reshape(len(keys), -1)
+    count, key_length = keys.shape
+    if key_length not in NUM_ROUNDS:
+        raise ValueError(f'Keys must be 16, 24 or 32 bytes, got {key_length}')
+    num_rounds, key_words = NUM_ROUNDS[key_length], key_length // 4
+    sbox = _tables()['sbox']
+    rcon = _round_constants(num_rounds)
+    words = np.empty((count, 4 * (num_rounds + 1), 4), dtype=np.uint8)
+    words[:, :key_words] = keys.reshape(count, key_words, 4)
+    for i in range(key_words, 4 * (num_rounds + 1)):
+        word = words[:, i - 1]
+        if i % key_words == 0:
+            word = sbox[np.roll(word, -1, axis=1)]
+            word[:, 0] ^= rcon[i // key_words - 1]
+        elif key_words == 8 and i % key_words == 4:
+            word = sbox[word]
+        words[:, i] = word ^ words[:, i - key_words]
+    return words.reshape(count, num_rounds + 1, 16)
+
+
+def _per_block_schedules(round_keys, block_counts):
+    """ (blocks, rounds + 1, 16) schedules: key k repeated for each of its block_counts[k] blocks """
+    return np.repeat(round_keys, block_counts, axis=0)
+
+
+def encrypt_blocks_multi_key(round_keys, blocks, block_counts):
+    """ Encrypt (sum(block_counts), 16) blocks where the next block_counts[k] blocks belong to
+    key k of the (N, rounds + 1, 16) round_keys from expand_keys """
+    schedules = _per_block_schedules(round_keys, block_counts)
+    num_rounds = round_keys.shape[1] - 1
+    return np.concatenate([_encrypt_rounds(blocks[i: i + BATCH_BLOCKS], schedules[i: i + BATCH_BLOCKS], num_rounds)
+                           for i in range(0, len(blocks), BATCH_BLOCKS)] or [blocks])
+
+
+def decrypt_blocks_multi_key(round_keys, blocks, block_counts):
+    """ Inverse of encrypt_blocks_multi_key """
+    schedules = _per_block_schedules(round_keys, block_counts)
+    num_rounds = round_keys.shape[1] - 1
+    return np.concatenate([_decrypt_rounds(blocks[i: i + BATCH_BLOCKS], schedules[i: i + BATCH_BLOCKS], num_rounds)
+                           for i in range(0, len(blocks), BATCH_BLOCKS)] or [blocks])
+
+
+class NumpyBatchEngine:
+    """ Batch block engine over (N, 16) uint8 arrays; also exposes the single block and
+    CBC/CTR helpers AES expects from an engine so it can be selected with engine='numpy' """
+
+    def __init__(self, round_keys, num_rounds: int, ttable: TTableEngine = None):
+        _require_numpy()
+        self.num_rounds = num_rounds
+        self.tables = _tables()
+        # (num_rounds + 1, 16) so round key r broadcasts over every block in a batch
+        self.round_keys = np.array(
+            [[b for column in round_key for b in column] for round_key in round_keys], dtype=np.uint8)
+        self.ttable = ttable if ttable is not None else TTableEngine(round_keys, num_rounds)
+
+    ## Batch block operations ##
+    def encrypt_blocks(self, blocks):
+        """ Encrypt an (N, 16) uint8 array of independent blocks """
+        return _encrypt_rounds(blocks, self.round_keys, self.num_rounds)
+
+    def decrypt_blocks(self, blocks):
+        """ Decrypt an (N, 16) uint8 array of independent blocks """
+        return _decrypt_rounds(blocks, self.round_keys, self.num_rounds)
+
+    def encrypt_ecb(self, data) -> bytes:
+        """ Encrypt a whole number of blocks independently (ECB), batch by batch """
+        blocks = np.frombuffer(data, dtype=np.uint8).reshape(-1, 16)
+        return b''.join(self.encrypt_blocks(blocks[i: i + BATCH_BLOCKS]).tobytes()
+                        for i in range(0, len(blocks), BATCH_BLOCKS))
+
+    def decrypt_ecb(self, data) -> bytes:
+        """ Decrypt a whole number of independently encrypted (ECB) blocks """
+        blocks = np.frombuffer(data, dtype=np.uint8).reshape(-1, 16)
+        return b''.join(self.decrypt_blocks(blocks[i: i + BATCH_BLOCKS]).tobytes()
+                        for i in range(0, len(blocks), BATCH_BLOCKS))
+
+    ## Engine interface used by AES ##
+    def encrypt_block(self, plaintext) -> bytes:
+        """ Single blocks gain nothing from vectorizing; use the T-table rounds """
+        return self.ttable.encrypt_block(plaintext)
+
+    def decrypt_block(self, ciphertext) -> bytes:
+        return self.ttable.decrypt_block(ciphertext)
+
+    def encrypt_cbc(self, plaintext, initialization_vector) -> bytes:
+        """ CBC encryption is serial, so it runs on the T-table engine """
+        return self.ttable.encrypt_cbc(plaintext, initialization_vector)
+
+    def encrypt_cbc_into(self, plaintext, out, initialization_vector):
+        self.ttable.encrypt_cbc_into(plaintext, out, initialization_vector)
+
+    def decrypt_cbc(self, ciphertext, initialization_vector) -> bytes:
+        out = bytearray(len(ciphertext))
+        self.decrypt_cbc_into(ciphertext, out, initialization_vector)
+        return bytes(out)
+
+    def decrypt_cbc_into(self, ciphertext, out, initialization_vector):
+        """ CBC decrypt: decrypt every block in batches, then xor with the previous ciphertext blocks,
+        writing straight into the caller's buffer """
+        blocks = np.frombuffer(ciphertext, dtype=np.uint8).reshape(-1, 16)
+        destination = np.frombuffer(out, dtype=np.uint8).reshape(-1, 16)
+        previous = np.frombuffer(bytes(initialization_vector), dtype=np.uint8).reshape(1, 16)
+        for i in range(0, len(blocks), BATCH_BLOCKS):
+            batch = blocks[i: i + BATCH_BLOCKS]
+            chain = np.concatenate((previous, batch[:-1]))
+            np.bitwise_xor(self.decrypt_blocks(batch), chain, out=destination[i: i + len(batch)])
+            previous = batch[-1:]
+
+    def ctr_keystream(self, initial_counter: int, num_blocks: int) -> bytes:
+        """ Encrypt num_blocks successive 128 bit counter blocks, batch by batch """
+        out = []
+        for first in range(0, num_blocks, BATCH_BLOCKS):
+            count = min(BATCH_BLOCKS, num_blocks - first)
+            start = (initial_counter + first) % (1 << 128)
+            high, low = start >> 64, start & 0xFFFFFFFFFFFFFFFF
+            counters = np.empty((count, 2), dtype='>u8')
+            # 64-bit halves with an explicit carry; a batch is far smaller than 2^64 blocks
+            lows = np.uint64(low) + np.arange(count, dtype=np.uint64)
+            counters[:, 1] = lows
+            counters[:, 0] = np.uint64(high) + (lows < np.uint64(low)).astype(np.uint64)
+            out.append(self.encrypt_blocks(counters.view(np.uint8).reshape(count, 16)).tobytes())
+        return b''.join(out)
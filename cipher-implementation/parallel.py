@@ -0,0 +1,78 @@
+"""
+Process pool helpers for the block-parallel AES modes.
+
+Worker functions live at module level so ProcessPoolExecutor can pickle them.
+Workers are handed the already expanded round keys, never the master key, and
+rebuild a cipher with AES.from_round_keys so no key expansion is repeated.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# Below this many bytes per segment the cost of shipping data to a worker
+# outweighs the crypto work, so inputs are not split any finer than this.
+MIN_SEGMENT_SIZE = 256 * 1024
+# Likewise, encrypt_many / decrypt_many batches are not sharded below this many messages per worker
+MIN_SHARD_MESSAGES = 1024
+
+
+def resolve_workers(workers) -> int:
+    """ None means one worker per core """
+    if workers is None:
+        return os.cpu_count() or 1
+    return max(1, workers)
+
+
+def split_into_segments(length: int, block_size: int, workers, min_segment_size: int = MIN_SEGMENT_SIZE):
+    """ Split [0, length) into at most `workers` contiguous (start, end) ranges whose
+    boundaries fall on block boundaries, each at least min_segment_size bytes long
+    (except possibly the last). """
+    workers = resolve_workers(workers)
+    num_blocks = -(-length // block_size)
+    min_blocks = max(1, min_segment_size // block_size)
+    num_segments = max(1, min(workers, num_blocks // min_blocks))
+    blocks_per_segment = max(1, -(-num_blocks // num_segments))
+    segments = []
+    for first_block in range(0, num_blocks, blocks_per_segment):
+        start = first_block * block_size
+        end = min(length, (first_block + blocks_per_segment) * block_size)
+        segments.append((start, end))
+    return segments
+
+
+def map_in_processes(fn, jobs, workers, executor=None) -> list:
+    """ Run fn(*job) for every job in a process pool and return the results in job order """
+    if executor is not None:
+        return list(executor.map(fn, *zip(*jobs)))
+    with ProcessPoolExecutor(max_workers=min(resolve_workers(workers), len(jobs))) as pool:
+        return list(pool.map(fn, *zip(*jobs)))
+
+
+def ctr_segment(round_keys, engine: str, initial_counter: int, data) -> bytes:
+    """ Worker: encrypt/decrypt one contiguous CTR segment """
+    from aescipher import AES
+    return AES.from_round_keys(round_keys, engine)._ctr_xor(data, initial_counter)
+
+
+def cbc_decrypt_segment(round_keys, engine: str, previous_block, data) -> bytes:
+    """ Worker: CBC decrypt one contiguous range of ciphertext blocks, chaining from
+    previous_block (the IV for the first range, otherwise the ciphertext block before the range) """
+    from aescipher import AES
+    return AES.from_round_keys(round_keys, engine)._decrypt_cbc(data, previous_block)
+
+
+def cbc_encrypt_segment(round_keys, engine: str, previous_block, data) -> bytes:
+    """ Worker: CBC encrypt whole (already padded) blocks chaining from previous_block """
+    from aescipher import AES
+    return AES.from_round_keys(round_keys, engine)._encrypt_cbc(data, previous_block)
+
+
+def encrypt_many_segment(round_keys, engine: str, pairs) -> list:
+    """ Worker: encrypt one contiguous shard of (message, iv) pairs """
+    from aescipher import AES
+    return AES.from_round_keys(round_keys, engine).encrypt_many(pairs)
+
+
+def decrypt_many_segment(round_keys, engine: str, pairs) -> list:
+    """ Worker: decrypt one contiguous shard of (ciphertext, iv) pairs """
+    from aescipher import AES
+    return AES.from_round_keys(round_keys, engine).decrypt_many(pairs)
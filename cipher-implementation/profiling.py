@@ -0,0 +1,174 @@
+"""
+Opt-in per-stage profiling of the AES round function.
+
+Nothing here runs unless a cipher is instrumented: Profiler.instrument(aes)
+shadows the stage methods of that one instance (_substitute_bytes, _shift_rows,
+mix_columns, _add_round_key, the state matrix conversions, ...) with timing
+wrappers, and uninstrument removes them again. Ciphers that are not instrumented
+keep calling the plain class methods, so disabled profiling costs nothing.
+
+Per key size the profiler gathers call counts and cumulative nanoseconds for
+every stage, and whole message counters (messages, blocks, bytes, padding bytes)
+for encrypt and decrypt. _encrypt_cbc / _decrypt_cbc totals are recorded for
+every engine. The T-table and numpy engines fold the stages into table lookups
+and run whole messages through engine.encrypt_cbc / decrypt_cbc, so with those
+engines the CBC totals are the only stage timings; per-block and per-stage
+timings come from the reference engine.
+
+    profiler = aes.enable_profiling()
+    aes.encrypt(message, iv)
+    print(profiler.to_prometheus())
+"""
+import threading
+import time
+from functools import wraps
+
+STAGES = (
+    '_encrypt_cbc',
+    '_decrypt_cbc',
+    '_encrypt_block',
+    'decrypt_block',
+    '_substitute_bytes',
+    '_inverse_substitute_bytes',
+    '_shift_rows',
+    '_inverse_shift_rows',
+    'mix_columns',
+    '_inverse_mix_columns',
+    '_add_round_key',
+    '_convert_byte_array_to_state_matrix',
+    '_convert_state_matrix_to_byte_array',
+)
+MESSAGE_COUNTERS = ('messages', 'blocks', 'bytes', 'padding_bytes')
+
+
+class Profiler:
+    """ Collects stage timings and message counters from any number of instrumented ciphers """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # {key size bits: {stage: [calls, nanoseconds]}}
+            self.stages = {}
+            # {key size bits: {'encrypt' / 'decrypt': {counter: value}}}
+            self.messages = {}
+
+    ## Instrumentation ##
+    def instrument(self, cipher):
+        """ Wrap the stage and message methods of one cipher instance """
+        key_size = cipher.aes_key_size * 8
+        for stage in STAGES:
+            setattr(cipher, stage, self._timed(getattr(cipher, stage), key_size, stage))
+        setattr(cipher, 'encrypt', self._counted_encrypt(cipher.encrypt, key_size, cipher.block_size))
+        setattr(cipher, 'decrypt_bytes', self._counted_decrypt(cipher.decrypt_bytes, key_size, cipher.block_size))
+        cipher.profiler = self
+        return cipher
+
+    @staticmethod
+    def uninstrument(cipher):
+        """ Remove the wrappers so the instance uses the class methods again """
+        for name in STAGES + ('encrypt', 'decrypt_bytes'):
+            cipher.__dict__.pop(name, None)
+        cipher.profiler = None
+        return cipher
+
+    def _timed(self, method, key_size: int, stage: str):
+        clock = time.perf_counter_ns
+
+        @wraps(method)
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = clock() - start
+                with self._lock:
+                    totals = self.stages.setdefault(key_size, {}).setdefault(stage, [0, 0])
+                    totals[0] += 1
+                    totals[1] += elapsed
+        return timed
+
+    def _count_message(self, key_size: int, direction: str, blocks: int, num_bytes: int, padding: int):
+        with self._lock:
+            counters = self.messages.setdefault(key_size, {}).setdefault(
+                direction, dict.fromkeys(MESSAGE_COUNTERS, 0))
+            counters['messages'] += 1
+            counters['blocks'] += blocks
+            counters['bytes'] += num_bytes
+            counters['padding_bytes'] += padding
+
+    def _counted_encrypt(self, encrypt, key_size: int, block_size: int):
+        @wraps(encrypt)
+        def counted(plaintext, *args, **kwargs):
+            ciphertext = encrypt(plaintext, *args, **kwargs)
+            length = _encoded_length(plaintext)
+            self._count_message(key_size, 'encrypt', len(ciphertext) // block_size, length,
+                                len(ciphertext) - length)
+            return ciphertext
+        return counted
+
+    def _counted_decrypt(self, decrypt_bytes, key_size: int, block_size: int):
+        @wraps(decrypt_bytes)
+        def counted(ciphertext, *args, **kwargs):
+            plaintext = decrypt_bytes(ciphertext, *args, **kwargs)
+            self._count_message(key_size, 'decrypt', len(ciphertext) // block_size, len(plaintext),
+                                len(ciphertext) - len(plaintext))
+            return plaintext
+        return counted
+
+    ## Export ##
+    def as_dict(self) -> dict:
+        """ {'stages': {key size: {stage: {'calls', 'ns', 'ns_per_call'}}},
+             'messages': {key size: {'encrypt' / 'decrypt': {counter: value}}}} """
+        with self._lock:
+            return {
+                'stages': {
+                    key_size: {
+                        stage: {'calls': calls, 'ns': ns, 'ns_per_call': ns / calls if calls else 0.0}
+                        for stage, (calls, ns) in stages.items()
+                    }
+                    for key_size, stages in self.stages.items()
+                },
+                'messages': {
+                    key_size: {direction: dict(counters) for direction, counters in directions.items()}
+                    for key_size, directions in self.messages.items()
+                },
+            }
+
+    def to_prometheus(self, prefix: str = 'aes') -> str:
+        """ Prometheus text exposition format dump of every counter """
+        snapshot = self.as_dict()
+        lines = []
+
+        def metric(name: str, help_text: str, samples):
+            lines.append(f'# HELP {prefix}_{name} {help_text}')
+            lines.append(f'# TYPE {prefix}_{name} counter')
+            for labels, value in samples:
+                label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+                lines.append(f'{prefix}_{name}{{{label_text}}} {value}')
+
+        stage_samples = [(key_size, stage, totals) for key_size, stages in sorted(snapshot['stages'].items())
+                         for stage, totals in stages.items()]
+        metric('stage_calls_total', 'Calls of each AES round stage',
+               [((('key_size', k), ('stage', s)), t['calls']) for k, s, t in stage_samples])
+        metric('stage_nanoseconds_total', 'Cumulative time spent in each AES round stage',
+               [((('key_size', k), ('stage', s)), t['ns']) for k, s, t in stage_samples])
+        message_samples = [(key_size, direction, counters)
+                           for key_size, directions in sorted(snapshot['messages'].items())
+                           for direction, counters in sorted(directions.items())]
+        for counter in MESSAGE_COUNTERS:
+            name = 'messages_total' if counter == 'messages' else f'message_{counter}_total'
+            metric(name, f'Whole message {counter.replace("_", " ")} processed',
+                   [((('key_size', k), ('direction', d)), c[counter]) for k, d, c in message_samples])
+        return '\n'.join(lines) + '\n'
+
+
+def _encoded_length(plaintext) -> int:
+    """ Length of the plaintext after the str / int encoding AES.encrypt applies """
+    if isinstance(plaintext, str):
+        return len(plaintext.encode('utf-8'))
+    if isinstance(plaintext, int):
+        return len(str(plaintext))
+    return len(plaintext)
@@ -86,11 +86,14 @@ class KeyScheduler(Util):
         #    f'inverse substitution 32 bit word for 32 word input {word} is {sub}')
         return sub
 
-    def get_key_expansion(self, base_key, key_columns, num_rounds):
+    def get_key_expansion(self, base_key, key_columns, num_rounds, equivalent_inverse: bool = False):
         """
         Expand AES base key into num_rounds + 1 round keys.
         Alternative approach to key expansion from boppreh / aes at
         https://github.com/boppreh/aes/blob/d6857518fa95f08352a250242b0cf21d2544e470/aes.py#L190
+
+        With equivalent_inverse=True, return (round_keys, inverse_round_keys) where
+        inverse_round_keys is the decryption schedule from get_equivalent_inverse_key_expansion.
         """
         num_rows = len(base_key) // 4
         i = 1
@@ -115,4 +118,31 @@ class KeyScheduler(Util):
             key_columns.append(word)
 
         # Group key words in 4x4 byte matrices.
-        return [key_columns[4*i: 4*(i+1)] for i in range(len(key_columns) // 4)]
+        round_keys = [key_columns[4*i: 4*(i+1)] for i in range(len(key_columns) // 4)]
+        if equivalent_inverse:
+            return round_keys, self.get_equivalent_inverse_key_expansion(round_keys)
+        return round_keys
+
+    def get_equivalent_inverse_key_expansion(self, round_keys):
+        """
+        Build the decryption schedule for the equivalent inverse cipher (FIPS-197 section 5.3.5).
+        The round keys are used in reverse order, and InvMixColumns is applied to every round key
+        except the first and the last. Since InvMixColumns is linear, this lets decryption run
+        InvSubBytes, InvShiftRows, InvMixColumns, AddRoundKey in that order, the same shape as an
+        encryption round.
+        """
+        mul9, mul11, mul13, mul14 = self.mul9, self.mul11, self.mul13, self.mul14
+        num_rounds = len(round_keys) - 1
+        inverse_round_keys = []
+        for r in range(num_rounds, -1, -1):
+            if r in (0, num_rounds):
+                inverse_round_keys.append([list(column) for column in round_keys[r]])
+                continue
+            inverse_round_keys.append([
+                [mul14[a0] ^ mul11[a1] ^ mul13[a2] ^ mul9[a3],
+                 mul9[a0] ^ mul14[a1] ^ mul11[a2] ^ mul13[a3],
+                 mul13[a0] ^ mul9[a1] ^ mul14[a2] ^ mul11[a3],
+                 mul11[a0] ^ mul13[a1] ^ mul9[a2] ^ mul14[a3]]
+                for a0, a1, a2, a3 in round_keys[r]
+            ])
+        return inverse_round_keys
@@ -0,0 +1,278 @@
+"""
+Incremental (streaming) CBC encryption and decryption on top of AES.
+
+AES.encrypt / AES.decrypt need the whole message in memory. The classes here
+accept the message in arbitrarily sized chunks through update(chunk) and
+finish with finalize(), carrying the CBC chaining value and the PKCS#7 style
+padding (Util._add_padding / Util._remove_padding) across chunk boundaries.
+Only a partial block (encryption) or the last full block (decryption) is ever
+held back, so memory use is bounded by the chunk size rather than the message size.
+
+CBCReader goes the other way for random access: a CBC plaintext block only
+depends on its own ciphertext block and the one before it, so a byte range is
+decrypted from the blocks it covers without touching the rest of the file.
+"""
+import io
+import mmap
+import os
+from collections import OrderedDict
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+
+class _CBCStream:
+    """ Shared state for the incremental encryptor / decryptor """
+
+    def __init__(self, cipher, initialization_vector):
+        assert len(initialization_vector) == cipher.block_size
+        self.cipher = cipher
+        self.previous = bytes(initialization_vector)
+        self.pending = bytearray()
+        self.finalized = False
+
+    def _check_open(self):
+        if self.finalized:
+            raise ValueError('update() or finalize() called after finalize()')
+
+    def _take_blocks(self, keep_last_block: bool) -> bytes:
+        """ Remove and return the whole blocks buffered so far. When keep_last_block
+        is set, a trailing full block stays buffered (it may carry padding). """
+        block_size = self.cipher.block_size
+        usable = len(self.pending) - len(self.pending) % block_size
+        if keep_last_block and usable == len(self.pending):
+            usable -= block_size
+        if usable <= 0:
+            return b''
+        data = bytes(self.pending[:usable])
+        del self.pending[:usable]
+        return data
+
+
+class CBCEncryptor(_CBCStream):
+    """ Encrypt a message incrementally; the concatenation of every update() result
+    and the finalize() result equals AES.encrypt(message, initialization_vector) """
+
+    def update(self, chunk) -> bytes:
+        self._check_open()
+        self.pending += chunk
+        data = self._take_blocks(keep_last_block=False)
+        if not data:
+            return b''
+        encrypted = self.cipher._encrypt_cbc(data, self.previous)
+        self.previous = encrypted[-self.cipher.block_size:]
+        return encrypted
+
+    def finalize(self) -> bytes:
+        """ Pad whatever is left (possibly nothing, giving a full block of padding) and encrypt it """
+        self._check_open()
+        self.finalized = True
+        return self.cipher._encrypt_cbc(self.cipher._add_padding(bytes(self.pending)), self.previous)
+
+
+class CBCDecryptor(_CBCStream):
+    """ Decrypt a message incrementally; returns raw bytes, padding removed by finalize() """
+
+    def update(self, chunk) -> bytes:
+        self._check_open()
+        self.pending += chunk
+        data = self._take_blocks(keep_last_block=True)
+        if not data:
+            return b''
+        decrypted = self.cipher._decrypt_cbc(data, self.previous)
+        self.previous = data[-self.cipher.block_size:]
+        return decrypted
+
+    def finalize(self) -> bytes:
+        """ Decrypt the final block and strip its padding """
+        self._check_open()
+        self.finalized = True
+        if len(self.pending) != self.cipher.block_size:
+            raise ValueError('Ciphertext length is not a positive multiple of the block size')
+        return self.cipher._remove_padding(self.cipher._decrypt_cbc(bytes(self.pending), self.previous))
+
+
+class CBCReader(io.RawIOBase):
+    """ Read-only, seekable file object over a CBC encrypted file (as written by
+    encrypt_file, optionally prefixed with its 16 byte IV).
+
+    read / readinto / seek / tell work on plaintext offsets. A range read fetches the
+    ciphertext blocks it covers plus the one before them (the chaining value) in a single
+    read and decrypts only those, so its cost is O(range) rather than O(file). The last
+    cache_blocks blocks of each decryption are kept in a small LRU (cache_spans entries),
+    and short reads decrypt a whole span ahead, so sequential small reads mostly hit the cache.
+
+    source is a path or an open, seekable binary file (left open on close()). Without an
+    initialization_vector the first 16 bytes of the file are taken as the IV.
+    """
+
+    def __init__(self, cipher, source, initialization_vector=None, cache_blocks: int = 256, cache_spans: int = 4):
+        super().__init__()
+        self.cipher = cipher
+        self.block_size = cipher.block_size
+        self._owns_source = isinstance(source, (str, bytes, os.PathLike))
+        self._source = open(source, 'rb') if self._owns_source else source
+        try:
+            self._data_offset = self._source.seek(0, io.SEEK_CUR)
+            if initialization_vector is None:
+                initialization_vector = self._source.read(self.block_size)
+                self._data_offset += self.block_size
+            if len(initialization_vector) != self.block_size:
+                raise ValueError('Initialization vector must be 16 bytes')
+            self._iv = bytes(initialization_vector)
+            ciphertext_length = self._source.seek(0, io.SEEK_END) - self._data_offset
+            if ciphertext_length <= 0 or ciphertext_length % self.block_size:
+                raise ValueError('Ciphertext length is not a positive multiple of the block size')
+            self._num_blocks = ciphertext_length // self.block_size
+            self.cache_blocks = max(1, cache_blocks)
+            self.cache_spans = max(1, cache_spans)
+            # {first block index: decrypted bytes of a run of blocks}
+            self._cache = OrderedDict()
+            self._position = 0
+            last = self._decrypt_blocks(self._num_blocks - 1, self._num_blocks)
+            try:
+                self._length = len(cipher._remove_padding(last)) + ciphertext_length - self.block_size
+            except ValueError:
+                raise ValueError('Invalid padding (wrong key, IV or not a CBC file)') from None
+        except BaseException:
+            if self._owns_source:
+                self._source.close()
+            raise
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def __len__(self) -> int:
+        """ Plaintext length (the padding is not part of it) """
+        return self._length
+
+    def tell(self) -> int:
+        self._checkClosed()
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        self._checkClosed()
+        if whence == io.SEEK_SET:
+            base = 0
+        elif whence == io.SEEK_CUR:
+            base = self._position
+        elif whence == io.SEEK_END:
+            base = self._length
+        else:
+            raise ValueError('invalid whence')
+        if base + offset < 0:
+            raise ValueError('Negative seek position')
+        self._position = base + offset
+        return self._position
+
+    def readinto(self, buffer) -> int:
+        self._checkClosed()
+        view = memoryview(buffer).cast('B')
+        start = self._position
+        end = min(self._length, start + len(view))
+        if end <= start:
+            return 0
+        data = self._read_range(start, end)
+        view[:len(data)] = data
+        self._position = end
+        return len(data)
+
+    def readall(self) -> bytes:
+        self._checkClosed()
+        start = self._position
+        self._position = max(start, self._length)
+        return self._read_range(start, self._length) if start < self._length else b''
+
+    def close(self):
+        if not self.closed and self._owns_source:
+            self._source.close()
+        self._cache.clear()
+        super().close()
+
+    def _read_range(self, start: int, end: int) -> bytes:
+        """ Plaintext bytes [start, end), served from the cache when one span covers them """
+        block_size = self.block_size
+        first, last = start // block_size, (end - 1) // block_size + 1
+        for span_start, span in self._cache.items():
+            if span_start <= first and last <= span_start + len(span) // block_size:
+                self._cache.move_to_end(span_start)
+                offset = span_start * block_size
+                return span[start - offset: end - offset]
+        if last - first < self.cache_blocks:
+            # short read: decrypt a whole span ahead for the reads that follow
+            last = min(self._num_blocks, first + self.cache_blocks)
+        data = self._decrypt_blocks(first, last)
+        offset = first * block_size
+        return data[start - offset: end - offset]
+
+    def _decrypt_blocks(self, first: int, last: int) -> bytes:
+        """ Decrypt ciphertext blocks [first, last), reading only those and the block before them """
+        block_size = self.block_size
+        if first == 0:
+            self._source.seek(self._data_offset)
+            previous = self._iv
+        else:
+            self._source.seek(self._data_offset + (first - 1) * block_size)
+            previous = self._source.read(block_size)
+        ciphertext = self._source.read((last - first) * block_size)
+        if len(ciphertext) != (last - first) * block_size:
+            raise OSError('Encrypted file was truncated while reading')
+        plaintext = self.cipher._decrypt_cbc(ciphertext, previous)
+        # keep (the tail of) what was decrypted; a sequential read continues from there
+        cached_first = max(first, last - self.cache_blocks)
+        self._cache[cached_first] = plaintext[(cached_first - first) * block_size:]
+        self._cache.move_to_end(cached_first)
+        while len(self._cache) > self.cache_spans:
+            self._cache.popitem(last=False)
+        return plaintext
+
+
+def _iter_chunks(source, chunk_size: int, use_mmap: bool):
+    """ Yield successive chunks of an open binary file, either through a single
+    reused read buffer or by slicing a read-only memory map (pages are only
+    faulted in as each slice is taken) """
+    if use_mmap and os.fstat(source.fileno()).st_size > 0:
+        with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for start in range(0, len(mapped), chunk_size):
+                yield mapped[start: start + chunk_size]
+        return
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    while True:
+        read = source.readinto(buffer)
+        if not read:
+            return
+        yield view[:read]
+
+
+def _transform_file(stream, source_path, destination_path, chunk_size: int, use_mmap: bool) -> int:
+    """ Pump a file through an encryptor/decryptor, returning the number of bytes written """
+    # Keep chunks block aligned so update() never has to carry a partial block
+    chunk_size = max(stream.cipher.block_size, chunk_size - chunk_size % stream.cipher.block_size)
+    written = 0
+    with open(source_path, 'rb') as source, open(destination_path, 'wb') as destination:
+        for chunk in _iter_chunks(source, chunk_size, use_mmap):
+            out = stream.update(chunk)
+            destination.write(out)
+            written += len(out)
+        out = stream.finalize()
+        destination.write(out)
+        written += len(out)
+    return written
+
+
+def encrypt_file(cipher, source_path, destination_path, initialization_vector,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE, use_mmap: bool = False) -> int:
+    """ CBC encrypt source_path into destination_path chunk by chunk.
+    The output is exactly AES.encrypt of the whole file (the IV is not written). """
+    return _transform_file(CBCEncryptor(cipher, initialization_vector),
+                           source_path, destination_path, chunk_size, use_mmap)
+
+
+def decrypt_file(cipher, source_path, destination_path, initialization_vector,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE, use_mmap: bool = False) -> int:
+    """ CBC decrypt source_path into destination_path chunk by chunk """
+    return _transform_file(CBCDecryptor(cipher, initialization_vector),
+                           source_path, destination_path, chunk_size, use_mmap)
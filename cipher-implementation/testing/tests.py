@@ -1,9 +1,27 @@
-import csv
+import asyncio
+import contextlib
+import hashlib
+import hmac
+import io
 import os
 import json
+import tempfile
 import unittest
 from aescipher import AES
+from context import AESContext
+from keycache import KeyScheduleCache, DerivedKeyCache
+from ttable import equivalent_inverse_words, round_keys_to_words
+import numpy_engine
+import util
+import batch
+import benchmark
+import avs
+import profiling
+import cli
+import parallel as parallel_module
 INIT_VECTOR_FIXED_SIZE_BYTES = 16
+# The numpy engine is only exercised when numpy is installed
+AVAILABLE_ENGINES = [e for e in AES.ENGINES if e != 'numpy' or numpy_engine.np is not None]
 
 
 class TestAESCipher(unittest.TestCase):
@@ -47,63 +65,740 @@ class TestAESCipher(unittest.TestCase):
         self.check_multiple_random_ivs(cipher)
     #################### TEST KEY SIZES #########################
 
+    def test_mix_columns_tables(self):
+        # FIPS-197 / Wikipedia MixColumns test column db 13 53 45 -> 8e 4d a1 bc
+        cipher = AES(aes_key_size_bits=128)
+        state = [[0xdb, 0x13, 0x53, 0x45], [0xf2, 0x0a, 0x22, 0x5c], [1, 1, 1, 1], [0xd4, 0xd4, 0xd4, 0xd5]]
+        cipher.mix_columns(state)
+        self.assertEqual([[0x8e, 0x4d, 0xa1, 0xbc], [0x9f, 0xdc, 0x58, 0x9d], [1, 1, 1, 1], [0xd5, 0xd5, 0xd7, 0xd6]],
+                         state)
+        cipher._inverse_mix_columns(state)
+        self.assertEqual([[0xdb, 0x13, 0x53, 0x45], [0xf2, 0x0a, 0x22, 0x5c], [1, 1, 1, 1], [0xd4, 0xd4, 0xd4, 0xd5]],
+                         state)
 
-# class TestAVS(unittest.TestCase):
-#     def setUp(self):
-#         with open(os.path.join(os.path.dirname(__file__), 'aesavstestdata.csv')) as f:
-#             reader = csv.reader(f)
-#             next(reader)
-#             self.keysize_128_tests = [l for l in reader if l[0] == '128']
-#             self.keysize_192_tests = [l for l in reader if l[0] == '192']
-#             self.keysize_256_tests = [l for l in reader if l[0] == '256']
-
-#     def test_128bit_keysize(self):
-#         aes = AES(aes_key_size_bits=128)
-#         aes.set_master_key(b'0000000000000000')
-#         for t in self.keysize_128_tests:
-#             plaintextoriv, ct = t[1], t[2]
-#             iv, plaintext = plaintextoriv[16:], plaintextoriv[:16]
-#             plaintext = plaintext.encode('utf-8')
-#             iv = iv.encode('utf-8')
-#             ct = ct.encode('utf-8')
-#             ciphertext = aes.encrypt(
-#                 plaintext=plaintext,
-#                 initialization_vector=iv
-#             )
-#             self.assertEqual(
-#                 ct, ciphertext
-#             )
-
-#     def test_192bit_keysize(self):
-#         aes = AES(aes_key_size_bits=192)
-#         aes.set_master_key(b'000000000000000000000000')
-#         for t in self.keysize_192_tests:
-#             plaintextoriv, ct = t[1], t[2]
-#             iv, plaintext = plaintextoriv[16:], plaintextoriv[:16]
-#             plaintext = plaintext.encode('utf-8')
-#             iv = iv.encode('utf-8')
-#             ct = ct.encode('utf-8')
-#             ciphertext = aes.encrypt(
-#                 plaintext=plaintext,
-#                 initialization_vector=iv
-#             )
-#             self.assertEqual(
-#                 ct, ciphertext
-#             )
-
-#     def test_256bit_keysize(self):
-#         aes = AES(aes_key_size_bits=192)
-#         aes.set_master_key(b'00000000000000000000000000000000')
-#         for t in self.keysize_256_tests:
-#             plaintextoriv, ct = t[1], t[2]
-#             iv, plaintext = plaintextoriv[16:], plaintextoriv[:16]
-#             plaintext = plaintext.encode('utf-8')
-#             iv = iv.encode('utf-8')
-#             ct = ct.encode('utf-8')
-#             ciphertext = aes.encrypt(
-#                 plaintext=plaintext,
-#                 initialization_vector=iv
-#             )
-#             self.assertEqual(
-#                 ct, ciphertext
-#             )
+    def test_bad_padding_raises_value_error(self):
+        # fixed keys and data, so the wrong key and the corrupted block deterministically leave bad padding
+        init_vector = bytes(range(16))
+        cipher = AES(aes_key_size_bits=128, master_key=bytes(16), engine='ttable')
+        ciphertext = cipher.encrypt(b'attack at dawn, bring snacks', init_vector)
+        corrupted = ciphertext[:-1] + bytes([ciphertext[-1] ^ 1])
+        wrong_key = bytes([1]) * 16
+
+        def finish(decryptor, data):
+            return decryptor.update(data) + decryptor.finalize()
+
+        cases = {
+            'decrypt_bytes': lambda data, key: AES(128, master_key=key, engine='ttable').decrypt_bytes(data, init_vector),
+            'reference': lambda data, key: AES(128, master_key=key).decrypt_bytes(data, init_vector),
+            'decryptor': lambda data, key: finish(AES(128, master_key=key).decryptor(init_vector), data),
+            'decrypt_many': lambda data, key: batch.decrypt_many(AES(128, master_key=key), [(data, init_vector)]),
+            'context': lambda data, key: AESContext(key).decrypt(data, init_vector),
+        }
+        for name, decrypt in cases.items():
+            for label, data, key in (('wrong key', ciphertext, wrong_key), ('corrupted', corrupted, bytes(16))):
+                with self.subTest(path=name, case=label):
+                    with self.assertRaises(ValueError):
+                        decrypt(data, key)
+        for plaintext in (b'', bytes(16), bytes(15) + b'\x11', bytes(14) + b'\x01\x02'):
+            with self.subTest(plaintext=plaintext):
+                with self.assertRaises(ValueError):
+                    util.remove_padding(plaintext)
+        self.assertEqual(b'abc', util.remove_padding(b'abc' + bytes([13]) * 13))
+
+
+class TestTTableEngine(unittest.TestCase):
+    """ The T-table engine must match the reference engine byte for byte """
+
+    def test_blocks_match_reference(self):
+        for bits in (128, 192, 256):
+            with self.subTest(bits=bits):
+                key = os.urandom(bits // 8)
+                reference = AES(aes_key_size_bits=bits, master_key=key)
+                ttable = AES(aes_key_size_bits=bits, master_key=key, engine='ttable')
+                for _ in range(20):
+                    block = os.urandom(16)
+                    self.assertEqual(reference._encrypt_block(block), ttable._encrypt_block(block))
+                    self.assertEqual(reference.decrypt_block(block), ttable.decrypt_block(block))
+
+    def test_equivalent_inverse_schedule(self):
+        # FIPS-197 appendix C.1, decrypted through the equivalent inverse round keys
+        key = bytes(range(16))
+        reference = AES(aes_key_size_bits=128, master_key=key)
+        ciphertext = bytes.fromhex('69c4e0d86a7b0430d8cdb78070b4c55a')
+        self.assertEqual(bytes.fromhex('00112233445566778899aabbccddeeff'), reference.decrypt_block(ciphertext))
+        self.assertEqual(equivalent_inverse_words(round_keys_to_words(reference.round_keys), 10),
+                         round_keys_to_words(reference.inverse_round_keys))
+
+    def test_cbc_matches_reference(self):
+        with open(os.path.join(os.path.dirname(__file__), 'messages.json')) as f:
+            messages = json.load(f)['messages']
+        key = os.urandom(16)
+        reference = AES(aes_key_size_bits=128, master_key=key)
+        ttable = AES(aes_key_size_bits=128, master_key=key, engine='ttable')
+        init_vector = os.urandom(INIT_VECTOR_FIXED_SIZE_BYTES)
+        for i, m in enumerate(messages):
+            with self.subTest(i=i):
+                ciphertext = ttable.encrypt(m, init_vector)
+                self.assertEqual(reference.encrypt(m, init_vector), ciphertext)
+                self.assertEqual(m, ttable.decrypt(ciphertext, init_vector))
+
+
+@unittest.skipIf(numpy_engine.np is None, 'numpy is not installed')
+class TestNumpyBatchEngine(unittest.TestCase):
+    """ The vectorized batch engine must match the reference engine byte for byte """
+
+    def test_batches_match_reference(self):
+        for bits in (128, 192, 256):
+            with self.subTest(bits=bits):
+                key = os.urandom(bits // 8)
+                reference = AES(aes_key_size_bits=bits, master_key=key)
+                batch = AES(aes_key_size_bits=bits, master_key=key, engine='numpy')
+                data = os.urandom(16 * 50)
+                expected = b''.join(reference._encrypt_block(data[i: i + 16]) for i in range(0, len(data), 16))
+                self.assertEqual(expected, batch.engine.encrypt_ecb(data))
+                self.assertEqual(data, batch.engine.decrypt_ecb(expected))
+
+    def test_cbc_and_ctr_match_reference(self):
+        key = os.urandom(16)
+        reference = AES(aes_key_size_bits=128, master_key=key)
+        batch = AES(aes_key_size_bits=128, master_key=key, engine='numpy')
+        message = os.urandom(1000).hex()
+        init_vector = b'\xff' * 8 + os.urandom(8)
+        ciphertext = reference.encrypt(message, init_vector)
+        self.assertEqual(ciphertext, batch.encrypt(message, init_vector))
+        self.assertEqual(message, batch.decrypt(ciphertext, init_vector))
+        self.assertEqual(reference.encrypt_ctr(message, init_vector), batch.encrypt_ctr(message, init_vector))
+
+
+class TestCTRMode(unittest.TestCase):
+    """ Counter mode, serial and split across worker processes """
+
+    def test_sp800_38a_vector(self):
+        # NIST SP 800-38A F.5.1 CTR-AES128.Encrypt, first two blocks
+        key = bytes.fromhex('2b7e151628aed2a6abf7158809cf4f3c')
+        counter = bytes.fromhex('f0f1f2f3f4f5f6f7f8f9fafbfcfdfeff')
+        plaintext = bytes.fromhex('6bc1bee22e409f96e93d7e117393172aae2d8a571e03ac9c9eb76fac45af8e51')
+        expected = bytes.fromhex('874d6191b620e3261bef6864990db6ce9806f66b7970fdff8617187bb9fffdff')
+        for engine in AVAILABLE_ENGINES:
+            with self.subTest(engine=engine):
+                cipher = AES(aes_key_size_bits=128, master_key=key, engine=engine)
+                self.assertEqual(expected, cipher.encrypt_ctr(plaintext, counter))
+                self.assertEqual(plaintext, cipher.decrypt_ctr(expected, counter))
+
+    def test_parallel_matches_serial(self):
+        cipher = AES(aes_key_size_bits=256, engine='ttable')
+        data = os.urandom(20000 + 7)
+        # counter wraps around 2^128 inside the payload
+        init_vector = b'\xff' * 15 + b'\x00'
+        serial = cipher.encrypt_ctr(data, init_vector)
+        parallel = cipher.encrypt_ctr(data, init_vector, workers=3, min_segment_size=1024)
+        self.assertEqual(serial, parallel)
+        self.assertEqual(data, cipher.decrypt_ctr(parallel, init_vector, workers=2, min_segment_size=1024))
+
+    def test_empty_input(self):
+        # split_into_segments(0, ...) used to build a range with step 0
+        self.assertEqual([], parallel_module.split_into_segments(0, 16, 3))
+        cipher = AES(aes_key_size_bits=128, engine='ttable')
+        init_vector = os.urandom(INIT_VECTOR_FIXED_SIZE_BYTES)
+        for workers in (1, 3):
+            with self.subTest(workers=workers):
+                self.assertEqual(b'', cipher.encrypt_ctr(b'', init_vector, workers=workers))
+                self.assertEqual(b'', cipher.decrypt_ctr(b'', init_vector, workers=workers))
+
+
+class TestParallelCBCDecrypt(unittest.TestCase):
+    """ CBC decryption split into independent ranges across worker processes """
+
+    def test_parallel_matches_serial(self):
+        message = os.urandom(3000).hex()
+        init_vector = os.urandom(INIT_VECTOR_FIXED_SIZE_BYTES)
+        for engine in AVAILABLE_ENGINES:
+            with self.subTest(engine=engine):
+                cipher = AES(aes_key_size_bits=128, engine=engine)
+                ciphertext = cipher.encrypt(message, init_vector)
+                self.assertEqual(message, cipher.decrypt(ciphertext, init_vector, workers=3, min_segment_size=512))
+
+    def test_empty_message(self):
+        cipher = AES(aes_key_size_bits=128, engine='ttable')
+        init_vector = os.urandom(INIT_VECTOR_FIXED_SIZE_BYTES)
+        ciphertext = cipher.encrypt(b'', init_vector)
+        self.assertEqual('', cipher.decrypt(ciphertext, init_vector, workers=3, min_segment_size=16))
+
+
+class TestBatchAPI(unittest.TestCase):
+    """ encrypt_many / decrypt_many over (message, iv) pairs """
+
+    def setUp(self):
+        with open(os.path.join(os.path.dirname(__file__), 'messages.json')) as f:
+            messages = json.load(f)['messages']
+        self.pairs = [(m, os.urandom(INIT_VECTOR_FIXED_SIZE_BYTES)) for m in messages * 5]
+        self.pairs += [(b'', os.urandom(INIT_VECTOR_FIXED_SIZE_BYTES)), (os.urandom(48), bytes(16))]
+
+    def test_matches_per_message(self):
+        for engine in AVAILABLE_ENGINES:
+            with self.subTest(engine=engine):
+                cipher = AES(aes_key_size_bits=256, engine=engine)
+                ciphertexts = cipher.encrypt_many(self.pairs)
+                self.assertEqual([cipher.encrypt(m, iv) for m, iv in self.pairs], ciphertexts)
+                plaintexts = cipher.decrypt_many(zip(ciphertexts, (iv for _, iv in self.pairs)))
+                self.assertEqual([m.encode('utf-8') if isinstance(m, str) else m for m, _ in self.pairs], plaintexts)
+
+    def test_sharded_in_order(self):
+        cipher = AES(aes_key_size_bits=128, engine='ttable')
+        ciphertexts = cipher.encrypt_many(self.pairs, workers=3, min_shard_size=10)
+        self.assertEqual(cipher.encrypt_many(self.pairs), ciphertexts)
+
+    def test_multi_key_matches_per_key(self):
+        keys = [os.urandom(length) for length in (16, 24, 32) * 7]
+        records = [os.urandom(16 * (i % 3)) for i in range(len(keys))]
+        expected = []
+        for key, record in zip(keys, records):
+            cipher = AES(aes_key_size_bits=8 * len(key), master_key=key)
+            expected.append(b''.join(cipher._encrypt_block(record[i: i + 16]) for i in range(0, len(record), 16)))
+        with_numpy = batch.np
+        for np in {with_numpy, None}:
+            with self.subTest(numpy=np is not None):
+                batch.np = np
+                try:
+                    self.assertEqual(expected, AES.encrypt_multi_key(keys, records))
+                    self.assertEqual(records, AES.decrypt_multi_key(keys, expected))
+                finally:
+                    batch.np = with_numpy
+
+    @unittest.skipIf(numpy_engine.np is None, 'numpy is not installed')
+    def test_expand_keys_matches_key_scheduler(self):
+        for length in (16, 24, 32):
+            keys = [os.urandom(length) for _ in range(5)]
+            expanded = numpy_engine.expand_keys(keys)
+            for key, round_keys in zip(keys, expanded):
+                schedule = AES(aes_key_size_bits=8 * length, master_key=key).round_keys
+                self.assertEqual(bytes(b for round_key in schedule for column in round_key for b in column),
+                                 round_keys.tobytes())
+
+
+class TestGCMMode(unittest.TestCase):
+    """ AES-GCM against the test cases from the original GCM specification """
+    KEY = bytes.fromhex('feffe9928665731c6d6a8f9467308308')
+    PLAINTEXT = bytes.fromhex(
+        'd9313225f88406e5a55909c5aff5269a86a7a9531534f7da2e4c303d8a318a72'
+        '1c3c0c95956809532fcf0e2449a6b525b16aedf5aa0de657ba637b39')
+    ASSOCIATED_DATA = bytes.fromhex('feedfacedeadbeeffeedfacedeadbeefabaddad2')
+
+    def test_vectors(self):
+        cases = [
+            # (test case, key, iv, plaintext, associated data, ciphertext || tag)
+            (2, bytes(16), bytes(12), bytes(16), b'',
+             '0388dace60b6a392f328c2b971b2fe78ab6e47d42cec13bdf53a67b21257bddf'),
+            (4, self.KEY, bytes.fromhex('cafebabefacedbaddecaf888'), self.PLAINTEXT, self.ASSOCIATED_DATA,
+             '42831ec2217774244b7221b784d0d49ce3aa212f2c02a4e035c17e2329aca12e'
+             '21d514b25466931c7d8f6a5aac84aa051ba30b396a0aac973d58e091'
+             '5bc94fbc3221a5db94fae95ae7121a47'),
+            (6, self.KEY, bytes.fromhex(
+                '9313225df88406e555909c5aff5269aa6a7a9538534f7da1e4c303d2a318a728'
+                'c3c0c95156809539fcf0e2429a6b525416aedbf5a0de6a57a637b39b'),
+             self.PLAINTEXT, self.ASSOCIATED_DATA,
+             '8ce24998625615b603a033aca13fb894be9112a5c3a211a8ba262a3cca7e2ca7'
+             '01e4a9a4fba43c90ccdcb281d48c7c6fd62875d2aca417034c34aee5'
+             '619cc5aefffe0bfa462af43c1699d050'),
+        ]
+        for engine in AVAILABLE_ENGINES:
+            for case, key, init_vector, plaintext, associated_data, expected in cases:
+                with self.subTest(engine=engine, case=case):
+                    cipher = AES(aes_key_size_bits=128, master_key=key, engine=engine)
+                    sealed = cipher.encrypt_gcm(plaintext, init_vector, associated_data)
+                    self.assertEqual(expected, sealed.hex())
+                    self.assertEqual(plaintext, cipher.decrypt_gcm(sealed, init_vector, associated_data))
+
+    def test_tampering_is_detected(self):
+        cipher = AES(aes_key_size_bits=256, engine='ttable')
+        init_vector = os.urandom(12)
+        sealed = bytearray(cipher.encrypt_gcm(os.urandom(100), init_vector, b'header'))
+        with self.assertRaises(ValueError):
+            cipher.decrypt_gcm(bytes(sealed), init_vector, b'other header')
+        sealed[3] ^= 1
+        with self.assertRaises(ValueError):
+            cipher.decrypt_gcm(bytes(sealed), init_vector, b'header')
+
+    def test_truncated_tags(self):
+        cipher = AES(aes_key_size_bits=128, engine='ttable')
+        init_vector = os.urandom(12)
+        full = cipher.encrypt_gcm(b'message', init_vector)
+        for tag_size in (12, 13, 16):
+            with self.subTest(tag_size=tag_size):
+                sealed = cipher.encrypt_gcm(b'message', init_vector, tag_size=tag_size)
+                self.assertEqual(full[:len(b'message') + tag_size], sealed)
+                self.assertEqual(b'message', cipher.decrypt_gcm(sealed, init_vector, tag_size=tag_size))
+        with self.assertRaises(ValueError):
+            cipher.decrypt_gcm(full, init_vector, tag_size=12)
+
+    def test_rejects_bad_iv_and_tag_size(self):
+        cipher = AES(aes_key_size_bits=128, engine='ttable')
+        sealed = cipher.encrypt_gcm(b'message', bytes(12))
+        for iv, tag_size in ((b'', 16), (bytes(12), 11), (bytes(12), 17), (bytes(12), 0)):
+            with self.subTest(iv=iv, tag_size=tag_size):
+                with self.assertRaises(ValueError):
+                    cipher.decrypt_gcm(sealed, iv, tag_size=tag_size)
+                with self.assertRaises(ValueError):
+                    cipher.encrypt_gcm(b'message', iv, tag_size=tag_size)
+
+
+class TestPasswordEncryption(unittest.TestCase):
+    """ Password based encryption with the self describing header """
+
+    def test_round_trip_across_key_sizes(self):
+        for bits in (128, 192, 256):
+            with self.subTest(bits=bits):
+                sealed = AES(aes_key_size_bits=bits).encrypt_with_password('secret message', 'hunter2', workload=1000)
+                # key size comes from the header, not the decrypting cipher
+                self.assertEqual(b'secret message', AES(aes_key_size_bits=128).decrypt_with_password(sealed, 'hunter2'))
+
+    def test_wrong_password_and_tampering(self):
+        cipher = AES(aes_key_size_bits=128, engine='ttable')
+        sealed = bytearray(cipher.encrypt_with_password(b'data', 'right', workload=1000))
+        with self.assertRaises(ValueError):
+            cipher.decrypt_with_password(bytes(sealed), 'wrong')
+        sealed[-40] ^= 1
+        with self.assertRaises(ValueError):
+            cipher.decrypt_with_password(bytes(sealed), 'right')
+
+    def test_reused_salt_hits_cache(self):
+        cipher = AES(aes_key_size_bits=128)
+        cipher.derived_key_cache = DerivedKeyCache()
+        salt = os.urandom(16)
+        first = cipher.encrypt_with_password('a', 'pw', salt=salt, workload=1000)
+        second = cipher.encrypt_with_password('a', 'pw', salt=salt, workload=1000)
+        self.assertNotEqual(first, second)  # fresh IV per message
+        self.assertEqual(b'a', cipher.decrypt_with_password(second, 'pw'))
+        self.assertEqual({'hits': 2, 'misses': 1}, {k: cipher.derived_key_cache.stats()[k] for k in ('hits', 'misses')})
+
+    def test_cache_keys_hold_no_unsalted_password_hash(self):
+        cache = DerivedKeyCache()
+        salt = os.urandom(16)
+        derived = cache.get(b'pw', salt, 1000, 16, lambda: (bytes(16), bytes(16)))
+        self.assertEqual(('aes_key', 'hmac_key', 'schedule'), derived._fields)
+        (cache_key,) = cache._entries
+        self.assertNotIn(hashlib.sha256(b'pw').digest(), cache_key)
+        self.assertEqual((hmac.new(salt, b'pw', hashlib.sha256).digest(), 1000, 16), cache_key)
+        # the same password under another salt is a different entry
+        cache.get(b'pw', os.urandom(16), 1000, 16, lambda: (bytes(16), bytes(16)))
+        self.assertEqual(2, len(cache))
+
+
+class TestBufferAPI(unittest.TestCase):
+    """ encrypt_into / decrypt_into over arbitrary buffers and decrypt_bytes """
+
+    def test_into_matches_encrypt(self):
+        init_vector = os.urandom(INIT_VECTOR_FIXED_SIZE_BYTES)
+        for engine in AVAILABLE_ENGINES:
+            cipher = AES(aes_key_size_bits=128, engine=engine)
+            for length in (0, 5, 16, 70):
+                with self.subTest(engine=engine, length=length):
+                    message = bytearray(os.urandom(length))
+                    out = bytearray(length + 32)
+                    written = cipher.encrypt_into(memoryview(message), memoryview(out)[8:], init_vector)
+                    ciphertext = cipher.encrypt(bytes(message), init_vector)
+                    self.assertEqual(len(ciphertext), written)
+                    self.assertEqual(ciphertext, bytes(out[8: 8 + written]))
+
+                    plain = bytearray(written)
+                    size = cipher.decrypt_into(memoryview(out)[8: 8 + written], plain, init_vector)
+                    self.assertEqual(bytes(message), bytes(plain[:size]))
+                    self.assertEqual(bytes(message), cipher.decrypt_bytes(ciphertext, init_vector))
+
+    def test_output_buffer_checks(self):
+        cipher = AES(aes_key_size_bits=128, engine='ttable')
+        init_vector = os.urandom(INIT_VECTOR_FIXED_SIZE_BYTES)
+        with self.assertRaises(ValueError):
+            cipher.encrypt_into(b'x' * 16, bytearray(16), init_vector)
+        with self.assertRaises(TypeError):
+            cipher.encrypt_into(b'x', bytes(16), init_vector)
+
+
+class TestStreaming(unittest.TestCase):
+    """ Incremental encryptor / decryptor and the chunked file helpers """
+
+    def test_chunked_matches_one_shot(self):
+        cipher = AES(aes_key_size_bits=192, engine='ttable')
+        init_vector = os.urandom(INIT_VECTOR_FIXED_SIZE_BYTES)
+        for length in (0, 1, 15, 16, 17, 100, 1000):
+            with self.subTest(length=length):
+                message = os.urandom(length)
+                encryptor = cipher.encryptor(init_vector)
+                ciphertext = b''.join(encryptor.update(message[i: i + 7]) for i in range(0, length, 7))
+                ciphertext += encryptor.finalize()
+                self.assertEqual(cipher.encrypt(message, init_vector), ciphertext)
+
+                decryptor = cipher.decryptor(init_vector)
+                decrypted = b''.join(decryptor.update(ciphertext[i: i + 5]) for i in range(0, len(ciphertext), 5))
+                decrypted += decryptor.finalize()
+                self.assertEqual(message, decrypted)
+
+    def test_file_round_trip(self):
+        cipher = AES(aes_key_size_bits=128, engine='ttable')
+        init_vector = os.urandom(INIT_VECTOR_FIXED_SIZE_BYTES)
+        message = os.urandom(5000)
+        with tempfile.TemporaryDirectory() as tmp:
+            source, encrypted, decrypted = (os.path.join(tmp, name) for name in ('in', 'enc', 'dec'))
+            with open(source, 'wb') as f:
+                f.write(message)
+            for use_mmap in (False, True):
+                with self.subTest(use_mmap=use_mmap):
+                    cipher.encrypt_file(source, encrypted, init_vector, chunk_size=1000, use_mmap=use_mmap)
+                    with open(encrypted, 'rb') as f:
+                        self.assertEqual(cipher.encrypt(message, init_vector), f.read())
+                    cipher.decrypt_file(encrypted, decrypted, init_vector, chunk_size=512, use_mmap=use_mmap)
+                    with open(decrypted, 'rb') as f:
+                        self.assertEqual(message, f.read())
+
+    def test_random_access_reader(self):
+        cipher = AES(aes_key_size_bits=128, engine='ttable')
+        init_vector = os.urandom(INIT_VECTOR_FIXED_SIZE_BYTES)
+        message = os.urandom(20001)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'enc')
+            with open(path, 'wb') as f:
+                f.write(init_vector + cipher.encrypt(message, init_vector))
+            with cipher.open_encrypted(path, cache_blocks=8) as reader:
+                self.assertEqual(len(message), len(reader))
+                for start, size in ((0, 1), (15, 2), (9999, 40), (20000, 10), (19990, 100), (30000, 5)):
+                    with self.subTest(start=start, size=size):
+                        reader.seek(start)
+                        self.assertEqual(message[start: start + size], reader.read(size))
+                reader.seek(-17, io.SEEK_END)
+                self.assertEqual(message[-17:], reader.read())
+                reader.seek(0)
+                self.assertEqual(message, b''.join(iter(lambda: reader.read(100), b'')))
+                with self.assertRaises(ValueError):
+                    reader.seek(0, 3)
+                with self.assertRaises(ValueError):
+                    reader.seek(-1)
+
+    def test_random_access_rejects_bad_padding(self):
+        init_vector = bytes(range(16))
+        ciphertext = AES(aes_key_size_bits=128, master_key=bytes(16), engine='ttable').encrypt(b'x' * 100, init_vector)
+        for name, key, data in (('wrong key', bytes([1]) * 16, ciphertext),
+                                ('corrupted', bytes(16), ciphertext[:-1] + bytes([ciphertext[-1] ^ 1]))):
+            with self.subTest(case=name):
+                cipher = AES(aes_key_size_bits=128, master_key=key, engine='ttable')
+                with self.assertRaises(ValueError):
+                    cipher.open_encrypted(io.BytesIO(data), init_vector)
+
+    def test_random_access_decrypts_only_the_range(self):
+        cipher = AES(aes_key_size_bits=128, engine='ttable')
+        init_vector = os.urandom(INIT_VECTOR_FIXED_SIZE_BYTES)
+        message = os.urandom(64 * 1024)
+        decrypted = []
+        decrypt_cbc = cipher._decrypt_cbc
+        cipher._decrypt_cbc = lambda data, previous: decrypted.append(len(data)) or decrypt_cbc(data, previous)
+        reader = cipher.open_encrypted(io.BytesIO(cipher.encrypt(message, init_vector)), init_vector, cache_blocks=4)
+        reader.seek(40000)
+        self.assertEqual(message[40000: 40100], reader.read(100))
+        # the final block (to learn the padding) and the 7 blocks covering the range
+        self.assertEqual([16, 112], decrypted)
+        reader.seek(40100)
+        reader.read(10)
+        self.assertEqual(2, len(decrypted))
+
+
+class _BufferWriter:
+    """ Minimal stand-in for asyncio.StreamWriter collecting what is written """
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+
+def _stream_reader(data):
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+    return reader
+
+
+class TestAsyncStream(unittest.TestCase):
+    """ asyncio stream adapter """
+
+    def test_matches_one_shot(self):
+        cipher = AES(aes_key_size_bits=128, engine='ttable')
+        init_vector = os.urandom(INIT_VECTOR_FIXED_SIZE_BYTES)
+
+        async def round_trip(message, mode):
+            encrypted, decrypted = _BufferWriter(), _BufferWriter()
+            stats = await cipher.encrypt_stream(
+                _stream_reader(message), encrypted, init_vector, mode, chunk_size=64, max_in_flight=2)
+            await cipher.decrypt_stream(_stream_reader(bytes(encrypted.data)), decrypted, init_vector, mode,
+                                        chunk_size=64)
+            return bytes(encrypted.data), bytes(decrypted.data), stats
+
+        for mode in ('cbc', 'ctr'):
+            for length in (0, 15, 64, 200):
+                with self.subTest(mode=mode, length=length):
+                    message = os.urandom(length)
+                    ciphertext, plaintext, stats = asyncio.run(round_trip(message, mode))
+                    expected = cipher.encrypt(message, init_vector) if mode == 'cbc' \
+                        else cipher.encrypt_ctr(message, init_vector)
+                    self.assertEqual(expected, ciphertext)
+                    self.assertEqual(message, plaintext)
+                    self.assertEqual((length, len(ciphertext)), (stats.bytes_in, stats.bytes_out))
+
+    def test_bad_ciphertext_length(self):
+        cipher = AES(aes_key_size_bits=128)
+        with self.assertRaises(ValueError):
+            asyncio.run(cipher.decrypt_stream(_stream_reader(b'x' * 20), _BufferWriter(), bytes(16)))
+
+    def test_bad_padding(self):
+        cipher = AES(aes_key_size_bits=128, engine='ttable')
+        init_vector = os.urandom(INIT_VECTOR_FIXED_SIZE_BYTES)
+
+        async def decrypt(ciphertext):
+            return await cipher.decrypt_stream(_stream_reader(ciphertext), _BufferWriter(), init_vector,
+                                               chunk_size=16)
+
+        for last_byte in (0, 17):
+            with self.subTest(last_byte=last_byte):
+                # whole blocks encrypted without padding, so the final byte is not valid padding
+                with self.assertRaises(ValueError):
+                    asyncio.run(decrypt(cipher._encrypt_cbc(bytes(31) + bytes([last_byte]), init_vector)))
+
+
+class TestKeyScheduleCache(unittest.TestCase):
+    """ LRU cache of expanded key schedules """
+
+    def test_hits_misses_and_evictions(self):
+        cache = KeyScheduleCache(max_size=2)
+        key_a, key_b, key_c = (os.urandom(16) for _ in range(3))
+        schedule = cache.get(key_a, 10)
+        cache.get(key_b, 10)
+        self.assertIs(schedule, cache.get(key_a, 10))
+        cache.get(key_c, 10)  # evicts key_b, the least recently used
+        cache.get(key_a, 10)
+        self.assertEqual({'hits': 2, 'misses': 3, 'evictions': 1, 'size': 2, 'max_size': 2}, cache.stats())
+
+    def test_cached_schedule_matches_fresh_expansion(self):
+        key = os.urandom(32)
+        cached = AES(aes_key_size_bits=256, master_key=key)
+        uncached = AES(aes_key_size_bits=256)
+        uncached.key_schedule_cache = None
+        uncached.set_master_key(key)
+        self.assertEqual([[list(w) for w in rk] for rk in uncached.round_keys],
+                         [[list(w) for w in rk] for rk in cached.round_keys])
+        init_vector = os.urandom(INIT_VECTOR_FIXED_SIZE_BYTES)
+        self.assertEqual(uncached.encrypt('cache', init_vector), cached.encrypt('cache', init_vector))
+
+
+class TestAESContext(unittest.TestCase):
+    """ Slotted AESContext """
+
+    def test_matches_aes(self):
+        init_vector = os.urandom(INIT_VECTOR_FIXED_SIZE_BYTES)
+        for bits in (128, 192, 256):
+            key = os.urandom(bits // 8)
+            aes = AES(aes_key_size_bits=bits, master_key=key)
+            context = AESContext(key)
+            message = os.urandom(77)
+            ciphertext = context.encrypt(message, init_vector)
+            self.assertEqual(aes.encrypt(message, init_vector), ciphertext)
+            self.assertEqual(message, context.decrypt(ciphertext, init_vector))
+            self.assertEqual(aes.decrypt_bytes(ciphertext, init_vector), context.decrypt(ciphertext, init_vector))
+            self.assertEqual(ciphertext, AESContext(key, key_schedule_cache=None).encrypt(message, init_vector))
+
+    def test_compact(self):
+        context = AESContext.generate(256)
+        self.assertFalse(hasattr(context, '__dict__'))
+        with self.assertRaises(ValueError):
+            AESContext(b'short key')
+
+
+class TestProfiling(unittest.TestCase):
+    """ Opt-in per-stage profiling hooks """
+
+    def test_stage_and_message_counters(self):
+        cipher = AES(aes_key_size_bits=128)
+        init_vector = os.urandom(INIT_VECTOR_FIXED_SIZE_BYTES)
+        profiler = cipher.enable_profiling()
+        ciphertext = cipher.encrypt('hello world', init_vector)
+        self.assertEqual('hello world', cipher.decrypt(ciphertext, init_vector))
+        stats = profiler.as_dict()
+        stages = stats['stages'][128]
+        # one block each way; AddRoundKey runs 11 times in each direction
+        self.assertEqual((1, 10, 9, 22), (stages['_encrypt_block']['calls'], stages['_substitute_bytes']['calls'],
+                                          stages['mix_columns']['calls'], stages['_add_round_key']['calls']))
+        self.assertEqual({'messages': 1, 'blocks': 1, 'bytes': 11, 'padding_bytes': 5},
+                         stats['messages'][128]['encrypt'])
+        self.assertEqual(stats['messages'][128]['encrypt'], stats['messages'][128]['decrypt'])
+        self.assertIn('aes_message_padding_bytes_total{key_size="128",direction="encrypt"} 5',
+                      profiler.to_prometheus())
+
+    def test_table_engines_record_cbc_totals(self):
+        for engine in AVAILABLE_ENGINES:
+            with self.subTest(engine=engine):
+                cipher = AES(aes_key_size_bits=128, engine=engine)
+                init_vector = os.urandom(INIT_VECTOR_FIXED_SIZE_BYTES)
+                profiler = cipher.enable_profiling()
+                cipher.decrypt(cipher.encrypt('hello world' * 10, init_vector), init_vector)
+                stages = profiler.as_dict()['stages'][128]
+                self.assertEqual((1, 1), (stages['_encrypt_cbc']['calls'], stages['_decrypt_cbc']['calls']))
+                self.assertGreater(stages['_encrypt_cbc']['ns'], 0)
+
+    def test_disabled_leaves_class_methods(self):
+        cipher = AES(aes_key_size_bits=128)
+        cipher.enable_profiling()
+        cipher.disable_profiling()
+        self.assertFalse(set(profiling.STAGES) & set(vars(cipher)))
+        self.assertIsNone(cipher.profiler)
+
+
+class TestCLI(unittest.TestCase):
+    """ cli.py file encryptor """
+
+    def run_cli(self, *argv):
+        with contextlib.redirect_stderr(io.StringIO()):
+            return cli.main(list(argv))
+
+    def test_round_trip(self):
+        data = os.urandom(5000)
+        key = os.urandom(24).hex()
+        with tempfile.TemporaryDirectory() as tmp:
+            plain, encrypted, decrypted = (os.path.join(tmp, name) for name in ('in', 'out.aes', 'back'))
+            with open(plain, 'wb') as f:
+                f.write(data)
+            for mode in cli.MODES:
+                for workers, strategy in (('1', 'read'), ('2', 'mmap')):
+                    with self.subTest(mode=mode, workers=workers):
+                        self.assertEqual(0, self.run_cli('encrypt', '-i', plain, '-o', encrypted, '--key', key,
+                                                         '--mode', mode, '--workers', workers, '--io', strategy,
+                                                         '--chunk-size', '1K'))
+                        self.assertEqual(0, self.run_cli('decrypt', '-i', encrypted, '-o', decrypted, '--key', key,
+                                                         '--workers', workers, '--io', strategy,
+                                                         '--chunk-size', '100'))
+                        with open(decrypted, 'rb') as f:
+                            self.assertEqual(data, f.read())
+
+    def test_password_is_authenticated(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            plain, encrypted, decrypted = (os.path.join(tmp, name) for name in ('in', 'out.aes', 'back'))
+            with open(plain, 'wb') as f:
+                f.write(b'backup' * 100)
+            self.assertEqual(0, self.run_cli('encrypt', '-i', plain, '-o', encrypted, '--password', 'pw',
+                                             '--workload', '1000', '--mode', 'ctr', '--workers', '1'))
+            self.assertEqual(0, self.run_cli('decrypt', '-i', encrypted, '-o', decrypted, '--password', 'pw'))
+            self.assertEqual(1, self.run_cli('decrypt', '-i', encrypted, '-o', decrypted, '--password', 'wrong'))
+            # a failed decryption leaves an existing output file untouched and no temporary files behind
+            with open(decrypted, 'rb') as f:
+                self.assertEqual(b'backup' * 100, f.read())
+            self.assertEqual(['back', 'in', 'out.aes'], sorted(os.listdir(tmp)))
+
+    def test_argument_errors(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            plain, encrypted = os.path.join(tmp, 'in'), os.path.join(tmp, 'out.aes')
+            with open(plain, 'wb') as f:
+                f.write(b'data')
+            # a 10 byte key and a missing input file are reported, not raised
+            self.assertEqual(1, self.run_cli('encrypt', '-i', plain, '-o', encrypted, '--key', '00' * 10))
+            self.assertEqual(1, self.run_cli('encrypt', '-i', os.path.join(tmp, 'missing'), '-o', encrypted,
+                                             '--key', '00' * 16))
+            self.assertEqual(['in'], os.listdir(tmp))
+
+    def test_bad_padding_is_reported(self):
+        key = bytes(range(16))
+        with tempfile.TemporaryDirectory() as tmp:
+            plain, encrypted, decrypted = (os.path.join(tmp, name) for name in ('in', 'out.aes', 'back'))
+            with open(plain, 'wb') as f:
+                f.write(b'x' * 100)
+            with open(decrypted, 'wb') as f:
+                f.write(b'keep me')
+            self.assertEqual(0, self.run_cli('encrypt', '-i', plain, '-o', encrypted, '--key', key.hex(),
+                                             '--workers', '1'))
+            # replace the final block with one that decrypts to a zero padding byte
+            with open(encrypted, 'r+b') as f:
+                f.seek(-32, io.SEEK_END)
+                previous = f.read(16)
+                f.write(AES(aes_key_size_bits=128, master_key=key)._encrypt_cbc(bytes(16), previous))
+            stderr = io.StringIO()
+            with contextlib.redirect_stderr(stderr):
+                self.assertEqual(1, cli.main(['decrypt', '-i', encrypted, '-o', decrypted, '--key', key.hex()]))
+            self.assertIn('error: Invalid padding', stderr.getvalue())
+            with open(decrypted, 'rb') as f:
+                self.assertEqual(b'keep me', f.read())
+            self.assertEqual(['back', 'in', 'out.aes'], sorted(os.listdir(tmp)))
+
+    def test_tampered_input_writes_nothing(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            plain, encrypted = os.path.join(tmp, 'in'), os.path.join(tmp, 'out.aes')
+            with open(plain, 'wb') as f:
+                f.write(os.urandom(3000))
+            self.assertEqual(0, self.run_cli('encrypt', '-i', plain, '-o', encrypted, '--password', 'pw',
+                                             '--workload', '1000', '--workers', '1'))
+            with open(encrypted, 'r+b') as f:
+                f.seek(200)
+                byte = f.read(1)
+                f.seek(200)
+                f.write(bytes([byte[0] ^ 1]))
+            stdout = io.TextIOWrapper(io.BytesIO())
+            with contextlib.redirect_stdout(stdout):
+                self.assertEqual(1, self.run_cli('decrypt', '-i', encrypted, '--password', 'pw', '--chunk-size', '1K'))
+            # the MAC is checked before any plaintext reaches stdout
+            self.assertEqual(b'', stdout.buffer.getvalue())
+
+
+class TestBenchmarkHarness(unittest.TestCase):
+    """ Helpers behind benchmark.py """
+
+    def test_parse_size(self):
+        self.assertEqual([16, 1024, 64 * 1024 * 1024], [util.parse_size(s) for s in ('16', '1k', '64M')])
+
+    def test_compare_flags_only_regressions(self):
+        baseline = {'a': {'mb_per_s': 10.0, 'p50_s': 1}, 'b': {'keys_per_s': 100.0, 'p50_s': 1}}
+        results = {'a': {'mb_per_s': 9.0, 'p50_s': 1}, 'b': {'keys_per_s': 50.0, 'p50_s': 1}, 'c': {'p50_s': 1}}
+        regressions = benchmark.compare(results, baseline, tolerance=0.25)
+        self.assertEqual(['b'], [r[0] for r in regressions])
+
+    def test_uncached_aes_bypasses_the_schedule_cache(self):
+        cache = KeyScheduleCache()
+        previous, AES.key_schedule_cache = AES.key_schedule_cache, cache
+        try:
+            key = os.urandom(16)
+            aes = benchmark.uncached_aes(128, key, 'ttable')
+            self.assertEqual(0, len(cache))
+            self.assertIs(cache, AES.key_schedule_cache)
+            self.assertEqual(AES(aes_key_size_bits=128, master_key=key).round_keys, aes.round_keys)
+        finally:
+            AES.key_schedule_cache = previous
+
+    def test_missing_baseline_entries_are_reported(self):
+        baseline = {'a': {'mb_per_s': 10.0, 'p50_s': 1}}
+        results = {'a': {'mb_per_s': 10.0, 'p50_s': 1}, 'c': {'p50_s': 1}, 'd': {'p50_s': 1}}
+        self.assertEqual(['c', 'd'], benchmark.missing_from_baseline(results, baseline))
+
+
+class TestAVS(unittest.TestCase):
+    """ AESAVS known answer tests (appendices B - E) and Monte Carlo tests, see avs.py """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.vectors = avs.load_kat_vectors()
+
+    def test_known_answer_tests(self):
+        for suite in avs.KAT_SUITES:
+            for engine in AVAILABLE_ENGINES:
+                with self.subTest(suite=suite, engine=engine):
+                    self.assertTrue(self.vectors[suite])
+                    self.assertEqual([], avs.run_kat(engine, self.vectors[suite]))
+
+    def test_monte_carlo_known_answers(self):
+        # the first three published AES-128 encryption records of each MCT
+        for suite in avs.MCT_SUITES:
+            for engine in AVAILABLE_ENGINES:
+                with self.subTest(suite=suite, engine=engine):
+                    records = avs.run_mct(suite, engine, 128, encrypt=True, outer=3)
+                    self.assertEqual([], avs.check_mct_known_answers(suite, records))
+
+    def test_parallel_runner(self):
+        report = avs.run(avs.SUITES, AVAILABLE_ENGINES, outer=2, inner=10, workers=2)
+        self.assertEqual({suite: [] for suite in avs.SUITES},
+                         {suite: summary['failures'] for suite, summary in report.items()})
@@ -0,0 +1,203 @@
+"""
+T-table (32-bit word) implementation of the AES round function.
+
+Instead of keeping the state as a 4x4 list-of-lists and running SubBytes,
+ShiftRows, MixColumns and AddRoundKey one after another, the state is kept as
+four 32-bit column words. SubBytes, ShiftRows and MixColumns are folded into
+four lookup tables (Te0 - Te3 for encryption, Td0 - Td3 for decryption) so that
+each round is 16 table lookups and 16 xors.
+
+Reference: Section 4.2 of The Design of Rijndael (docs/JDA_VRI_Rijndael_2002.pdf)
+and Section 5.3.5 of FIPS-197 for the equivalent inverse cipher used by decryption.
+"""
+from array import array
+from struct import Struct
+from rijndael import SBOX as _SBOX_BYTES, INV_SBOX as _INV_SBOX_BYTES, MUL2, MUL3, MUL9, MUL11, MUL13, MUL14
+
+# A 16 byte block viewed as four big-endian 32-bit column words
+BLOCK = Struct('>4I')
+
+
+def _ror8(word: int) -> int:
+    """ Rotate a 32-bit word right by one byte """
+    return ((word >> 8) | (word << 24)) & 0xFFFFFFFF
+
+
+def _build_tables():
+    """ Build the encryption and decryption T-tables from the Rijndael S-boxes.
+    Te0[x] is the column (02.S[x], S[x], S[x], 03.S[x]), i.e. MixColumns applied to
+    a column holding S[x] in the first row; Te1 - Te3 are byte rotations of Te0 for
+    the other three rows. Td0 - Td3 are built the same way from the inverse S-box and
+    the InvMixColumns coefficients (0e, 09, 0d, 0b).
+    """
+    te0, td0 = [], []
+    for x in range(256):
+        s = _SBOX_BYTES[x]
+        te0.append((MUL2[s] << 24) | (s << 16) | (s << 8) | MUL3[s])
+        si = _INV_SBOX_BYTES[x]
+        td0.append((MUL14[si] << 24) | (MUL9[si] << 16) | (MUL13[si] << 8) | MUL11[si])
+    te1 = [_ror8(w) for w in te0]
+    te2 = [_ror8(w) for w in te1]
+    te3 = [_ror8(w) for w in te2]
+    td1 = [_ror8(w) for w in td0]
+    td2 = [_ror8(w) for w in td1]
+    td3 = [_ror8(w) for w in td2]
+    return (te0, te1, te2, te3), (td0, td1, td2, td3), list(_SBOX_BYTES), list(_INV_SBOX_BYTES)
+
+
+(TE0, TE1, TE2, TE3), (TD0, TD1, TD2, TD3), SBOX, INV_SBOX = _build_tables()
+
+
+def round_keys_to_words(round_keys) -> array:
+    """ Flatten the round keys produced by KeyScheduler.get_key_expansion
+    (a list of 4x4 byte matrices) into a flat array of 32-bit column words """
+    return array('I', [int.from_bytes(bytes(column), 'big') for round_key in round_keys for column in round_key])
+
+
+def inverse_mix_column_word(word: int) -> int:
+    """ Apply InvMixColumns to a single 32-bit column word.
+    Td tables include the inverse S-box, so substitute with the forward S-box first
+    to cancel it out. """
+    return (TD0[SBOX[word >> 24]] ^ TD1[SBOX[(word >> 16) & 0xFF]]
+            ^ TD2[SBOX[(word >> 8) & 0xFF]] ^ TD3[SBOX[word & 0xFF]])
+
+
+def equivalent_inverse_words(encryption_words, num_rounds: int) -> array:
+    """ Derive the decryption key schedule for the equivalent inverse cipher
+    (FIPS-197 section 5.3.5): round keys in reverse order with InvMixColumns applied
+    to every round key except the first and the last. """
+    decryption_words = array('I')
+    for r in range(num_rounds, -1, -1):
+        round_words = encryption_words[4 * r: 4 * (r + 1)]
+        if 0 < r < num_rounds:
+            round_words = [inverse_mix_column_word(w) for w in round_words]
+        decryption_words.extend(round_words)
+    return decryption_words
+
+
+class TTableEngine:
+    """ Block engine operating on four 32-bit column words per block.
+    Built from already expanded round keys so it can be dropped in wherever
+    AES._encrypt_block / AES.decrypt_block are used. The schedules are flat
+    array('I') objects and the class uses __slots__, so an engine is a small,
+    fixed size object; the lookup tables are module level and shared. """
+    __slots__ = ('num_rounds', 'encryption_words', 'decryption_words')
+
+    def __init__(self, round_keys, num_rounds: int, inverse_round_keys=None):
+        """ inverse_round_keys: the equivalent inverse schedule from
+        KeyScheduler.get_equivalent_inverse_key_expansion, derived here if not given """
+        self.num_rounds = num_rounds
+        self.encryption_words = round_keys_to_words(round_keys)
+        if inverse_round_keys is None:
+            self.decryption_words = equivalent_inverse_words(self.encryption_words, num_rounds)
+        else:
+            self.decryption_words = round_keys_to_words(inverse_round_keys)
+
+    def encrypt_words(self, s0: int, s1: int, s2: int, s3: int):
+        """ Encrypt a single block given (and returned) as four column words """
+        te0, te1, te2, te3, sbox = TE0, TE1, TE2, TE3, SBOX
+        rk = self.encryption_words
+        s0 ^= rk[0]
+        s1 ^= rk[1]
+        s2 ^= rk[2]
+        s3 ^= rk[3]
+        for k in range(4, 4 * self.num_rounds, 4):
+            t0 = te0[s0 >> 24] ^ te1[(s1 >> 16) & 0xFF] ^ te2[(s2 >> 8) & 0xFF] ^ te3[s3 & 0xFF] ^ rk[k]
+            t1 = te0[s1 >> 24] ^ te1[(s2 >> 16) & 0xFF] ^ te2[(s3 >> 8) & 0xFF] ^ te3[s0 & 0xFF] ^ rk[k + 1]
+            t2 = te0[s2 >> 24] ^ te1[(s3 >> 16) & 0xFF] ^ te2[(s0 >> 8) & 0xFF] ^ te3[s1 & 0xFF] ^ rk[k + 2]
+            s3 = te0[s3 >> 24] ^ te1[(s0 >> 16) & 0xFF] ^ te2[(s1 >> 8) & 0xFF] ^ te3[s2 & 0xFF] ^ rk[k + 3]
+            s0, s1, s2 = t0, t1, t2
+        # Final round has no MixColumns; plain S-box lookups with the row shift
+        return (
+            ((sbox[s0 >> 24] << 24) | (sbox[(s1 >> 16) & 0xFF] << 16)
+             | (sbox[(s2 >> 8) & 0xFF] << 8) | sbox[s3 & 0xFF]) ^ rk[-4],
+            ((sbox[s1 >> 24] << 24) | (sbox[(s2 >> 16) & 0xFF] << 16)
+             | (sbox[(s3 >> 8) & 0xFF] << 8) | sbox[s0 & 0xFF]) ^ rk[-3],
+            ((sbox[s2 >> 24] << 24) | (sbox[(s3 >> 16) & 0xFF] << 16)
+             | (sbox[(s0 >> 8) & 0xFF] << 8) | sbox[s1 & 0xFF]) ^ rk[-2],
+            ((sbox[s3 >> 24] << 24) | (sbox[(s0 >> 16) & 0xFF] << 16)
+             | (sbox[(s1 >> 8) & 0xFF] << 8) | sbox[s2 & 0xFF]) ^ rk[-1],
+        )
+
+    def decrypt_words(self, s0: int, s1: int, s2: int, s3: int):
+        """ Decrypt a single block given (and returned) as four column words,
+        using the equivalent inverse cipher so the round shape mirrors encryption """
+        td0, td1, td2, td3, inv_sbox = TD0, TD1, TD2, TD3, INV_SBOX
+        dk = self.decryption_words
+        s0 ^= dk[0]
+        s1 ^= dk[1]
+        s2 ^= dk[2]
+        s3 ^= dk[3]
+        for k in range(4, 4 * self.num_rounds, 4):
+            t0 = td0[s0 >> 24] ^ td1[(s3 >> 16) & 0xFF] ^ td2[(s2 >> 8) & 0xFF] ^ td3[s1 & 0xFF] ^ dk[k]
+            t1 = td0[s1 >> 24] ^ td1[(s0 >> 16) & 0xFF] ^ td2[(s3 >> 8) & 0xFF] ^ td3[s2 & 0xFF] ^ dk[k + 1]
+            t2 = td0[s2 >> 24] ^ td1[(s1 >> 16) & 0xFF] ^ td2[(s0 >> 8) & 0xFF] ^ td3[s3 & 0xFF] ^ dk[k + 2]
+            s3 = td0[s3 >> 24] ^ td1[(s2 >> 16) & 0xFF] ^ td2[(s1 >> 8) & 0xFF] ^ td3[s0 & 0xFF] ^ dk[k + 3]
+            s0, s1, s2 = t0, t1, t2
+        return (
+            ((inv_sbox[s0 >> 24] << 24) | (inv_sbox[(s3 >> 16) & 0xFF] << 16)
+             | (inv_sbox[(s2 >> 8) & 0xFF] << 8) | inv_sbox[s1 & 0xFF]) ^ dk[-4],
+            ((inv_sbox[s1 >> 24] << 24) | (inv_sbox[(s0 >> 16) & 0xFF] << 16)
+             | (inv_sbox[(s3 >> 8) & 0xFF] << 8) | inv_sbox[s2 & 0xFF]) ^ dk[-3],
+            ((inv_sbox[s2 >> 24] << 24) | (inv_sbox[(s1 >> 16) & 0xFF] << 16)
+             | (inv_sbox[(s0 >> 8) & 0xFF] << 8) | inv_sbox[s3 & 0xFF]) ^ dk[-2],
+            ((inv_sbox[s3 >> 24] << 24) | (inv_sbox[(s2 >> 16) & 0xFF] << 16)
+             | (inv_sbox[(s1 >> 8) & 0xFF] << 8) | inv_sbox[s0 & 0xFF]) ^ dk[-1],
+        )
+
+    def encrypt_block(self, plaintext) -> bytes:
+        """ Encrypt single 16 byte block (128 bits) of plaintext """
+        return BLOCK.pack(*self.encrypt_words(*BLOCK.unpack(plaintext)))
+
+    def decrypt_block(self, ciphertext) -> bytes:
+        """ Decrypt single 16 byte block (128 bits) of ciphertext """
+        return BLOCK.pack(*self.decrypt_words(*BLOCK.unpack(ciphertext)))
+
+    def encrypt_cbc(self, plaintext, initialization_vector) -> bytes:
+        """ CBC encrypt already padded plaintext, chaining on words instead of bytes
+        so no per-block state matrices or xor_bytes calls are needed """
+        out = bytearray(len(plaintext))
+        self.encrypt_cbc_into(plaintext, out, initialization_vector)
+        return bytes(out)
+
+    def encrypt_cbc_into(self, plaintext, out, initialization_vector):
+        """ CBC encrypt already padded plaintext (any buffer) into the writable buffer out.
+        Blocks are read and written in place with struct, so nothing is allocated per block. """
+        encrypt_words = self.encrypt_words
+        pack_into = BLOCK.pack_into
+        p0, p1, p2, p3 = BLOCK.unpack(initialization_vector)
+        offset = 0
+        for w0, w1, w2, w3 in BLOCK.iter_unpack(plaintext):
+            p0, p1, p2, p3 = encrypt_words(w0 ^ p0, w1 ^ p1, w2 ^ p2, w3 ^ p3)
+            pack_into(out, offset, p0, p1, p2, p3)
+            offset += 16
+
+    def decrypt_cbc(self, ciphertext, initialization_vector) -> bytes:
+        """ CBC decrypt ciphertext (a multiple of 16 bytes); padding is left in place """
+        out = bytearray(len(ciphertext))
+        self.decrypt_cbc_into(ciphertext, out, initialization_vector)
+        return bytes(out)
+
+    def decrypt_cbc_into(self, ciphertext, out, initialization_vector):
+        """ CBC decrypt ciphertext (any buffer) into the writable buffer out, padding left in place """
+        decrypt_words = self.decrypt_words
+        pack_into = BLOCK.pack_into
+        p0, p1, p2, p3 = BLOCK.unpack(initialization_vector)
+        offset = 0
+        for c0, c1, c2, c3 in BLOCK.iter_unpack(ciphertext):
+            d0, d1, d2, d3 = decrypt_words(c0, c1, c2, c3)
+            pack_into(out, offset, d0 ^ p0, d1 ^ p1, d2 ^ p2, d3 ^ p3)
+            p0, p1, p2, p3 = c0, c1, c2, c3
+            offset += 16
+
+    def ctr_keystream(self, initial_counter: int, num_blocks: int) -> bytes:
+        """ Encrypt num_blocks successive 128 bit counter blocks starting at initial_counter """
+        encrypt_words = self.encrypt_words
+        out = bytearray(16 * num_blocks)
+        counter = initial_counter
+        for offset in range(0, 16 * num_blocks, 16):
+            counter &= 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF
+            BLOCK.pack_into(out, offset, *encrypt_words(
+                counter >> 96, (counter >> 64) & 0xFFFFFFFF, (counter >> 32) & 0xFFFFFFFF, counter & 0xFFFFFFFF))
+            counter += 1
+        return bytes(out)
@@ -2,6 +2,31 @@ from functools import reduce
 from rijndael import Rijndael
 
 
+def add_padding(plaintext, block_size: int = 16):
+    """ Pad plaintext to a multiple of block_size; every padding byte holds the padding length """
+    padding_needed = block_size - (len(plaintext) % block_size)
+    return plaintext + bytes([padding_needed] * padding_needed)
+
+
+def remove_padding(plaintext, block_size: int = 16):
+    """ Strip padding added by add_padding, checking that every padding byte agrees.
+    Raises ValueError for anything add_padding could not have produced (usually a wrong key or IV) """
+    padding_added = plaintext[-1] if plaintext else 0
+    if not 0 < padding_added <= min(block_size, len(plaintext)) \
+            or plaintext[-padding_added:] != bytes([padding_added]) * padding_added:
+        raise ValueError('Invalid padding (wrong key, IV or corrupted data)')
+    return plaintext[:-padding_added]
+
+
+def parse_size(text: str) -> int:
+    """ '16' -> 16, '64K' -> 65536, '1M' -> 1048576 """
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    text = text.strip().upper()
+    if text and text[-1] in units:
+        return int(text[:-1]) * units[text[-1]]
+    return int(text)
+
+
 class Util(Rijndael):
 
     def xor_bytes(self, a, b):
@@ -12,29 +37,17 @@ class Util(Rijndael):
     def _add_padding(self, plaintext):
         """ Pad plaintext to a multiple of 128 bits / 16 bytes to align
         with fixed 16 byte block size """
-        padding_needed = self.block_size - (len(plaintext) % self.block_size)
-        # print(f'Adding {padding_needed} bytes of padding to plaintext')
-        padded = plaintext + bytes([padding_needed] * padding_needed)
         # Use the actual value of the needed padding as the padding
         # so that it can be removed easily by getting the last value
         # that tells how many bytes need to be removed
-        return padded
+        return add_padding(plaintext, self.block_size)
 
     def _remove_padding(self, plaintext):
         """
         Removes padding if any; since each padding byte actually IS the length
         of the total padding that was added to end, just get last value
         """
-        # print(f'Checking for padding on plaintext: {plaintext}')
-        padding_added = plaintext[-1]
-        # print(f'Padding added: {padding_added}')
-        assert padding_added > 0
-        message = plaintext[:-padding_added]
-        padding = plaintext[-padding_added:]
-        # print(f'Message={message}')
-        # print(f'Padding={padding}')
-        assert all(p == padding_added for p in padding)
-        return message
+        return remove_padding(plaintext, self.block_size)
     ## Padding ##
 
     ## Data transformations ##
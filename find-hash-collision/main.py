@@ -5,9 +5,56 @@ Find two messages (strings or numbers) whose hexdigest collides in the first fiv
 
 Example provided:
 sha256(bytes(1000).hexdigest())[:4] == sha256(bytes(344962).hexdigest())[:4]
+
+bytes(i) is i zero bytes, so hashing every i from scratch costs O(N^2) bytes over a range.
+With --incremental each range keeps one running sha256 of its current message instead:
+the next candidate is one update(b'\0') away, and each digest is taken from a .copy()
+so the running state can keep going. The running state for a range is built once by
+hashing zeros up to the range's start, which makes a whole scan O(N).
+--incremental runs on the process backend unless --backend threads is given.
+
+--backend processes hashes the same ranges in a process pool instead of 50 threads
+sharing self.hashes (the sha256 loops are CPU bound, so threads only add races).
+Every range fills a private prefix table in its worker, string ranges draw from
+their own seeded random.Random, and the driver merges the tables in range order,
+so each run gives exactly the same collisions.
+
+--compact swaps the dict of hex strings for a PrefixIndex: the 20 bit prefix is read
+straight from digest() as an int, a 2^20 slot head table points at the newest entry
+of each prefix and a chain array links the older ones, all in preallocated / flat
+arrays. Numbers are stored as themselves and random strings as (length, seed) pairs
+from which string_from_seed regenerates them, so an entry costs 16 bytes however
+long its string is, instead of a dict slot, a list and the string itself.
+
+Storing every hash stops scaling a few characters past 5. --rho K finds a pair of
+messages whose hexdigests share the first K characters (8 to 14 is practical) with
+parallel collision search over distinguished points (van Oorschot and Wiener): the
+messages are K character hex strings and each step is x -> sha256(x).hexdigest()[:K].
+Workers walk trails from random starting points until they hit a distinguished point
+(its last few bits are zero) and only report (start, distinguished point, length).
+Two trails ending at the same point have merged, and re-walking them from their
+starts finds the two different messages that map to the same value. Workers keep
+no tables at all; the driver keeps one small table of distinguished points.
+
+--checkpoint runs the process backend (plain or --compact) in small work units and
+survives crashes and Ctrl-C: every finished unit is appended to hashes.log as one
+length prefixed record (raw prefix / value / length arrays in compact mode, the
+unit's JSON table otherwise) so the table can be rebuilt without hashing again,
+every candidate that joins a collision is appended to collisions.jsonl as it is
+found, and checkpoint.json records each range's cursor
+(next number, or next string length plus the RNG state of that range's string
+stream), the order ranges are scheduled in and how far both logs are valid. Ctrl-C
+stops after the unit being merged and writes a final checkpoint. --resume truncates
+the logs to the checkpoint, replays hashes.log and carries on exactly where the
+run stopped, giving the same results as an uninterrupted run.
 """
+import argparse
+import signal
+import struct
+from array import array
 from hashlib import sha256
-from concurrent.futures import ThreadPoolExecutor, wait
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
 import time
 import json
 import os
@@ -15,11 +62,127 @@ from string import ascii_letters
 import random
 
 PYTHONHASHSEED = 175
+# Zeros fed to sha256 at a time when fast-forwarding a running state to a range's start
+ZERO_CHUNK = bytes(1 << 20)
+NUM_RANDOM_STRINGS = 5
+PREFIX_BITS = 20
+# Roughly how many hash steps one --rho job walks before reporting back
+RHO_STEPS_PER_JOB = 1 << 16
+# Work unit sizes and files for --checkpoint
+NUMBERS_PER_UNIT = 1000000
+LENGTHS_PER_UNIT = 5
+CHECKPOINT_SECONDS = 30
+CHECKPOINT_FILE = 'checkpoint.json'
+HASHES_LOG = 'hashes.log'
+COLLISIONS_LOG = 'collisions.jsonl'
+# hashes.log record header: payload length
+UNIT_HEADER = struct.Struct('<I')
+# Numbers scanned per range with --numbers (the default ranges are a 100 number sample per 10,000)
+MIN_RANGE_SIZE = 10000
+
+
+def prefix_of(digest):
+    """ First PREFIX_BITS bits of a digest as an int (the first 5 hex characters) """
+    return int.from_bytes(digest[:3], 'big') >> (24 - PREFIX_BITS)
+
+
+def string_from_seed(length, seed):
+    """ The random string stored in a PrefixIndex as (length, seed) """
+    return ''.join(random.Random(seed).choices(ascii_letters, k=length))
+
+
+class PrefixIndex:
+    """ Candidates bucketed by hash prefix in flat arrays.
+
+    head[prefix] is the newest entry with that prefix (-1 if none), chain[entry] the
+    entry before it in the same bucket. values[entry] is the number, or the seed of a
+    random string whose length is lengths[entry] (-1 for numbers). """
+
+    HEADER = struct.Struct('<4sBQ')
+    MAGIC = b'PIDX'
+
+    def __init__(self, prefix_bits=PREFIX_BITS):
+        self.prefix_bits = prefix_bits
+        self.head = array('i', [-1]) * (1 << prefix_bits)
+        self.chain = array('i')
+        self.values = array('q')
+        self.lengths = array('i')
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, prefix, value, length=-1):
+        entry = len(self.values)
+        self.chain.append(self.head[prefix])
+        self.values.append(value)
+        self.lengths.append(length)
+        self.head[prefix] = entry
+
+    def extend(self, prefixes, values, lengths, on_collision=None):
+        """ Add entries from parallel arrays (as returned by the index_* range workers), in order.
+        on_collision(hex prefix, candidates) is called with the candidates that just became part
+        of a collision: both entries when a bucket reaches two, afterwards only the new one. """
+        width = self.prefix_bits // 4
+        chain, head = self.chain, self.head
+        for prefix, value, length in zip(prefixes, values, lengths):
+            self.add(prefix, value, length)
+            if on_collision is None:
+                continue
+            entry = head[prefix]
+            older = chain[entry]
+            if older == -1:
+                continue
+            joined = [older, entry] if chain[older] == -1 else [entry]
+            on_collision(f'{prefix:0{width}x}', [self.candidate(e) for e in joined])
+
+    def candidate(self, entry):
+        length = self.lengths[entry]
+        return self.values[entry] if length < 0 else string_from_seed(length, self.values[entry])
+
+    def bucket(self, prefix):
+        """ Entries with this prefix, oldest first """
+        entries = []
+        entry = self.head[prefix]
+        while entry != -1:
+            entries.append(entry)
+            entry = self.chain[entry]
+        return entries[::-1]
+
+    def collisions(self):
+        """ (hex prefix, [candidates]) for every prefix shared by more than one entry """
+        head, chain = self.head, self.chain
+        width = self.prefix_bits // 4
+        for prefix in range(len(head)):
+            entry = head[prefix]
+            if entry != -1 and chain[entry] != -1:
+                yield f'{prefix:0{width}x}', [self.candidate(e) for e in self.bucket(prefix)]
+
+    def save(self, path):
+        """ Write the arrays in binary; reload with PrefixIndex.load """
+        with open(path, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.prefix_bits, len(self)))
+            for table in (self.head, self.chain, self.values, self.lengths):
+                table.tofile(f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            magic, prefix_bits, count = cls.HEADER.unpack(f.read(cls.HEADER.size))
+            if magic != cls.MAGIC:
+                raise ValueError(f'{path} is not a prefix index')
+            index = cls(prefix_bits)
+            index.head = array('i')
+            index.head.fromfile(f, 1 << prefix_bits)
+            for name in ('chain', 'values', 'lengths'):
+                getattr(index, name).fromfile(f, count)
+        return index
 
 
 class CollisionFinder:
-    def __init__(self):
+    def __init__(self, compact=False):
         self.hashes = {}
+        # with compact=True the process backend fills this instead of self.hashes
+        self.index = PrefixIndex() if compact else None
 
     def calculate_number_hashes(self, start, end_inclusive):
         print(
@@ -35,31 +198,66 @@ class CollisionFinder:
             else:
                 self.hashes[hash_first_five] = [i]
 
-    def work_numbers(self):
+    def zero_hash_state(self, length):
+        """ Running sha256 of bytes(length), built by hashing zeros in large chunks """
+        state = sha256()
+        while length > 0:
+            chunk = min(length, len(ZERO_CHUNK))
+            state.update(memoryview(ZERO_CHUNK)[:chunk])
+            length -= chunk
+        return state
+
+    def calculate_number_hashes_incremental(self, start, end_inclusive):
+        """ Same as calculate_number_hashes but with one running hash per range:
+        bytes(i + 1) is bytes(i) plus one more zero byte """
+        print(
+            f'Starting incremental hash calculations for range {start} to {end_inclusive}')
+        state = self.zero_hash_state(start)
+        for i in range(start, end_inclusive + 1):
+            hash_first_five = state.copy().hexdigest()[:5]
+            if hash_first_five in self.hashes:
+                self.hashes[hash_first_five].append(i)
+            else:
+                self.hashes[hash_first_five] = [i]
+            state.update(b'\0')
+
+    def number_ranges(self, limit=None, workers=None):
+        """ (start, end_inclusive) of each numeric range searched: a sample of 100 numbers
+        per 10,000 below a million, or with a limit every number below it, split into
+        enough contiguous ranges to keep the workers busy """
+        if limit is not None:
+            size = max(MIN_RANGE_SIZE, -(-limit // (8 * (workers or os.cpu_count() or 1))))
+            return [(start, min(limit, start + size) - 1) for start in range(0, limit, size)]
+        ranges = []
+        for i in range(0, 1000000, 10000):
+            if i == 0:
+                start = 0
+            else:
+                start = i + 1
+            end = i + 100
+            ranges.append((start, end))
+        return ranges
+
+    def work_numbers(self, incremental=False):
+        calculate = self.calculate_number_hashes_incremental if incremental else self.calculate_number_hashes
         futures = []
         with ThreadPoolExecutor(max_workers=50) as executor:
-            for i in range(0, 1000000, 10000):
-                if i == 0:
-                    start = 0
-                else:
-                    start = i + 1
-                end = i + 100
+            for start, end in self.number_ranges():
                 futures.append(
-                    executor.submit(self.calculate_number_hashes, start, end)
+                    executor.submit(calculate, start, end)
                 )
         for f in wait(futures).done:
             pass
 
-    def generate_random_string_of_length_n(self, n):
-        return ''.join(random.choices(ascii_letters, k=n))
+    def generate_random_string_of_length_n(self, n, rng=random):
+        return ''.join(rng.choices(ascii_letters, k=n))
 
-    def calculate_string_hashes(self, start, end_inclusive):
-        NUM_RANDOM_STRINGS = 5
+    def calculate_string_hashes(self, start, end_inclusive, rng=random):
         print(
             f'Starting string hash calculations for random strings between lengths {start} and {end_inclusive}')
         for i in range(start, end_inclusive + 1):
             for j in range(NUM_RANDOM_STRINGS):
-                rand_string = self.generate_random_string_of_length_n(i)
+                rand_string = self.generate_random_string_of_length_n(i, rng)
                 hash_first_five = sha256(
                     bytes(rand_string.encode('utf-8'))).hexdigest()[:5]
                 if hash_first_five in self.hashes:
@@ -67,37 +265,418 @@ class CollisionFinder:
                 else:
                     self.hashes[hash_first_five] = [rand_string]
 
+    def string_ranges(self):
+        """ (shortest, longest) random string length of each string range searched """
+        return [(length + 1, length + 25) for length in range(0, 1000, 25)]
+
     def work_strings(self):
         futures = []
         with ThreadPoolExecutor(max_workers=50) as executor:
-            for rand_message_length in range(0, 1000, 25):
-                start = rand_message_length + 1
-                end = rand_message_length + 25
+            for start, end in self.string_ranges():
                 futures.append(
                     executor.submit(self.calculate_string_hashes, start, end)
                 )
             for f in wait(futures).done:
                 pass
 
+    def merge_hashes(self, tables, on_collision=None):
+        """ Merge per-range prefix tables into self.hashes. Tables are merged in the order
+        given (range order), so the merged lists come out the same on every run.
+        on_collision(prefix, sources) is called with the sources that just became part of a
+        collision (the whole list when a prefix first becomes shared, afterwards the new ones). """
+        for table in tables:
+            for hash_first_five, sources in table.items():
+                if hash_first_five in self.hashes:
+                    merged = self.hashes[hash_first_five]
+                    before = len(merged)
+                    merged.extend(sources)
+                else:
+                    merged = self.hashes[hash_first_five] = list(sources)
+                    before = 0
+                if on_collision is not None and len(merged) > 1:
+                    on_collision(hash_first_five, merged if before < 2 else list(sources))
+
+    def merge_index(self, range_entries, on_collision=None):
+        """ Add the (prefixes, values, lengths) arrays of each range to self.index, in range order """
+        for prefixes, values, lengths in range_entries:
+            self.index.extend(prefixes, values, lengths, on_collision)
+
+    def work_numbers_processes(self, workers=None, incremental=False, limit=None):
+        """ Hash every numeric range in a process pool, one private table per range
+        (with compact=True, one private entry list per range, always incremental) """
+        ranges = self.number_ranges(limit, workers)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            if self.index is not None:
+                self.merge_index(executor.map(index_number_range, *zip(*ranges)))
+            else:
+                self.merge_hashes(executor.map(
+                    hash_number_range, *zip(*ranges), [incremental] * len(ranges), chunksize=4))
+
+    def work_strings_processes(self, workers=None):
+        """ Hash every string range in a process pool; each range has its own seeded RNG """
+        ranges = self.string_ranges()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            if self.index is not None:
+                self.merge_index(executor.map(index_string_range, *zip(*ranges)))
+            else:
+                self.merge_hashes(executor.map(hash_string_range, *zip(*ranges)))
+
+    ## Checkpointed runs ##
+    def checkpoint_shards(self, limit=None, workers=None):
+        """ {name: [kind, first, last]} for every numeric and string range, plus their initial
+        cursors: the next number or length, and the string stream's RNG state (None in compact
+        mode, where each string has its own seed) """
+        shards, cursors = {}, {}
+        for start, end in self.number_ranges(limit, workers):
+            shards[f'numbers:{start}'] = ['numbers', start, end]
+            cursors[f'numbers:{start}'] = [start, None]
+        for start, end in self.string_ranges():
+            rng_state = None if self.index is not None else random.Random(f'{PYTHONHASHSEED}:{start}').getstate()
+            shards[f'strings:{start}'] = ['strings', start, end]
+            cursors[f'strings:{start}'] = [start, rng_state]
+        return shards, cursors
+
+    def log_unit(self, hashes_log, result):
+        """ Append one finished unit to the hashes log as a length prefixed record """
+        if self.index is not None:
+            payload = b''.join(entries.tobytes() for entries in result)
+        else:
+            payload = json.dumps(result).encode()
+        hashes_log.write(UNIT_HEADER.pack(len(payload)))
+        hashes_log.write(payload)
+
+    def replay_hashes_log(self, path, size):
+        """ Rebuild the table from the records in the first size bytes of the hashes log """
+        with open(path, 'rb') as f:
+            while f.tell() < size:
+                length, = UNIT_HEADER.unpack(f.read(UNIT_HEADER.size))
+                payload = f.read(length)
+                if self.index is not None:
+                    count = length // 16
+                    prefixes, values, lengths = array('i'), array('q'), array('i')
+                    prefixes.frombytes(payload[:4 * count])
+                    values.frombytes(payload[4 * count:12 * count])
+                    lengths.frombytes(payload[12 * count:])
+                    self.merge_index([(prefixes, values, lengths)])
+                else:
+                    self.merge_hashes([json.loads(payload)])
+
+    def write_checkpoint(self, state):
+        """ Atomically replace the checkpoint file (the logs were flushed before) """
+        temporary = CHECKPOINT_FILE + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, CHECKPOINT_FILE)
+
+    def work_checkpointed(self, workers=None, incremental=False, limit=None, resume=False, max_units=None):
+        """ The process backend in small units with append-only logs and checkpoints (see the
+        module docstring). Returns True when every range is done, False when interrupted
+        (by Ctrl-C, or after max_units units in this session). """
+        config = {'compact': self.index is not None, 'incremental': incremental, 'numbers': limit}
+        if resume:
+            with open(CHECKPOINT_FILE) as f:
+                state = json.load(f)
+            if state['config'] != config:
+                raise ValueError(f'{CHECKPOINT_FILE} was written with different options: {state["config"]}')
+            for path, size in state['log_sizes'].items():
+                os.truncate(path, size)
+            self.replay_hashes_log(HASHES_LOG, state['log_sizes'][HASHES_LOG])
+            print(f'Resuming with {len(state["order"])} ranges left')
+        else:
+            shards, cursors = self.checkpoint_shards(limit, workers)
+            state = {'config': config, 'shards': shards, 'cursors': cursors, 'order': list(shards),
+                     'log_sizes': {HASHES_LOG: 0, COLLISIONS_LOG: 0}}
+            for path in (HASHES_LOG, COLLISIONS_LOG):
+                open(path, 'wb').close()
+            self.write_checkpoint(state)
+        shards, cursors = state['shards'], state['cursors']
+
+        def submit(executor, name):
+            kind, _, last = shards[name]
+            position, rng_state = cursors[name]
+            if kind == 'numbers':
+                end = min(last, position + NUMBERS_PER_UNIT - 1)
+                if self.index is not None:
+                    return end, executor.submit(index_number_range, position, end)
+                return end, executor.submit(hash_number_range, position, end, incremental)
+            end = min(last, position + LENGTHS_PER_UNIT - 1)
+            if self.index is not None:
+                return end, executor.submit(index_string_range, position, end)
+            return end, executor.submit(hash_string_unit, position, end, rng_state)
+
+        stop = []
+        previous_handler = signal.signal(signal.SIGINT, lambda signum, frame: stop.append(signum))
+        workers = workers or os.cpu_count() or 1
+        # ranges wait in a FIFO and each has at most one unit in flight, so units are merged in
+        # the same order on every run; the checkpoint keeps the in-flight ranges at the front
+        waiting = deque(state['order'])
+        pending = deque()
+        last_checkpoint = time.time()
+        units = 0
+        try:
+            with open(HASHES_LOG, 'ab') as hashes_log, open(COLLISIONS_LOG, 'ab') as collisions_log, \
+                    ProcessPoolExecutor(max_workers=workers, initializer=ignore_sigint) as executor:
+
+                def log_collision(prefix, candidates):
+                    for candidate in candidates:
+                        collisions_log.write(json.dumps({'prefix': prefix, 'candidate': candidate}).encode() + b'\n')
+
+                while (waiting or pending) and not stop:
+                    while waiting and len(pending) < 2 * workers:
+                        name = waiting.popleft()
+                        pending.append((name, *submit(executor, name)))
+                    name, end, future = pending.popleft()
+                    result = future.result()
+                    if self.index is not None:
+                        self.log_unit(hashes_log, result)
+                        self.merge_index([result], log_collision)
+                        rng_state = None
+                    else:
+                        table, rng_state = result if shards[name][0] == 'strings' else (result, None)
+                        self.log_unit(hashes_log, table)
+                        self.merge_hashes([table], log_collision)
+                    cursors[name] = [end + 1, rng_state]
+                    if end < shards[name][2]:
+                        waiting.append(name)
+                    units += 1
+                    if max_units is not None and units >= max_units:
+                        stop.append(None)
+                    if stop or not (waiting or pending) or time.time() - last_checkpoint >= CHECKPOINT_SECONDS:
+                        for log in (hashes_log, collisions_log):
+                            log.flush()
+                            os.fsync(log.fileno())
+                        state['order'] = [name for name, _, _ in pending] + list(waiting)
+                        state['log_sizes'] = {HASHES_LOG: hashes_log.tell(), COLLISIONS_LOG: collisions_log.tell()}
+                        self.write_checkpoint(state)
+                        last_checkpoint = time.time()
+                for _, _, future in pending:
+                    future.cancel()
+        finally:
+            signal.signal(signal.SIGINT, previous_handler)
+        if stop:
+            print(f'Interrupted; state saved to {CHECKPOINT_FILE}, continue with --resume')
+            return False
+        return True
+
+    def find_prefix_collision(self, hex_chars, workers=None, dp_bits=None, seed=PYTHONHASHSEED):
+        """ Find two different messages whose sha256 hexdigests share the first hex_chars
+        characters, with parallel distinguished point search. The messages found depend only
+        on hex_chars, dp_bits and seed (jobs are seeded by number and read back in order). """
+        if not 1 <= hex_chars <= 64:
+            raise ValueError('hex_chars must be between 1 and 64')
+        if dp_bits is None:
+            # about 2^14 distinguished points over the expected 2^(2 * hex_chars) steps
+            dp_bits = min(4 * hex_chars - 1, max(2, 2 * hex_chars - 14))
+        trails_per_job = max(1, RHO_STEPS_PER_JOB >> dp_bits)
+        # trails this much longer than expected are probably stuck in a cycle
+        max_length = 20 << dp_bits
+        workers = workers or os.cpu_count() or 1
+        print(f'Searching for a {hex_chars} character prefix collision with {workers} workers '
+              f'({dp_bits} distinguished point bits)')
+        distinguished_points = {}
+        steps = 0
+        job = 0
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            try:
+                while True:
+                    while len(pending) < 2 * workers:
+                        pending.append(executor.submit(
+                            walk_trails, hex_chars, dp_bits, f'{seed}:{hex_chars}:{job}', trails_per_job, max_length))
+                        job += 1
+                    trails, job_steps = pending.popleft().result()
+                    steps += job_steps
+                    for start, point, length in trails:
+                        if point not in distinguished_points:
+                            distinguished_points[point] = (start, length)
+                            continue
+                        pair = locate_collision(distinguished_points[point], (start, length), hex_chars)
+                        if pair is not None:
+                            print(f'Found after {steps} hash steps and {len(distinguished_points)} '
+                                  f'distinguished points')
+                            return pair
+            finally:
+                for future in pending:
+                    future.cancel()
+
     def save_hashes(self):
         print('Saving hashes')
+        if self.index is not None:
+            self.index.save('hashes.idx')
+            return
         with open('hashes.json', 'w') as f:
             json.dump(self.hashes, f)
 
     def get_partial_collisions(self):
+        if self.index is not None:
+            return list(self.index.collisions())
         return [(hash_collided, src) for hash_collided, src in self.hashes.items() if len(src) > 1]
 
 
-if __name__ == "__main__":
+def hash_number_range(start, end_inclusive, incremental=False):
+    """ Process pool worker: prefix table of one numeric range """
+    finder = CollisionFinder()
+    if incremental:
+        finder.calculate_number_hashes_incremental(start, end_inclusive)
+    else:
+        finder.calculate_number_hashes(start, end_inclusive)
+    return finder.hashes
+
+
+def hash_string_range(start, end_inclusive):
+    """ Process pool worker: prefix table of one string range, drawing its strings from an
+    RNG seeded by the range so the same strings come out on every run """
     finder = CollisionFinder()
-    start = time.time()
-    finder.work_numbers()
-    end = time.time()
-    print(f'Elapsed time for numeric hash calculations: {end - start} seconds')
-    start = time.time()
-    finder.work_strings()
-    end = time.time()
-    print(f'Elapsed time for string hash calculations: {end - start} seconds')
+    finder.calculate_string_hashes(start, end_inclusive, random.Random(f'{PYTHONHASHSEED}:{start}'))
+    return finder.hashes
+
+
+def hash_string_unit(start, end_inclusive, rng_state):
+    """ Process pool worker for --checkpoint: continue a string range's RNG stream from
+    rng_state over lengths start to end_inclusive; returns (prefix table, new RNG state) """
+    finder = CollisionFinder()
+    rng = random.Random()
+    rng.setstate((rng_state[0], tuple(rng_state[1]), rng_state[2]))
+    finder.calculate_string_hashes(start, end_inclusive, rng)
+    return finder.hashes, rng.getstate()
+
+
+def ignore_sigint():
+    """ Pool initializer: Ctrl-C is handled by the driver, which stops after the current unit """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def index_number_range(start, end_inclusive):
+    """ Process pool worker for compact mode: (prefixes, numbers, lengths) of one numeric
+    range, hashed incrementally """
+    prefixes, values = array('i'), array('q')
+    state = CollisionFinder().zero_hash_state(start)
+    for i in range(start, end_inclusive + 1):
+        prefixes.append(prefix_of(state.copy().digest()))
+        values.append(i)
+        state.update(b'\0')
+    return prefixes, values, array('i', [-1]) * len(values)
+
+
+def index_string_range(start, end_inclusive):
+    """ Process pool worker for compact mode: (prefixes, seeds, lengths) of one string range.
+    Every string has its own seed, so it can be regenerated from (length, seed) alone. """
+    prefixes, seeds, lengths = array('i'), array('q'), array('i')
+    for length in range(start, end_inclusive + 1):
+        for j in range(NUM_RANDOM_STRINGS):
+            seed = (PYTHONHASHSEED << 32) | (length * NUM_RANDOM_STRINGS + j)
+            prefixes.append(prefix_of(sha256(string_from_seed(length, seed).encode('utf-8')).digest()))
+            seeds.append(seed)
+            lengths.append(length)
+    return prefixes, seeds, lengths
+
+
+def rho_step(message, hex_chars):
+    """ The walk's next message: the first hex_chars characters of its hexdigest """
+    return sha256(message).hexdigest()[:hex_chars].encode('ascii')
+
+
+def walk_trails(hex_chars, dp_bits, job_seed, count, max_length):
+    """ Process pool worker for --rho: walk count trails from random starting points to a
+    distinguished point. Returns ([(start, distinguished point, length)], hash steps taken);
+    trails longer than max_length are dropped. Memory use is constant. """
+    rng = random.Random(job_seed)
+    mask = (1 << dp_bits) - 1
+    trails = []
+    steps = 0
+    for _ in range(count):
+        start = f'{rng.getrandbits(4 * hex_chars):0{hex_chars}x}'.encode('ascii')
+        point = start
+        for length in range(1, max_length + 1):
+            point = rho_step(point, hex_chars)
+            if int(point, 16) & mask == 0:
+                trails.append((start, point, length))
+                break
+        steps += length
+    return trails, steps
+
+
+def locate_collision(trail_a, trail_b, hex_chars):
+    """ Re-walk two (start, length) trails that end at the same distinguished point and return
+    the two different messages where they merge, or None if one start lies on the other trail """
+    (a, length_a), (b, length_b) = sorted((trail_a, trail_b), key=lambda trail: -trail[1])
+    for _ in range(length_a - length_b):
+        a = rho_step(a, hex_chars)
+    if a == b:
+        return None
+    while True:
+        next_a, next_b = rho_step(a, hex_chars), rho_step(b, hex_chars)
+        if next_a == next_b:
+            return a, b
+        a, b = next_a, next_b
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Find partial sha256 collisions')
+    parser.add_argument('--incremental', action='store_true',
+                        help='hash the numeric ranges with running sha256 states (O(N) instead of O(N^2) bytes)')
+    parser.add_argument('--backend', choices=('threads', 'processes'), default=None,
+                        help='threads share one table (racy, results vary between runs); processes merge '
+                             'private tables deterministically (default: processes with --incremental '
+                             'or --compact, otherwise threads)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes for --backend processes (default: one per core)')
+    parser.add_argument('--compact', action='store_true',
+                        help='store candidates in a compact prefix index (hashes.idx) instead of hashes.json; '
+                             'implies --backend processes and --incremental')
+    parser.add_argument('--numbers', type=int, default=None,
+                        help='with --compact, scan every number below this instead of the default sample')
+    parser.add_argument('--rho', type=int, default=None, metavar='K',
+                        help='only search for one pair of messages colliding in the first K hex characters, '
+                             'with parallel distinguished point search (no hash tables)')
+    parser.add_argument('--dp-bits', type=int, default=None,
+                        help='distinguished point bits for --rho (default: chosen from K)')
+    parser.add_argument('--checkpoint', action='store_true',
+                        help=f'run the process backend in small units, logging to {HASHES_LOG} and '
+                             f'{COLLISIONS_LOG} and checkpointing to {CHECKPOINT_FILE}')
+    parser.add_argument('--resume', action='store_true',
+                        help=f'continue the run recorded in {CHECKPOINT_FILE} (implies --checkpoint)')
+    args = parser.parse_args()
+    if args.rho is not None:
+        start = time.time()
+        a, b = CollisionFinder().find_prefix_collision(args.rho, args.workers, args.dp_bits)
+        print(f'{a.decode()} -> {sha256(a).hexdigest()}')
+        print(f'{b.decode()} -> {sha256(b).hexdigest()}')
+        print(f'Elapsed time for the {args.rho} character prefix collision: {time.time() - start} seconds')
+        raise SystemExit(0)
+    if args.compact:
+        args.backend = 'processes'
+    elif args.numbers is not None:
+        parser.error('--numbers requires --compact')
+    if args.backend is None:
+        args.backend = 'processes' if args.incremental else 'threads'
+    elif args.backend == 'threads' and args.incremental:
+        print('Warning: --backend threads shares one racy table, so collision counts vary between runs')
+
+    finder = CollisionFinder(compact=args.compact)
+    if args.checkpoint or args.resume:
+        start = time.time()
+        if not finder.work_checkpointed(args.workers, args.incremental, args.numbers, args.resume):
+            raise SystemExit(130)
+        end = time.time()
+        print(f'Elapsed time for checkpointed hash calculations: {end - start} seconds')
+    else:
+        start = time.time()
+        if args.backend == 'processes':
+            finder.work_numbers_processes(args.workers, incremental=args.incremental, limit=args.numbers)
+        else:
+            finder.work_numbers(incremental=args.incremental)
+        end = time.time()
+        print(f'Elapsed time for numeric hash calculations: {end - start} seconds')
+        start = time.time()
+        if args.backend == 'processes':
+            finder.work_strings_processes(args.workers)
+        else:
+            finder.work_strings()
+        end = time.time()
+        print(f'Elapsed time for string hash calculations: {end - start} seconds')
 
     print('Saving hashes')
     finder.save_hashes()
@@ -0,0 +1,205 @@
+import json
+import os
+import tempfile
+import unittest
+
+import main
+from hashlib import sha256
+from main import CollisionFinder, PrefixIndex, locate_collision, prefix_of, rho_step, string_from_seed
+
+
+class InTemporaryDirectory(unittest.TestCase):
+    """ main.py writes its logs and tables to the working directory """
+
+    def setUp(self):
+        self.previous_directory = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        os.chdir(self.directory.name)
+
+    def tearDown(self):
+        os.chdir(self.previous_directory)
+        self.directory.cleanup()
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+
+class TestIncrementalHashes(unittest.TestCase):
+    def check_range(self, start, end_inclusive):
+        incremental = main.hash_number_range(start, end_inclusive, incremental=True)
+        self.assertEqual(incremental, main.hash_number_range(start, end_inclusive))
+        self.assertEqual(incremental, main.hash_number_range(start, end_inclusive, incremental=True))
+        expected = {}
+        for i in range(start, end_inclusive + 1):
+            expected.setdefault(sha256(bytes(i)).hexdigest()[:5], []).append(i)
+        self.assertEqual(incremental, expected)
+
+    def test_digit_boundary(self):
+        self.check_range(95, 105)
+
+    def test_zero_chunk_boundary(self):
+        self.check_range(len(main.ZERO_CHUNK) - 3, len(main.ZERO_CHUNK) + 3)
+
+
+class TestPrefixIndex(InTemporaryDirectory):
+    def make_index(self):
+        index = PrefixIndex()
+        index.add(0x12345, 7)
+        index.add(0xabcde, 11, 30)
+        index.add(0x12345, 9)
+        index.add(0x12345, 3, 12)
+        index.add(0x00001, 5)
+        return index
+
+    def test_add_and_bucket(self):
+        index = self.make_index()
+        self.assertEqual(len(index), 5)
+        # buckets are chained newest first but read back oldest first
+        self.assertEqual(index.bucket(0x12345), [0, 2, 3])
+        self.assertEqual(index.bucket(0xabcde), [1])
+        self.assertEqual(index.bucket(0x54321), [])
+        self.assertEqual([index.candidate(e) for e in index.bucket(0x12345)], [7, 9, string_from_seed(12, 3)])
+
+    def test_collisions(self):
+        index = self.make_index()
+        self.assertEqual(list(index.collisions()), [('12345', [7, 9, string_from_seed(12, 3)])])
+
+    def test_extend_reports_new_members(self):
+        index = PrefixIndex()
+        reported = []
+        index.extend([1, 2, 1, 1, 2], [10, 20, 30, 40, 50], [-1] * 5,
+                     lambda prefix, candidates: reported.append((prefix, candidates)))
+        self.assertEqual(reported, [('00001', [10, 30]), ('00001', [40]), ('00002', [20, 50])])
+
+    def test_save_load_round_trip(self):
+        index = self.make_index()
+        index.save('hashes.idx')
+        loaded = PrefixIndex.load('hashes.idx')
+        self.assertEqual(loaded.prefix_bits, index.prefix_bits)
+        for name in ('head', 'chain', 'values', 'lengths'):
+            self.assertEqual(getattr(loaded, name), getattr(index, name))
+        self.assertEqual(list(loaded.collisions()), list(index.collisions()))
+
+    def test_load_rejects_other_files(self):
+        with open('hashes.idx', 'wb') as f:
+            f.write(b'\0' * 64)
+        with self.assertRaises(ValueError):
+            PrefixIndex.load('hashes.idx')
+
+    def test_string_from_seed(self):
+        text = string_from_seed(40, 123456789)
+        self.assertEqual(len(text), 40)
+        self.assertEqual(string_from_seed(40, 123456789), text)
+        self.assertNotEqual(string_from_seed(40, 123456790), text)
+
+    def test_indexed_strings_regenerate(self):
+        prefixes, values, lengths = main.index_string_range(1, 5)
+        index = PrefixIndex()
+        index.extend(prefixes, values, lengths)
+        for entry, prefix in enumerate(prefixes):
+            text = index.candidate(entry)
+            self.assertEqual(len(text), lengths[entry])
+            self.assertEqual(prefix_of(sha256(text.encode()).digest()), prefix)
+
+
+class TestRho(unittest.TestCase):
+    def test_small_prefix_collision(self):
+        a, b = CollisionFinder().find_prefix_collision(8, workers=2)
+        self.assertNotEqual(a, b)
+        self.assertEqual(sha256(a).hexdigest()[:8], sha256(b).hexdigest()[:8])
+
+    def test_rejects_bad_prefix_length(self):
+        with self.assertRaises(ValueError):
+            CollisionFinder().find_prefix_collision(0)
+
+    def merging_trails(self, hex_chars=4):
+        """ Two trails from different starts whose walks first meet at a known point. Returns
+        the (start, length) trails, ending a few steps past the merge, and the two messages
+        that step onto the merge point. """
+        visited = {}
+        b = b'0000'
+        for steps in range(5000):
+            following = rho_step(b, hex_chars)
+            visited.setdefault(following, (steps + 1, b))
+            b = following
+        for seed in range(1, 100):
+            a = f'{seed:04x}'.encode('ascii')
+            if a in visited:
+                continue
+            for steps in range(1, 5000):
+                following = rho_step(a, hex_chars)
+                if following in visited:
+                    length_b, previous_b = visited[following]
+                    return (f'{seed:04x}'.encode('ascii'), steps + 3), (b'0000', length_b + 3), {a, previous_b}
+                a = following
+        self.fail('no merging trails found')
+
+    def test_locate_collision(self):
+        trail_a, trail_b, merge = self.merging_trails()
+        self.assertNotEqual(trail_a[1], trail_b[1])
+        for first, second in ((trail_a, trail_b), (trail_b, trail_a)):
+            a, b = locate_collision(first, second, 4)
+            self.assertEqual({a, b}, merge)
+            self.assertEqual(rho_step(a, 4), rho_step(b, 4))
+
+    def test_locate_collision_on_same_trail(self):
+        start = b'beef'
+        self.assertIsNone(locate_collision((start, 20), (rho_step(start, 4), 19), 4))
+
+
+class TestProcessBackend(InTemporaryDirectory):
+    def hashes_json(self, workers):
+        finder = CollisionFinder()
+        finder.work_numbers_processes(workers, incremental=True, limit=200000)
+        finder.work_strings_processes(workers)
+        finder.save_hashes()
+        return self.read('hashes.json')
+
+    def test_worker_count_does_not_change_output(self):
+        single = self.hashes_json(1)
+        self.assertEqual(self.hashes_json(3), single)
+
+
+class TestCheckpointResume(InTemporaryDirectory):
+    def run_checkpointed(self, compact, interrupt_after=None):
+        """ One uninterrupted run, or a run stopped after interrupt_after units and then
+        resumed (twice, to also resume a resumed run). Returns the logs and collisions. """
+        finder = CollisionFinder(compact=compact)
+        if interrupt_after is None:
+            self.assertTrue(finder.work_checkpointed(2, incremental=True, limit=40000))
+        else:
+            self.assertFalse(finder.work_checkpointed(2, incremental=True, limit=40000, max_units=interrupt_after))
+            finder = CollisionFinder(compact=compact)
+            self.assertFalse(finder.work_checkpointed(2, incremental=True, limit=40000, resume=True,
+                                                      max_units=interrupt_after))
+            finder = CollisionFinder(compact=compact)
+            self.assertTrue(finder.work_checkpointed(2, incremental=True, limit=40000, resume=True))
+        return (self.read(main.HASHES_LOG), self.read(main.COLLISIONS_LOG),
+                finder.get_partial_collisions())
+
+    def check_resume(self, compact):
+        uninterrupted = self.run_checkpointed(compact)
+        resumed = self.run_checkpointed(compact, interrupt_after=7)
+        self.assertEqual(resumed, uninterrupted)
+        self.assertTrue(uninterrupted[2])
+
+    def test_resume_compact(self):
+        self.check_resume(compact=True)
+
+    def test_resume_hashes(self):
+        self.check_resume(compact=False)
+
+    def test_collisions_log_has_new_members_only(self):
+        finder = CollisionFinder(compact=True)
+        finder.work_checkpointed(2, limit=40000)
+        with open(main.COLLISIONS_LOG) as f:
+            logged = [json.loads(line) for line in f]
+        expected = [(prefix, candidate) for prefix, candidates in finder.get_partial_collisions()
+                    for candidate in candidates]
+        self.assertEqual(sorted((entry['prefix'], str(entry['candidate'])) for entry in logged),
+                         sorted((prefix, str(candidate)) for prefix, candidate in expected))
+
+
+if __name__ == '__main__':
+    unittest.main()